@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import httpx
+from django.db import close_old_connections
+
+from .client import POLL_TIMEOUT, RetryAfter, TelegramClient, TelegramError
+from .outbox import Outbox
+from .services import ERROR_TEXT, BotCommands, TelegramUserDirectory
+
+logger = logging.getLogger(__name__)
+
+# Потоков для ORM: команды синхронные, каждая в своём соединении с базой
+BOT_WORKERS = 8
+# Сообщений в обработке; больше — опрос ждёт, очередь в памяти не растёт без предела
+BOT_MAX_INFLIGHT = 5000
+# Пауза после ошибки опроса (сеть, 5xx)
+POLL_ERROR_PAUSE = 5
+
+
+def _db_call(func, *args):
+    # Как на границах HTTP-запроса: устаревшие и сломанные соединения потока закрываются
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+class TelegramBot:
+    """
+    Telegram-бот одним asyncio-процессом: долгий опрос getUpdates, команды —
+    в ограниченном пуле потоков (BOT_WORKERS), ответы — через исходящую очередь
+    с лимитами Telegram (Outbox).
+
+    Пользователи всей пачки обновлений разрешаются одним запросом (TelegramUserDirectory).
+    Сообщения одного чата обрабатываются по порядку, разных чатов — параллельно:
+    на чат с необработанными сообщениями — одна задача asyncio, тысячи ожидающих
+    чатов стоят только памяти под их очереди.
+    """
+
+    def __init__(self, client: TelegramClient = None, outbox: Outbox = None, directory: TelegramUserDirectory = None,
+                 workers: int = BOT_WORKERS, max_inflight: int = BOT_MAX_INFLIGHT):
+        self.client = client or TelegramClient()
+        # Пустая очередь ложна (__len__), поэтому сравнение с None
+        self.outbox = outbox if outbox is not None else Outbox(self.client.send_message)
+        self.directory = directory or TelegramUserDirectory()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='bot-db')
+        self.offset = None
+        self.handled = 0
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._chats = {}  # chat_id -> deque (сообщение, пользователь)
+        self._tasks = set()
+
+    async def in_pool(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(_db_call, func, *args))
+
+    async def poll_once(self, timeout: int = POLL_TIMEOUT) -> int:
+        """Один getUpdates: сообщения раздаются по чатам. Возвращает число принятых сообщений."""
+        messages = []
+        for update in await self.client.get_updates(self.offset, timeout):
+            self.offset = update['update_id'] + 1
+            message = update.get('message')
+            if message and message.get('text') and message.get('from'):
+                messages.append(message)
+        if not messages:
+            return 0
+
+        users = await self.in_pool(self.directory.resolve_many, [message['from']['id'] for message in messages])
+        for message in messages:
+            await self._inflight.acquire()
+            self._dispatch(message, users.get(message['from']['id']))
+        return len(messages)
+
+    def _dispatch(self, message, user):
+        chat_id = message['chat']['id']
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            task = asyncio.create_task(self._serve_chat(chat_id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((message, user))
+
+    async def _serve_chat(self, chat_id: int, queue: deque):
+        try:
+            while queue:
+                message, user = queue.popleft()
+                try:
+                    reply = await self.in_pool(BotCommands.handle, message['text'], message['from']['id'], user, self.directory)
+                except Exception as e:
+                    logger.error(f"Bot command {message['text']!r} in chat {chat_id} failed: {e}")
+                    reply = ERROR_TEXT
+                finally:
+                    self._inflight.release()
+                self.handled += 1
+                if reply:
+                    self.outbox.put(chat_id, reply)
+        finally:
+            del self._chats[chat_id]
+
+    async def join(self):
+        """Ждёт обработки принятых сообщений и отправки ответов."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+        await self.outbox.join()
+
+    async def run(self):
+        """Опрос до отмены задачи."""
+        outbox = asyncio.create_task(self.outbox.run())
+        logger.info("Telegram bot started.")
+        try:
+            while True:
+                try:
+                    await self.poll_once()
+                except RetryAfter as error:
+                    await asyncio.sleep(error.retry_after)
+                except (TelegramError, httpx.HTTPError) as e:
+                    logger.error(f"Telegram polling failed: {e}")
+                    await asyncio.sleep(POLL_ERROR_PAUSE)
+        finally:
+            outbox.cancel()
+            await self.client.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,67 @@
+import logging
+
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Долгий опрос getUpdates: сервер держит запрос до стольких секунд, если обновлений нет
+POLL_TIMEOUT = 25
+# Обновлений за один getUpdates (максимум Telegram)
+POLL_LIMIT = 100
+# Таймаут HTTP поверх долгого опроса
+REQUEST_TIMEOUT = POLL_TIMEOUT + 10
+# Одновременных соединений к API: исходящая очередь шлёт параллельно
+MAX_CONNECTIONS = 64
+
+
+class TelegramError(Exception):
+    """Ответ Bot API с ok=false."""
+
+    def __init__(self, method: str, description: str, error_code: int = None):
+        super().__init__(f"{method}: {description}")
+        self.error_code = error_code
+
+
+class RetryAfter(TelegramError):
+    """429 Too Many Requests: Telegram просит подождать retry_after секунд."""
+
+    def __init__(self, method: str, description: str, retry_after: float):
+        super().__init__(method, description, 429)
+        self.retry_after = retry_after
+
+
+class TelegramClient:
+    """
+    Клиент Bot API поверх httpx.AsyncClient: https://core.telegram.org/bots/api
+    Базовый адрес берётся из settings.TELEGRAM_API_URL — в тестах это локальный сервер.
+    """
+
+    def __init__(self, token: str = None, base_url: str = None, timeout: float = REQUEST_TIMEOUT):
+        token = token or settings.TELEGRAM_BOT_TOKEN
+        base_url = (base_url or settings.TELEGRAM_API_URL).rstrip('/')
+        self._http = httpx.AsyncClient(
+            base_url=f"{base_url}/bot{token}/",
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+        )
+
+    async def call(self, method: str, **params):
+        response = await self._http.post(method, json=params)
+        payload = response.json()
+        if payload.get('ok'):
+            return payload['result']
+        description = payload.get('description', response.reason_phrase)
+        retry_after = payload.get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            raise RetryAfter(method, description, retry_after)
+        raise TelegramError(method, description, payload.get('error_code', response.status_code))
+
+    async def get_updates(self, offset: int = None, timeout: int = POLL_TIMEOUT, limit: int = POLL_LIMIT) -> list:
+        return await self.call('getUpdates', offset=offset, timeout=timeout, limit=limit, allowed_updates=['message'])
+
+    async def send_message(self, chat_id: int, text: str):
+        return await self.call('sendMessage', chat_id=chat_id, text=text)
+
+    async def close(self):
+        await self._http.aclose()
@@ -0,0 +1,20 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from apps.bot.bot import BOT_WORKERS, TelegramBot
+
+class Command(BaseCommand):
+    help = ('Runs the Telegram bot: long polling against TELEGRAM_API_URL with TELEGRAM_BOT_TOKEN, '
+            'commands in a thread pool, replies through the rate-limited outbox.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=BOT_WORKERS, help='Threads for database access.')
+
+    def handle(self, *args, **options):
+        if not settings.TELEGRAM_BOT_TOKEN:
+            raise CommandError('TELEGRAM_BOT_TOKEN is not set.')
+        try:
+            asyncio.run(TelegramBot(workers=options['workers']).run())
+        except KeyboardInterrupt:
+            self.stdout.write('Telegram bot stopped.')
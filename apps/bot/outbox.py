@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+
+from .client import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не больше одного в секунду в чат
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_INTERVAL = 1.0
+# Одновременных sendMessage: при задержке API ~100 мс глобальный лимит набирается с запасом
+OUTBOX_CONCURRENCY = 32
+# Ожидающих сообщений на чат; сверх этого старые отбрасываются
+OUTBOX_CHAT_BACKLOG = 50
+MESSAGE_MAX_LENGTH = 4096
+COALESCE_SEPARATOR = '\n\n'
+
+
+def split_message(text: str, limit: int = MESSAGE_MAX_LENGTH) -> list:
+    """Режет текст на части не длиннее limit, по возможности по переводам строк."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+
+class Outbox:
+    """
+    Исходящая очередь бота с лимитами Telegram.
+
+    Глобальный лимит — равномерный интервал 1 / global_rate между отправками, лимит
+    чата — не чаще раза в chat_interval. Сообщения, пришедшие в чат, пока он ждёт
+    своей очереди, сливаются в одно (до MESSAGE_MAX_LENGTH символов): тысячи
+    ожидающих ответов — это тысячи элементов словаря, а не тысячи отправок.
+    Готовые к отправке чаты обслуживаются по кругу, в порядке готовности.
+
+    На 429 (RetryAfter) вся очередь ждёт retry_after секунд, а сообщение
+    возвращается в начало очереди своего чата.
+    """
+
+    def __init__(self, send, global_rate: float = OUTBOX_GLOBAL_RATE, chat_interval: float = OUTBOX_CHAT_INTERVAL,
+                 concurrency: int = OUTBOX_CONCURRENCY):
+        self._send = send  # корутина send(chat_id, text)
+        self.interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self._pending = {}  # chat_id -> deque текстов
+        self._ready = deque()  # чаты, которым можно отправлять сейчас
+        self._delayed = []  # куча (время, chat_id): чаты, ждущие лимита чата
+        self._next_at = {}  # chat_id -> раньше этого времени в чат не отправлять
+        self._tasks = set()
+        self._in_flight = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._paused_until = 0.0
+        self.sent = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, chat_id: int, text: str):
+        """Ставит ответ в очередь чата (не ждёт отправки)."""
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._schedule(chat_id)
+        queue.extend(split_message(text))
+        while len(queue) > OUTBOX_CHAT_BACKLOG:
+            queue.popleft()
+            logger.warning(f"Outbox backlog for chat {chat_id} is full, oldest message dropped.")
+        self._idle.clear()
+
+    def _schedule(self, chat_id: int):
+        now = time.monotonic()
+        when = self._next_at.get(chat_id, 0.0)
+        if when <= now:
+            self._next_at.pop(chat_id, None)
+            self._ready.append(chat_id)
+        else:
+            heapq.heappush(self._delayed, (when, chat_id))
+        self._wakeup.set()
+
+    def _take(self, chat_id: int) -> str:
+        """Первое сообщение чата вместе со всеми следующими, что помещаются в одно."""
+        queue = self._pending[chat_id]
+        parts = [queue.popleft()]
+        length = len(parts[0])
+        while queue and length + len(COALESCE_SEPARATOR) + len(queue[0]) <= MESSAGE_MAX_LENGTH:
+            length += len(COALESCE_SEPARATOR) + len(queue[0])
+            parts.append(queue.popleft())
+        self.coalesced += len(parts) - 1
+        if queue:
+            heapq.heappush(self._delayed, (self._next_at[chat_id], chat_id))
+        else:
+            del self._pending[chat_id]
+        return COALESCE_SEPARATOR.join(parts)
+
+    async def run(self):
+        """Цикл отправки; работает, пока задачу не отменят."""
+        next_send = 0.0
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.append(heapq.heappop(self._delayed)[1])
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+                continue
+
+            wait = max(next_send, self._paused_until) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            await self._slots.acquire()
+
+            chat_id = self._ready.popleft()
+            now = time.monotonic()
+            next_send = now + self.interval
+            self._next_at[chat_id] = now + self.chat_interval
+            text = self._take(chat_id)
+            self._in_flight += 1
+            task = asyncio.create_task(self._deliver(chat_id, text))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            # Сроки чатов, которые больше ничего не ждут, не копятся
+            if len(self._next_at) > 2 * len(self._pending) + 1024:
+                self._next_at = {chat: when for chat, when in self._next_at.items() if when > now}
+
+    async def _deliver(self, chat_id: int, text: str):
+        try:
+            await self._send(chat_id, text)
+            self.sent += 1
+        except RetryAfter as error:
+            # Флуд-контроль Telegram: пауза для всей очереди, сообщение — обратно в начало чата
+            logger.warning(f"Telegram flood control, outbox paused for {error.retry_after}s.")
+            self._paused_until = max(self._paused_until, time.monotonic() + error.retry_after)
+            queue = self._pending.get(chat_id)
+            if queue is None:
+                queue = self._pending[chat_id] = deque()
+                self._schedule(chat_id)
+            queue.appendleft(text)
+        except Exception as e:
+            # Чат удалён, бот заблокирован, сеть — сообщение не повторяем
+            logger.error(f"Outbox: failed to send to chat {chat_id}: {e}")
+        finally:
+            self._slots.release()
+            self._in_flight -= 1
+            if not self._pending and not self._in_flight:
+                self._idle.set()
+
+    async def join(self):
+        """Ждёт, пока очередь опустеет и все отправки завершатся."""
+        await self._idle.wait()
@@ -0,0 +1,166 @@
+import copy
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from rest_framework.authtoken.models import Token
+
+from apps.portfolio.services import PortfolioService
+from apps.users.authentication import LocalTokenCache
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Кэш telegram_id -> пользователь в процессе бота: размер и срок записи. Деактивация
+# пользователя на сайте становится видна боту не позже чем через BOT_USER_TTL секунд
+BOT_USER_CACHE_SIZE = 100_000
+BOT_USER_TTL = 60
+# Сколько помнить, что telegram_id не привязан (не ходить в базу на каждое сообщение)
+BOT_UNKNOWN_TTL = 10
+
+# Метка непривязанного telegram_id в кэше
+UNKNOWN = 'unknown'
+
+HELP_TEXT = (
+    "Биржевой симулятор.\n"
+    "/link <токен> — привязать аккаунт (токен выдаёт /auth/token/login/)\n"
+    "/portfolio — сводка по портфелю\n"
+    "/quote <тикер> — котировка\n"
+    "/buy <тикер> <количество> — купить\n"
+    "/sell <тикер> <количество> — продать"
+)
+NOT_LINKED_TEXT = "Аккаунт не привязан. Отправьте /link <токен>."
+ERROR_TEXT = "Не удалось выполнить команду, попробуйте позже."
+
+
+class TelegramUserDirectory:
+    """
+    telegram_id -> пользователь (с portfolio_id) для бота. Промахи по пачке сообщений
+    читаются одним запросом по уникальному индексу telegram_id, результат — и
+    "не привязан" тоже — держится в LRU процесса. Вызывается из потоков пула бота.
+    """
+
+    def __init__(self, maxsize: int = BOT_USER_CACHE_SIZE, ttl: float = BOT_USER_TTL):
+        self._cache = LocalTokenCache(maxsize, ttl)
+
+    def resolve_many(self, telegram_ids) -> dict:
+        """{telegram_id: пользователь} для привязанных активных пользователей; один запрос на все промахи."""
+        found, missing = {}, []
+        for telegram_id in set(telegram_ids):
+            user = self._cache.get(telegram_id)
+            if user is None:
+                missing.append(telegram_id)
+            elif user != UNKNOWN:
+                found[telegram_id] = user
+        if missing:
+            users = {
+                user.telegram_id: user
+                for user in User.objects.filter(telegram_id__in=missing, is_active=True).annotate(portfolio_id=F('portfolio'))
+            }
+            for telegram_id in missing:
+                user = users.get(telegram_id)
+                if user is None:
+                    self._cache.set(telegram_id, UNKNOWN, BOT_UNKNOWN_TTL)
+                else:
+                    self._cache.set(telegram_id, user)
+                    found[telegram_id] = user
+        return found
+
+    def cached(self, telegram_id):
+        """Пользователь из кэша без запроса к базе (None — неизвестен или не привязан)."""
+        user = self._cache.get(telegram_id)
+        return None if user == UNKNOWN else user
+
+    def remember(self, telegram_id, user):
+        self._cache.set(telegram_id, user)
+
+
+class BotCommands:
+    """
+    Команды бота: текст сообщения -> текст ответа. Синхронные, выполняются
+    в пуле потоков бота и вызывают те же сервисы, что и API.
+    """
+
+    @staticmethod
+    def handle(text: str, telegram_id: int, user, directory: TelegramUserDirectory) -> str:
+        command, *args = text.split() or ['/help']
+        # /cmd@имя_бота в группах
+        command = command.split('@')[0].lower()
+
+        if command in ('/start', '/help'):
+            return HELP_TEXT
+        if command == '/quote':
+            return BotCommands.quote(args)
+        if command == '/link':
+            return BotCommands.link(telegram_id, args, directory)
+
+        # Привязка могла случиться в этой же пачке сообщений, после разрешения пользователей
+        user = user or directory.cached(telegram_id)
+        if user is None:
+            return NOT_LINKED_TEXT
+        # Своя копия на команду: объект из кэша общий для потоков
+        user = copy.copy(user)
+        if command == '/portfolio':
+            return BotCommands.portfolio(user)
+        if command in ('/buy', '/sell'):
+            return BotCommands.trade(user, command[1:], args)
+        return HELP_TEXT
+
+    @staticmethod
+    def link(telegram_id: int, args, directory: TelegramUserDirectory) -> str:
+        if len(args) != 1:
+            return "Формат: /link <токен>"
+        token = Token.objects.select_related('user').filter(key=args[0]).first()
+        if token is None or not token.user.is_active:
+            return "Токен не найден."
+        user = token.user
+        with transaction.atomic():
+            # telegram_id уникален: прежняя привязка этого чата снимается
+            User.objects.filter(telegram_id=telegram_id).exclude(pk=user.pk).update(telegram_id=None)
+            user.telegram_id = telegram_id
+            user.save(update_fields=['telegram_id'])
+        user.portfolio_id = PortfolioService.resolve_portfolio(user).pk
+        directory.remember(telegram_id, user)
+        logger.info(f"{user.username} привязал Telegram {telegram_id}.")
+        return f"Аккаунт {user.username} привязан."
+
+    @staticmethod
+    def quote(args) -> str:
+        if len(args) != 1:
+            return "Формат: /quote <тикер>"
+        try:
+            quote = PortfolioService.get_quote(args[0])
+        except Http404:
+            return f"Акция {args[0].upper()} не найдена."
+        return f"{quote['ticker']} ({quote['name']}): {quote['price']} RUB, лот {quote['lot_size']}"
+
+    @staticmethod
+    def portfolio(user) -> str:
+        summary = PortfolioService.get_portfolio_summary(user)
+        lines = [
+            f"Баланс: {summary['balance']:.2f} RUB (в заявках {summary['reserved_balance']:.2f})",
+            f"Акции: {summary['total_market_value']:.2f} RUB",
+            f"Чистая стоимость: {summary['net_worth']:.2f} RUB",
+            f"P&L: {summary['total_profit_loss']:+.2f} RUB ({summary['total_profit_loss_percent']:+.2f}%)",
+        ]
+        for asset in summary['assets']:
+            lines.append(
+                f"{asset['ticker']}: {asset['quantity']} шт. по {asset['current_price']:.2f}, "
+                f"P&L {asset['profit_loss']:+.2f} ({asset['profit_loss_percent']:+.2f}%)"
+            )
+        return '\n'.join(lines)
+
+    @staticmethod
+    def trade(user, action: str, args) -> str:
+        if len(args) != 2 or not args[1].isdigit() or int(args[1]) <= 0:
+            return f"Формат: /{action} <тикер> <количество>"
+        ticker, quantity = args[0].upper(), int(args[1])
+        execute = PortfolioService.buy_stock if action == 'buy' else PortfolioService.sell_stock
+        try:
+            result = execute(user, ticker, quantity)
+        except Http404:
+            return f"Акция {ticker} не найдена."
+        return result['message'] if result['success'] else result['error']
@@ -1,3 +1,258 @@
-from django.test import TestCase
+import asyncio
+import json
+import multiprocessing
+import threading
+import time
+import urllib.request
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from rest_framework.authtoken.models import Token
+
+from apps.market.cache import PriceCache
+from apps.market.models import Stock
+from apps.portfolio.models import Transaction
+from apps.portfolio.services import PortfolioService
+from .bot import TelegramBot
+from .client import RetryAfter, TelegramClient
+from .outbox import Outbox, split_message
+from .services import NOT_LINKED_TEXT, TelegramUserDirectory
+
+User = get_user_model()
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    Локальная заглушка Bot API в отдельном процессе (как настоящий сервер — не делит GIL
+    с ботом): отдаёт заготовленные обновления и записывает отправленные сообщения.
+    """
+
+    daemon_threads = True
+    # Очередь соединений под параллельные отправки (по умолчанию 5 — лишние ждут повтора SYN)
+    request_queue_size = 1024
+
+    def __init__(self, messages, flood_once=False):
+        """messages: (telegram_id, текст); чат = пользователь, как в личной переписке."""
+        super().__init__(('127.0.0.1', 0), FakeTelegramHandler)
+        self.updates = [
+            {'update_id': update_id, 'message': {
+                'message_id': update_id, 'from': {'id': telegram_id}, 'chat': {'id': telegram_id}, 'text': text,
+            }}
+            for update_id, (telegram_id, text) in enumerate(messages, 1)
+        ]
+        self.sent = []
+        self.flood_once = flood_once
+        self.lock = threading.Lock()
+        self.process = multiprocessing.get_context('fork').Process(target=self.serve_forever, daemon=True)
+        self.process.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def fetch_sent(self):
+        with urllib.request.urlopen(f"{self.url}/sent") as response:
+            return [tuple(item) for item in json.load(response)]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.server_close()
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Ответы мелкие: без Nagle, иначе отложенный ACK даёт ~40 мс на запрос keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.reply(200, self.server.sent)
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+        server = self.server
+        with server.lock:
+            if method == 'getUpdates':
+                offset = params.get('offset') or 0
+                payload = {'ok': True, 'result': [u for u in server.updates if u['update_id'] >= offset][:params['limit']]}
+            elif method == 'sendMessage' and server.flood_once:
+                server.flood_once = False
+                payload = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.2}}
+            elif method == 'sendMessage':
+                server.sent.append((params['chat_id'], params['text']))
+                payload = {'ok': True, 'result': {'message_id': len(server.sent)}}
+            else:
+                payload = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        self.reply(200 if payload['ok'] else payload['error_code'], payload)
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TelegramBotTests(TransactionTestCase):
+    """Бот против локальной заглушки Bot API: команды, привязка, очередь ответов."""
+
+    def setUp(self):
+        cache.clear()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        PriceCache.publish()
+        self.user = User.objects.create(username='telegram_trader', telegram_id=1001)
+
+    def run_bot(self, messages, flood_once=False, **outbox_options):
+        """
+        Опрашивает заглушку, пока обновления не кончатся, и ждёт отправки всех ответов.
+        Возвращает (бот, {chat_id: [ответы]}).
+        """
+        server = FakeTelegramServer(messages, flood_once)
+        self.addCleanup(server.stop)
+
+        async def scenario():
+            client = TelegramClient(token='test', base_url=server.url)
+            bot = TelegramBot(client=client, outbox=Outbox(client.send_message, **outbox_options))
+            sender = asyncio.create_task(bot.outbox.run())
+            try:
+                while await bot.poll_once(timeout=0):
+                    pass
+                await bot.join()
+            finally:
+                sender.cancel()
+                await client.close()
+                bot.executor.shutdown()
+            return bot
+
+        bot = asyncio.run(scenario())
+        replies = {}
+        for chat_id, text in server.fetch_sent():
+            replies.setdefault(chat_id, []).append(text)
+        return bot, replies
+
+    def test_commands(self):
+        _, replies = self.run_bot([
+            (1001, '/quote sber'),
+            (1001, '/buy SBER 10'),
+            (1001, '/portfolio'),
+            (2002, '/portfolio'),
+            (1001, '/quote NOPE'),
+        ], global_rate=1000, chat_interval=0)
+
+        self.assertEqual(Transaction.objects.filter(portfolio__user=self.user, action='BUY', quantity=10).count(), 1)
+        text = '\n'.join(replies[1001])
+        self.assertIn('SBER (Сбербанк): 100.00 RUB, лот 10', text)
+        self.assertIn('SBER: 10 шт.', text)
+        self.assertIn('Акция NOPE не найдена.', text)
+        # Ответы чата — в порядке команд
+        self.assertLess(text.index('лот 10'), text.index('SBER: 10 шт.'))
+        self.assertEqual(replies[2002], [NOT_LINKED_TEXT])
+
+    def test_link_then_trade_in_one_batch(self):
+        other = User.objects.create(username='newcomer')
+        token = Token.objects.create(user=other)
+        self.run_bot([(3003, f'/link {token.key}'), (3003, '/buy SBER 20')], global_rate=1000, chat_interval=0)
+
+        other.refresh_from_db()
+        self.assertEqual(other.telegram_id, 3003)
+        self.assertEqual(Transaction.objects.filter(portfolio__user=other).count(), 1)
+
+    def test_replies_are_coalesced_per_chat(self):
+        # Пять команд подряд в один чат при лимите 1 сообщение в чат за интервал:
+        # первое уходит сразу, остальные сливаются
+        bot, replies = self.run_bot([(1001, '/quote SBER')] * 5, global_rate=1000, chat_interval=0.3)
+        self.assertEqual(bot.handled, 5)
+        self.assertLessEqual(len(replies[1001]), 3)
+        self.assertEqual(sum(text.count('SBER (Сбербанк)') for text in replies[1001]), 5)
+
+    def test_flood_control_retries(self):
+        _, replies = self.run_bot([(1001, '/quote SBER')], flood_once=True, global_rate=1000, chat_interval=0)
+        self.assertEqual(len(replies[1001]), 1)
+
+    def test_thousands_of_chats(self):
+        chats = 1000
+        User.objects.bulk_create([User(username=f"tg{i}", telegram_id=10_000 + i) for i in range(chats)])
+        messages = [(10_000 + i, '/quote SBER') for i in range(chats)] + [(50_000 + i, '/portfolio') for i in range(chats)]
+        started = time.perf_counter()
+        bot, replies = self.run_bot(messages, global_rate=100_000, chat_interval=0)
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(bot.handled, 2 * chats)
+        self.assertEqual(len(replies), 2 * chats)
+        self.assertTrue(all(len(texts) == 1 for texts in replies.values()))
+        self.assertLess(elapsed, 30)
+
+
+class OutboxTests(TestCase):
+    """Лимиты исходящей очереди без сети: отправка — запись времени."""
+
+    def deliver(self, messages, fail_first=False, **options):
+        sent = []
+
+        async def send(chat_id, text):
+            if fail_first and not sent:
+                sent.append(None)
+                raise RetryAfter('sendMessage', 'Too Many Requests', 0.1)
+            sent.append((time.monotonic(), chat_id, text))
+
+        async def scenario():
+            outbox = Outbox(send, **options)
+            for chat_id, text in messages:
+                outbox.put(chat_id, text)
+            sender = asyncio.create_task(outbox.run())
+            await asyncio.wait_for(outbox.join(), 10)
+            sender.cancel()
+            return outbox
+
+        outbox = asyncio.run(scenario())
+        return outbox, [item for item in sent if item is not None]
+
+    def test_global_rate(self):
+        _, sent = self.deliver([(chat, 'hi') for chat in range(10)], global_rate=50, chat_interval=0)
+        self.assertEqual(len(sent), 10)
+        gaps = [b[0] - a[0] for a, b in zip(sent, sent[1:])]
+        self.assertGreaterEqual(min(gaps), 1 / 50 - 0.002)
+
+    def test_chat_interval_and_coalescing(self):
+        outbox, sent = self.deliver([(1, 'first'), (2, 'other'), (1, 'second'), (1, 'third')], global_rate=1000, chat_interval=0.2)
+        to_first = [(moment, text) for moment, chat, text in sent if chat == 1]
+        self.assertEqual([text for _, text in to_first], ['first\n\nsecond\n\nthird'])
+        self.assertEqual(outbox.coalesced, 2)
+
+        _, sent = self.deliver([(1, 'a' * 3000), (1, 'b' * 3000)], global_rate=1000, chat_interval=0.2)
+        self.assertEqual(len(sent), 2)
+        self.assertGreaterEqual(sent[1][0] - sent[0][0], 0.2 - 0.01)
+
+    def test_retry_after_pauses_and_resends(self):
+        _, sent = self.deliver([(1, 'hello')], fail_first=True, global_rate=1000, chat_interval=0)
+        self.assertEqual([text for _, _, text in sent], ['hello'])
+
+    def test_split_long_message(self):
+        parts = split_message('line\n' * 2000, limit=100)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        self.assertEqual(''.join(part.replace('\n', '') for part in parts), 'line' * 2000)
+
+
+class TelegramUserDirectoryTests(TestCase):
+    """telegram_id -> пользователь: один запрос на пачку, затем из кэша процесса."""
+
+    def test_batch_lookup_is_cached(self):
+        User.objects.bulk_create([User(username=f"u{i}", telegram_id=i) for i in range(1, 51)])
+        PortfolioService.create_missing_portfolios()
+        directory = TelegramUserDirectory()
+        with self.assertNumQueries(1):
+            users = directory.resolve_many(list(range(1, 61)))
+        self.assertEqual(len(users), 50)
+        self.assertTrue(all(user.portfolio_id for user in users.values()))
+        # Привязанные и непривязанные (отрицательный кэш) — без базы
+        with self.assertNumQueries(0):
+            self.assertEqual(len(directory.resolve_many(list(range(1, 61)))), 50)
@@ -6,3 +6,12 @@ class MarketConfig(AppConfig):
     name = 'apps.market'
     label = 'market'
     verbose_name = 'биржа'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from .cache import on_stock_changed
+        from .models import Stock
+        # Правка акции (название, сектор, листинг) меняет версию метаданных: поиск
+        # и ETag списка рынка не зависят от версии цен
+        post_save.connect(on_stock_changed, sender=Stock, dispatch_uid='market.stock_saved')
+        post_delete.connect(on_stock_changed, sender=Stock, dispatch_uid='market.stock_deleted')
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Stock
+
+logger = logging.getLogger(__name__)
+
+# Снимок цен целиком и короткий ключ с его версией. Читатели сначала берут версию
+# (дешёвый get) и перечитывают снимок только если она изменилась.
+SNAPSHOT_KEY = 'market:prices:snapshot'
+VERSION_KEY = 'market:prices:version'
+
+# Снимок старше этого (нет ни одного прогона обновления цен) считается устаревшим
+PRICE_CACHE_MAX_AGE = 10 * 60
+
+# Версия метаданных акций (состав, названия, сектор, листинг) — отдельно от цен
+METADATA_VERSION_KEY = 'market:stocks:metadata_version'
+
+
+class PriceCache:
+    """
+    Общий кэш котировок: ticker -> id, название, цена, лот, время обновления.
+
+    Снимок публикуется целиком после каждого прогона обновления цен, в котором что-то
+    изменилось, и получает новую версию (микросекунды времени публикации, поэтому версия
+    растёт и после перезапуска или очистки кэша). В каждом процессе хранится своя копия
+    снимка, которая заменяется, как только в общем кэше появляется другая версия.
+    """
+
+    _local = {'version': None, 'snapshot': None, 'by_id': None}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _build_snapshot(version) -> dict:
+        stocks = {}
+        for row in Stock.objects.values('id', 'ticker', 'name', 'current_price', 'lot_size', 'updated_at'):
+            stocks[row['ticker']] = {
+                'id': row['id'],
+                'ticker': row['ticker'],
+                'name': row['name'],
+                'price': row['current_price'],
+                'lot_size': row['lot_size'],
+                'updated_at': row['updated_at'],
+            }
+        return {'version': version, 'published_at': time.time(), 'stocks': stocks}
+
+    @staticmethod
+    def publish() -> dict:
+        """Читает таблицу Stock одним запросом и публикует её как новую версию снимка."""
+        version = int(timezone.now().timestamp() * 1_000_000)
+        snapshot = PriceCache._build_snapshot(version)
+        # Сначала снимок, затем версия: читатель, увидевший новую версию, найдёт и снимок
+        cache.set(SNAPSHOT_KEY, snapshot, timeout=None)
+        cache.set(VERSION_KEY, {'version': version, 'checked_at': snapshot['published_at']}, timeout=None)
+        PriceCache._store_local(snapshot)
+        logger.info(f"Price cache published: version {version}, {len(snapshot['stocks'])} stocks.")
+        return snapshot
+
+    @staticmethod
+    def touch():
+        """Отмечает прогон обновления без изменений: версия та же, снимок снова считается свежим."""
+        marker = cache.get(VERSION_KEY)
+        if marker is None:
+            PriceCache.publish()
+            return
+        marker['checked_at'] = time.time()
+        cache.set(VERSION_KEY, marker, timeout=None)
+
+    @staticmethod
+    def _store_local(snapshot):
+        with PriceCache._lock:
+            PriceCache._local = {'version': snapshot['version'], 'snapshot': snapshot, 'by_id': None}
+
+    @staticmethod
+    def _marker() -> dict:
+        marker = cache.get(VERSION_KEY)
+        if marker is None:
+            # Общий кэш пуст (первый запуск, очистка Redis): собираем снимок из базы
+            snapshot = PriceCache.publish()
+            marker = {'version': snapshot['version'], 'checked_at': snapshot['published_at']}
+        return marker
+
+    @staticmethod
+    def get_snapshot(marker=None) -> dict:
+        """Текущий снимок: локальная копия процесса, если её версия совпадает с общей."""
+        marker = marker or PriceCache._marker()
+        local = PriceCache._local
+        if local['version'] == marker['version']:
+            return local['snapshot']
+
+        snapshot = cache.get(SNAPSHOT_KEY)
+        if snapshot is None or snapshot['version'] != marker['version']:
+            snapshot = PriceCache.publish()
+        else:
+            PriceCache._store_local(snapshot)
+        return snapshot
+
+    @staticmethod
+    def version() -> int:
+        return PriceCache._marker()['version']
+
+    @staticmethod
+    def is_fresh() -> bool:
+        """Был ли прогон обновления цен за последние PRICE_CACHE_MAX_AGE секунд."""
+        return time.time() - PriceCache._marker()['checked_at'] <= PRICE_CACHE_MAX_AGE
+
+    @staticmethod
+    def get_quote(ticker):
+        """Котировка по тикеру из снимка или None, если тикера в снимке нет."""
+        return PriceCache.get_snapshot()['stocks'].get(ticker.upper())
+
+    @staticmethod
+    def get_fresh_quote(ticker):
+        """Как get_quote, но None ещё и если снимок устарел (см. PRICE_CACHE_MAX_AGE)."""
+        marker = PriceCache._marker()
+        if time.time() - marker['checked_at'] > PRICE_CACHE_MAX_AGE:
+            return None
+        return PriceCache.get_snapshot(marker)['stocks'].get(ticker.upper())
+
+    @staticmethod
+    def get_quotes_by_id() -> dict:
+        """Те же котировки, но по Stock.id (индекс строится один раз на версию снимка)."""
+        snapshot = PriceCache.get_snapshot()
+        local = PriceCache._local
+        if local['version'] == snapshot['version'] and local['by_id'] is not None:
+            return local['by_id']
+        by_id = {quote['id']: quote for quote in snapshot['stocks'].values()}
+        with PriceCache._lock:
+            if PriceCache._local['version'] == snapshot['version']:
+                PriceCache._local['by_id'] = by_id
+        return by_id
+
+
+class StockMetadata:
+    """
+    Версия метаданных акций: меняется при сохранении и удалении Stock (админка) и при
+    пакетной инициализации списка, но не при обновлении цен. По ней перестраивается
+    индекс поиска и меняется ETag списка рынка.
+    """
+
+    @staticmethod
+    def version() -> int:
+        version = cache.get(METADATA_VERSION_KEY)
+        if version is None:
+            # Общий кэш пуст: первая версия; при гонке побеждает записанная раньше
+            cache.add(METADATA_VERSION_KEY, int(timezone.now().timestamp() * 1_000_000), timeout=None)
+            version = cache.get(METADATA_VERSION_KEY)
+        return version
+
+    @staticmethod
+    def bump() -> int:
+        version = int(timezone.now().timestamp() * 1_000_000)
+        cache.set(METADATA_VERSION_KEY, version, timeout=None)
+        return version
+
+
+def on_stock_changed(sender, **kwargs):
+    """
+    Подписчик post_save / post_delete Stock. Версия меняется сразу и ещё раз после
+    коммита: читатель, перестроивший индекс до коммита, не закрепит старые данные.
+    """
+    StockMetadata.bump()
+    transaction.on_commit(StockMetadata.bump)
@@ -4,9 +4,33 @@ from apps.market.services import MoexDataService
 class Command(BaseCommand):
     help = 'Initializes the database with a list of top stock tickers and their prices.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be inserted/updated, without writing to the database.',
+        )
+
     def handle(self, *args, **options):
-        self.stdout.write(self.style.SUCCESS("Starting MOEX stock data initialization..."))
+        dry_run = options['dry_run']
+        self.stdout.write(self.style.SUCCESS(
+            f"Starting MOEX stock data initialization{' (dry run)' if dry_run else ''}..."
+        ))
+
+        report = MoexDataService.initialize_top_stocks(dry_run=dry_run)
+
+        if report['error']:
+            self.stderr.write(self.style.ERROR(f"Could not fetch security list: {report['error']}"))
+            return
 
-        MoexDataService.initialize_top_stocks()
+        timings = report['timings']
+        self.stdout.write(
+            f"Fetched: {report['fetched']}, invalid: {report['invalid']}\n"
+            f"Inserted: {report['inserted']}, updated: {report['updated']}, unchanged: {report['unchanged']}\n"
+            f"Timings: fetch {timings['fetch']:.3f}s, load {timings['load']:.3f}s, "
+            f"diff {timings['diff']:.3f}s, write {timings['write']:.3f}s, prices {timings['prices']:.3f}s"
+        )
+        if report['prices'] is not None:
+            self.stdout.write(f"Prices changed: {report['prices']['changed']}")
 
-        self.stdout.write(self.style.SUCCESS("MOEX stock data initialization complete."))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS("MOEX stock data initialization complete."))
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.market.sources import MoexAlgoSource, SnapshotRecorder
+
+class Command(BaseCommand):
+    help = 'Records live MOEX marketdata()/tickers() snapshots into a gzip file for offline replay.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path to the .jsonl.gz file (appended if it exists).')
+        parser.add_argument('--count', type=int, default=1, help='Number of marketdata snapshots to record.')
+        parser.add_argument('--interval', type=float, default=120.0, help='Seconds between snapshots.')
+        parser.add_argument('--no-tickers', action='store_true', help='Do not record the tickers() metadata snapshot.')
+
+    def handle(self, *args, **options):
+        source = MoexAlgoSource()
+        recorder = SnapshotRecorder(options['output'])
+
+        if not options['no_tickers']:
+            rows = recorder.record('tickers', source.tickers())
+            self.stdout.write(f"tickers: {rows} rows")
+
+        for number in range(1, options['count'] + 1):
+            started = time.monotonic()
+            rows = recorder.record('marketdata', source.marketdata())
+            self.stdout.write(f"marketdata #{number}: {rows} rows")
+            if number < options['count']:
+                time.sleep(max(0.0, options['interval'] - (time.monotonic() - started)))
+
+        self.stdout.write(self.style.SUCCESS(f"Snapshots saved to {options['output']}."))
@@ -0,0 +1,50 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.market.services import MoexDataService
+from apps.market.sources import ReplaySource
+
+class Command(BaseCommand):
+    help = 'Replays recorded market snapshots through update_stock_prices and reports ingestion throughput.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File written by the recordmarket command.')
+        parser.add_argument('--speed', type=float, default=0,
+                            help='Replay speed: 1 = real time, 100 = 100x faster, 0 = as fast as possible.')
+        parser.add_argument('--runs', type=int, default=0, help='Stop after this many snapshots (0 = whole file).')
+        parser.add_argument('--loop', action='store_true', help='Start over when the recording ends (use with --runs).')
+        parser.add_argument('--init', action='store_true', help='Initialize stocks from the recorded tickers() snapshot first.')
+
+    def handle(self, *args, **options):
+        source = ReplaySource(options['path'], speed=options['speed'], loop=options['loop'])
+
+        if options['init']:
+            report = MoexDataService.initialize_top_stocks(source=source)
+            self.stdout.write(f"Initialized: inserted {report['inserted']}, updated {report['updated']}")
+
+        runs = rows = changed = 0
+        phases = {'load': 0.0, 'diff': 0.0, 'write': 0.0}
+        started = time.perf_counter()
+
+        while not options['runs'] or runs < options['runs']:
+            result = MoexDataService.update_stock_prices(source)
+            if source.exhausted:
+                break
+            runs += 1
+            rows += result['scanned']
+            changed += result['changed']
+            for phase, elapsed in result['timings'].items():
+                phases[phase] += elapsed
+
+        elapsed = time.perf_counter() - started
+        if not runs:
+            self.stderr.write(self.style.WARNING("No marketdata snapshots replayed."))
+            return
+
+        ingest_time = sum(phases.values())
+        self.stdout.write(
+            f"Snapshots: {runs}, rows scanned: {rows}, rows changed: {changed}\n"
+            f"Wall time: {elapsed:.3f}s, ingestion time: {ingest_time:.3f}s "
+            f"({rows / ingest_time if ingest_time else 0:.0f} rows/s)\n"
+            f"Per snapshot: load {phases['load'] / runs * 1000:.2f}ms, "
+            f"diff {phases['diff'] / runs * 1000:.2f}ms, write {phases['write'] / runs * 1000:.2f}ms"
+        )
@@ -0,0 +1,47 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.market.services import MoexDataService
+from apps.market.simulator import SimulatedSource
+
+class Command(BaseCommand):
+    help = 'Ticks all stocks with the synthetic price simulator through the bulk ingestion path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0.5, help='Wall-clock seconds between ticks.')
+        parser.add_argument('--ticks', type=int, default=0, help='Stop after this many ticks (0 = run forever).')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for a reproducible price path.')
+        parser.add_argument('--tick-seconds', type=float, default=None,
+                            help='Market time per tick in seconds (default: real elapsed time).')
+        parser.add_argument('--time-scale', type=float, default=1.0, help='Market time speed-up factor.')
+
+    def handle(self, *args, **options):
+        source = SimulatedSource(
+            seed=options['seed'],
+            tick_seconds=options['tick_seconds'],
+            time_scale=options['time_scale'],
+        )
+        ticks = 0
+        generate_time = ingest_time = 0.0
+
+        try:
+            while not options['ticks'] or ticks < options['ticks']:
+                started = time.perf_counter()
+                rows = source.marketdata()
+                generated = time.perf_counter()
+                result = MoexDataService.apply_market_data(rows)
+                finished = time.perf_counter()
+
+                ticks += 1
+                generate_time += generated - started
+                ingest_time += finished - generated
+                self.stdout.write(f"tick #{ticks}: {result['scanned']} rows, {result['changed']} changed")
+
+                time.sleep(max(0.0, options['interval'] - (time.perf_counter() - started)))
+        except KeyboardInterrupt:
+            pass
+
+        if ticks:
+            self.stdout.write(self.style.SUCCESS(
+                f"{ticks} ticks: generate {generate_time / ticks * 1000:.3f}ms/tick, "
+                f"ingest {ingest_time / ticks * 1000:.2f}ms/tick"
+            ))
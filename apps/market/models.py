@@ -71,6 +71,79 @@ class Stock(models.Model):
     class Meta:
         verbose_name = "Акция"
         verbose_name_plural = "Акции"
+        # Индексы под фильтры MarketListView (market_list.js): список всегда ограничен
+        # акциями с ценой и отсортирован по тикеру, поэтому индексы частичные
+        # (только current_price > 0) и заканчиваются тикером — без отдельной сортировки.
+        indexes = [
+            models.Index(fields=['ticker'], condition=models.Q(current_price__gt=0), name='market_stock_priced_idx'),
+            models.Index(fields=['sector', 'ticker'], condition=models.Q(current_price__gt=0), name='market_stock_sector_idx'),
+            models.Index(fields=['listing_level', 'ticker'], condition=models.Q(current_price__gt=0), name='market_stock_listing_idx'),
+            models.Index(fields=['stock_type', 'ticker'], condition=models.Q(current_price__gt=0), name='market_stock_type_idx'),
+            models.Index(
+                fields=['ticker'],
+                condition=models.Q(is_blue_chip=True, current_price__gt=0),
+                name='market_stock_blue_chip_idx',
+            ),
+        ]
 
     def __str__(self):
-        return f"{self.ticker} - {self.current_price} RUB"
\ No newline at end of file
+        return f"{self.ticker} - {self.current_price} RUB"
+
+# Сырые тики цены: пишутся пачкой на каждом прогоне обновления цен, только для изменившихся акций.
+# Таблица append-only, старые тики удаляются после свёртки в свечи (см. PriceHistoryService).
+class PriceTick(models.Model):
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='ticks')
+    price = models.DecimalField(max_digits=14, decimal_places=2, verbose_name="Цена")
+    timestamp = models.DateTimeField(verbose_name="Время")
+
+    class Meta:
+        verbose_name = "Тик цены"
+        verbose_name_plural = "Тики цен"
+        indexes = [
+            # Свёртка и очистка идут по окну времени сразу по всем акциям
+            models.Index(fields=['timestamp'], name='market_tick_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_id} {self.price} @ {self.timestamp:%Y-%m-%d %H:%M:%S}"
+
+
+# Свечи OHLC: 1 минута / 1 час / 1 день. Графики читают только эту таблицу.
+class Candle(models.Model):
+
+    INTERVAL_1M = '1m'
+    INTERVAL_1H = '1h'
+    INTERVAL_1D = '1d'
+
+    INTERVAL_CHOICES = [
+        (INTERVAL_1M, '1 минута'),
+        (INTERVAL_1H, '1 час'),
+        (INTERVAL_1D, '1 день'),
+    ]
+
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='candles')
+    interval = models.CharField(max_length=2, choices=INTERVAL_CHOICES, verbose_name="Интервал")
+    bucket_start = models.DateTimeField(verbose_name="Начало интервала")
+    open = models.DecimalField(max_digits=14, decimal_places=2)
+    high = models.DecimalField(max_digits=14, decimal_places=2)
+    low = models.DecimalField(max_digits=14, decimal_places=2)
+    close = models.DecimalField(max_digits=14, decimal_places=2)
+    ticks = models.PositiveIntegerField(default=0, verbose_name="Количество тиков")
+
+    class Meta:
+        verbose_name = "Свеча"
+        verbose_name_plural = "Свечи"
+        constraints = [
+            # Уникальный индекс (stock, interval, bucket_start) обслуживает запросы графиков
+            models.UniqueConstraint(
+                fields=['stock', 'interval', 'bucket_start'],
+                name='market_candle_stock_interval_bucket_uniq',
+            ),
+        ]
+        indexes = [
+            # Свёртка следующего уровня и очистка по retention
+            models.Index(fields=['interval', 'bucket_start'], name='market_candle_interval_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_id} {self.interval} {self.bucket_start:%Y-%m-%d %H:%M}"
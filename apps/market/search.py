@@ -0,0 +1,144 @@
+import threading
+from bisect import bisect_left
+
+from .cache import StockMetadata
+from .models import Stock
+
+# Раскладки клавиатуры: буква на той же клавише в QWERTY и ЙЦУКЕН
+LATIN_KEYS = "qwertyuiop[]asdfghjkl;'zxcvbnm,.`"
+CYRILLIC_KEYS = "йцукенгшщзхъфывапролджэячсмитьбюё"
+TO_CYRILLIC = str.maketrans(LATIN_KEYS, CYRILLIC_KEYS)
+TO_LATIN = str.maketrans(CYRILLIC_KEYS, LATIN_KEYS)
+
+# Ранги совпадений: чем меньше, тем выше в выдаче
+RANK_EXACT_TICKER = 0
+RANK_TICKER_PREFIX = 1
+RANK_NAME_PREFIX = 2
+RANK_SUBSTRING = 3
+
+NGRAM_SIZE = 3
+DEFAULT_LIMIT = 10
+
+
+def normalize(text) -> str:
+    """Регистр и ё/е не различаются (casefold работает и для кириллицы, в отличие от SQLite)."""
+    return text.casefold().replace('ё', 'е').strip()
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class StockSearchIndex:
+    """
+    Индекс поиска акций по тикеру и названию в памяти процесса.
+
+    Префиксы ищутся бинарным поиском по отсортированным тикерам и словам названий,
+    подстроки — пересечением списков триграмм. Запрос дополнительно пробуется в
+    другой раскладке ("ЫИУК" -> "sber"), ранжирование: точный тикер > начало тикера >
+    начало слова в названии > подстрока.
+    """
+
+    def __init__(self, stocks):
+        # stocks: итерируемое словарей с ключами 'ticker' и 'name'
+        self.entries = []
+        self.exact = {}
+        self.ticker_keys = []
+        self.word_keys = []
+        self.grams = {}
+
+        for position, stock in enumerate(sorted(stocks, key=lambda stock: stock['ticker'])):
+            ticker = normalize(stock['ticker'])
+            name = normalize(stock['name'] or '')
+            self.entries.append((ticker, name, {'ticker': stock['ticker'], 'name': stock['name']}))
+            self.exact[ticker] = position
+            self.ticker_keys.append((ticker, position))
+            # Название целиком и каждое его слово — для поиска по началу слова
+            for word in {name, *name.replace('-', ' ').replace('"', ' ').split()}:
+                if word:
+                    self.word_keys.append((word, position))
+            for gram in ngrams(ticker) | ngrams(name):
+                self.grams.setdefault(gram, set()).add(position)
+
+        self.ticker_keys.sort()
+        self.word_keys.sort()
+
+    @staticmethod
+    def _prefix_range(keys, prefix):
+        start = bisect_left(keys, (prefix,))
+        for key, position in keys[start:]:
+            if not key.startswith(prefix):
+                break
+            yield position
+
+    def _substring(self, query):
+        if len(query) < NGRAM_SIZE:
+            candidates = range(len(self.entries))
+        else:
+            sets = [self.grams.get(gram) for gram in ngrams(query)]
+            if not all(sets):
+                return
+            candidates = set.intersection(*sorted(sets, key=len))
+        for position in candidates:
+            ticker, name, _ = self.entries[position]
+            if query in ticker or query in name:
+                yield position
+
+    def _match(self, query, ranks):
+        def offer(position, rank):
+            if rank < ranks.get(position, RANK_SUBSTRING + 1):
+                ranks[position] = rank
+
+        if query in self.exact:
+            offer(self.exact[query], RANK_EXACT_TICKER)
+        for position in self._prefix_range(self.ticker_keys, query):
+            offer(position, RANK_TICKER_PREFIX)
+        for position in self._prefix_range(self.word_keys, query):
+            offer(position, RANK_NAME_PREFIX)
+        for position in self._substring(query):
+            offer(position, RANK_SUBSTRING)
+
+    def search(self, query, limit=DEFAULT_LIMIT) -> list:
+        """Акции ({'ticker', 'name'}) по убыванию релевантности; limit=None — все совпадения."""
+        typed = (query or '').casefold().strip()
+        if not normalize(typed):
+            return []
+
+        ranks = {}
+        # Как набрано, затем в другой раскладке; совпадение по исходному запросу важнее.
+        # Нормализуется уже переведённый запрос: клавиша ` в русской раскладке даёт "ё"
+        for variant_rank, variant in enumerate(dict.fromkeys(
+            normalize(variant) for variant in (typed, typed.translate(TO_LATIN), typed.translate(TO_CYRILLIC))
+        )):
+            variant_ranks = {}
+            self._match(variant, variant_ranks)
+            for position, rank in variant_ranks.items():
+                key = (rank, variant_rank)
+                if key < ranks.get(position, (RANK_SUBSTRING + 1, 0)):
+                    ranks[position] = key
+
+        # Внутри одного ранга — по алфавиту тикера (entries отсортированы по тикеру)
+        positions = sorted(ranks, key=lambda position: (ranks[position], position))
+        if limit is not None:
+            positions = positions[:limit]
+        return [self.entries[position][2] for position in positions]
+
+
+_index = {'version': None, 'index': None}
+_index_lock = threading.Lock()
+
+
+def get_search_index() -> StockSearchIndex:
+    """
+    Индекс для текущей версии метаданных акций (StockMetadata).
+
+    Строится при первом поиске одним запросом к базе и перестраивается, только когда
+    меняются сами акции (состав, названия); обновления цен индекс не трогают.
+    """
+    version = StockMetadata.version()
+    if _index['version'] != version:
+        index = StockSearchIndex(Stock.objects.values('ticker', 'name'))
+        with _index_lock:
+            _index['version'] = version
+            _index['index'] = index
+    return _index['index']
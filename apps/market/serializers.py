@@ -1,5 +1,5 @@
 from rest_framework.serializers import ModelSerializer
-from .models import Stock
+from .models import Stock, Candle
 
 class StockSearchSerializer(ModelSerializer):
     class Meta:
@@ -9,7 +9,23 @@ class StockSearchSerializer(ModelSerializer):
 class MarketStockSerializer(ModelSerializer):
     """
     Сериализатор для полного списка акций на странице "Рынок"
+    Необязательный аргумент fields оставляет в ответе только перечисленные поля.
     """
     class Meta:
         model = Stock
-        fields = ['ticker', 'name', 'current_price']
\ No newline at end of file
+        fields = ['ticker', 'name', 'current_price']
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+class CandleSerializer(ModelSerializer):
+    """
+    Свеча OHLC для графика цены.
+    """
+    class Meta:
+        model = Candle
+        fields = ['bucket_start', 'open', 'high', 'low', 'close', 'ticks']
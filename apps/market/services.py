@@ -1,107 +1,465 @@
-from decimal import Decimal
-from moexalgo import Market, Ticker
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from django.db import transaction
 from django.utils import timezone
-from .models import Stock
+from .models import Stock, PriceTick, Candle
+from .sources import get_market_data_source
+from .cache import PriceCache, StockMetadata
+from .signals import prices_updated, prices_written
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Точность поля Stock.current_price (2 знака после запятой)
+PRICE_QUANT = Decimal('0.01')
+# Сколько строк обновлять одним UPDATE в bulk_update
+PRICE_UPDATE_BATCH_SIZE = 200
+# Размер пачки для bulk_create/bulk_update при инициализации списка акций
+STOCK_UPSERT_BATCH_SIZE = 500
+# Ограничения полей Stock.ticker и Stock.name
+TICKER_MAX_LENGTH = Stock._meta.get_field('ticker').max_length
+NAME_MAX_LENGTH = Stock._meta.get_field('name').max_length
+# Размер пачки для записи/чтения/удаления тиков и свечей
+PRICE_HISTORY_BATCH_SIZE = 1000
+# Максимум свечей в одном ответе API
+MAX_CANDLES_PER_REQUEST = 2000
+
 class MoexDataService:
 
     @staticmethod
-    def initialize_top_stocks():
-        """Инициализирует базу данных основными акциями, получает их реальные имена."""
+    def initialize_top_stocks(dry_run: bool = False, source=None) -> dict:
+        """
+        Инициализирует базу данных основными акциями, получает их реальные имена.
+
+        Работает как пакетный upsert: существующие тикеры читаются одним запросом,
+        новые акции добавляются через bulk_create, у существующих обновляются
+        название и размер лота через bulk_update — всё в одной транзакции.
+        При dry_run=True ничего не пишет и только возвращает отчёт.
+        source — источник данных (MarketDataSource), по умолчанию из настроек.
+        """
         logger.info("Starting initial stock data population...")
-        new_stocks_count = 0
+        report = {
+            'dry_run': dry_run,
+            'fetched': 0,
+            'invalid': 0,
+            'inserted': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'error': None,
+            'prices': None,
+            'timings': {'fetch': 0.0, 'load': 0.0, 'diff': 0.0, 'write': 0.0, 'prices': 0.0},
+        }
+        timings = report['timings']
 
+        started = time.perf_counter()
+        source = source or get_market_data_source()
         try:
-            market = Market('shares', 'tqbr')
             # Получаем все метаданные ценных бумаг с доски TQBR
-            security_list = market.tickers('*')
+            security_list = source.tickers()
 
         except Exception as e:
-            logger.error(f"FATAL: Could not fetch security list via Market.tickers(): {e}")
-            return
+            logger.error(f"FATAL: Could not fetch security list via {type(source).__name__}.tickers(): {e}")
+            report['error'] = str(e)
+            return report
+        timings['fetch'] = time.perf_counter() - started
 
+        # 1. Нормализуем фид: один словарь ticker -> (name, lot_size), дубли схлопываются
+        started = time.perf_counter()
+        incoming = {}
         for sec_info in security_list:
+            report['fetched'] += 1
 
             # Извлекаем данные
             ticker_symbol = sec_info.get('ticker')
             real_name = sec_info.get('shortname')
-            fetched_lot_size = sec_info.get('lotsize', 1)
+            fetched_lot_size = MoexDataService._to_lot_size(sec_info.get('lotsize', 1))
 
             # Базовая валидация: пропускаем, если нет тикера, имени или лот некорректен
-            if not ticker_symbol or not real_name or fetched_lot_size is None or fetched_lot_size < 1:
+            if not ticker_symbol or not real_name or fetched_lot_size is None:
+                report['invalid'] += 1
                 continue
 
             ticker_symbol = ticker_symbol.upper()
+            if len(ticker_symbol) > TICKER_MAX_LENGTH:
+                report['invalid'] += 1
+                continue
 
-            # Используем get_or_createдля добавления новой акции
-            stock, created = Stock.objects.get_or_create(
-                ticker=ticker_symbol,
-                defaults={
-                    'name': real_name,
-                    'lot_size': fetched_lot_size,
-                    'current_price': 0.00
-                }
-            )
+            incoming[ticker_symbol] = (real_name[:NAME_MAX_LENGTH], fetched_lot_size)
 
-            if created:
-                new_stocks_count += 1
+        # 2. Одно чтение существующих тикеров
+        existing = {
+            stock.ticker: stock
+            for stock in Stock.objects.only('id', 'ticker', 'name', 'lot_size')
+        }
+        timings['load'] = time.perf_counter() - started
 
-        logger.info(f"Initial stock data population finished. Added {new_stocks_count} new stocks.")
+        # 3. Раскладываем на новые / изменившиеся / без изменений
+        started = time.perf_counter()
+        stocks_to_create = []
+        stocks_to_update = []
+        for ticker_symbol, (real_name, lot_size) in incoming.items():
+            stock = existing.get(ticker_symbol)
+            if stock is None:
+                stocks_to_create.append(Stock(
+                    ticker=ticker_symbol,
+                    name=real_name,
+                    lot_size=lot_size,
+                    current_price=Decimal('0.00'),
+                ))
+            elif stock.name != real_name or stock.lot_size != lot_size:
+                stock.name = real_name
+                stock.lot_size = lot_size
+                stocks_to_update.append(stock)
+            else:
+                report['unchanged'] += 1
+        report['inserted'] = len(stocks_to_create)
+        report['updated'] = len(stocks_to_update)
+        timings['diff'] = time.perf_counter() - started
 
-        MoexDataService.update_stock_prices()
+        # 4. Запись одной транзакцией
+        started = time.perf_counter()
+        if not dry_run and (stocks_to_create or stocks_to_update):
+            with transaction.atomic():
+                Stock.objects.bulk_create(stocks_to_create, batch_size=STOCK_UPSERT_BATCH_SIZE)
+                Stock.objects.bulk_update(
+                    stocks_to_update, ['name', 'lot_size'], batch_size=STOCK_UPSERT_BATCH_SIZE
+                )
+            # Пакетные запросы не шлют сигналы модели — версия метаданных меняется явно
+            StockMetadata.bump()
+            PriceCache.publish()
+        timings['write'] = time.perf_counter() - started
 
-    @staticmethod
-    @transaction.atomic
-    def update_stock_prices():
-        """Обновляет текущие цены (last) и размер лота (lotsize)."""
-        tracked_tickers = set(Stock.objects.values_list('ticker', flat=True))
-        stocks_to_update = []
-        now = timezone.now()
+        logger.info(
+            f"Initial stock data population finished{' (dry run)' if dry_run else ''}. "
+            f"Inserted {report['inserted']}, updated {report['updated']}, "
+            f"unchanged {report['unchanged']}, invalid {report['invalid']}."
+        )
 
-        try:
-            market = Market('shares', 'tqbr')
-            market_data_list = market.marketdata()
-
-            for data_row in market_data_list:
-                # Все ключи в нижнем регистре: 'ticker', 'last', 'lotsize'
-                ticker_symbol = data_row.get('ticker', None)
-                if ticker_symbol:
-                    ticker_symbol = ticker_symbol.upper()
-
-                if ticker_symbol not in tracked_tickers:
-                    continue
-
-                last_price = data_row.get('last', None)
-                lot_size = data_row.get('lotsize', None)
-                stock = Stock.objects.get(ticker=ticker_symbol)
-                has_changed = False
-
-                if last_price and last_price > Decimal('0'):
-                    if stock.current_price != last_price:
-                        stock.current_price = last_price
-                        has_changed = True
-
-                # Обновляем лот, если он предоставлен API
-                if lot_size is not None and lot_size > 0:
-                    if stock.current_price != last_price:
-                        stock.current_price = last_price
-                        has_changed = True
-
-                if has_changed:
-                    stock.updated_at = now
-                    stocks_to_update.append(stock)
-            # ... (bulk_update logic) ...
-            if stocks_to_update:
-                # Обновляем и цену, и размер лота
-                Stock.objects.bulk_update(stocks_to_update, ['current_price', 'lot_size', 'updated_at'])
-                logger.info(f"Successfully updated prices for {len(stocks_to_update)} stocks.")
-            else:
-                logger.warning("No valid price updates received from MOEX.")
+        if not dry_run:
+            started = time.perf_counter()
+            report['prices'] = MoexDataService.update_stock_prices(source)
+            timings['prices'] = time.perf_counter() - started
+
+        return report
 
+    @staticmethod
+    def update_stock_prices(source=None) -> dict:
+        """
+        Обновляет текущие цены (last) и размер лота (lotsize).
+        source — источник данных (MarketDataSource), по умолчанию из настроек.
+        """
+        source = source or get_market_data_source()
+        try:
+            market_data_list = source.marketdata()
         except Exception as e:
             logger.error(f"Fatal error during MOEX price update: {e}")
+            return MoexDataService._empty_update_result()
+
+        return MoexDataService.apply_market_data(market_data_list)
+
+    @staticmethod
+    def _empty_update_result() -> dict:
+        return {
+            'scanned': 0,
+            'changed': 0,
+            'skipped': 0,
+            'ticks': 0,
+            'changes': [],
+            'timings': {'load': 0.0, 'diff': 0.0, 'write': 0.0},
+        }
+
+    @staticmethod
+    def _to_price(value):
+        """Приводит цену из фида к Decimal с точностью поля current_price (копейки)."""
+        if value is None:
+            return None
+        try:
+            price = Decimal(str(value)).quantize(PRICE_QUANT, rounding=ROUND_HALF_UP)
+        except (InvalidOperation, ValueError):
+            return None
+        # NaN/Infinity из фида не являются ценой
+        if not price.is_finite() or price <= Decimal('0'):
+            return None
+        return price
+
+    @staticmethod
+    def _to_lot_size(value):
+        if value is None:
+            return None
+        try:
+            lot_size = int(value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return lot_size if lot_size > 0 else None
+
+    @staticmethod
+    def apply_market_data(market_data_list, now=None) -> dict:
+        """
+        Применяет срез рыночных данных к таблице Stock.
+
+        Все отслеживаемые акции читаются одним запросом, изменения считаются в памяти,
+        а в базу пишутся только изменившиеся строки пачками bulk_update.
+        Возвращает статистику прогона: scanned / changed / skipped, список изменений
+        и время каждой фазы (load, diff, write) в секундах.
+        """
+        result = MoexDataService._empty_update_result()
+        timings = result['timings']
+        now = now or timezone.now()
+
+        # 1. Загрузка: одна выборка вместо SELECT на каждый тикер
+        started = time.perf_counter()
+        stocks_by_ticker = {
+            stock.ticker: stock
+            for stock in Stock.objects.only('id', 'ticker', 'current_price', 'lot_size')
+        }
+        timings['load'] = time.perf_counter() - started
+
+        # 2. Дифф: сравниваем цену и лот с входящим фидом
+        started = time.perf_counter()
+        stocks_to_update = []
+        changes = result['changes']
+
+        for data_row in market_data_list:
+            result['scanned'] += 1
+            # Все ключи в нижнем регистре: 'ticker', 'last', 'lotsize'
+            ticker_symbol = data_row.get('ticker', None)
+            stock = stocks_by_ticker.get(ticker_symbol.upper()) if ticker_symbol else None
+
+            if stock is None:
+                result['skipped'] += 1
+                continue
+
+            last_price = MoexDataService._to_price(data_row.get('last', None))
+            lot_size = MoexDataService._to_lot_size(data_row.get('lotsize', None))
+
+            old_price = stock.current_price
+            old_lot_size = stock.lot_size
+            price_changed = last_price is not None and last_price != old_price
+            # Обновляем лот, если он предоставлен API
+            lot_changed = lot_size is not None and lot_size != old_lot_size
+
+            if not (price_changed or lot_changed):
+                continue
+
+            if price_changed:
+                stock.current_price = last_price
+            if lot_changed:
+                stock.lot_size = lot_size
+            stock.updated_at = now
+            stocks_to_update.append(stock)
+            changes.append({
+                'stock_id': stock.id,
+                'ticker': stock.ticker,
+                'old_price': old_price,
+                'price': stock.current_price,
+                'old_lot_size': old_lot_size,
+                'lot_size': stock.lot_size,
+            })
+        timings['diff'] = time.perf_counter() - started
+
+        # 3. Запись: только изменившиеся строки, пачками, в короткой транзакции
+        started = time.perf_counter()
+        if stocks_to_update:
+            with transaction.atomic():
+                Stock.objects.bulk_update(
+                    stocks_to_update,
+                    ['current_price', 'lot_size', 'updated_at'],
+                    batch_size=PRICE_UPDATE_BATCH_SIZE,
+                )
+                result['ticks'] = PriceHistoryService.record_ticks(changes, now)
+                for receiver, response in prices_written.send_robust(sender=MoexDataService, changes=changes):
+                    if isinstance(response, Exception):
+                        logger.error(f"prices_written receiver {receiver.__qualname__} failed: {response}")
+            # Новая версия снимка цен для торговли и оценки портфелей
+            PriceCache.publish()
+            logger.info(f"Successfully updated prices for {len(stocks_to_update)} stocks.")
+        else:
+            PriceCache.touch()
+            logger.warning("No valid price updates received from MOEX.")
+        timings['write'] = time.perf_counter() - started
+
+        # Подписчики (например, движок отложенных заявок) — после записи и публикации цен.
+        # Ошибка подписчика не должна ломать обновление цен.
+        for receiver, response in prices_updated.send_robust(sender=MoexDataService, changes=changes):
+            if isinstance(response, Exception):
+                logger.error(f"prices_updated receiver {receiver.__qualname__} failed: {response}")
+
+        result['changed'] = len(stocks_to_update)
+        logger.info(
+            f"Market data applied: scanned={result['scanned']}, changed={result['changed']}, "
+            f"skipped={result['skipped']}, load={timings['load']:.4f}s, "
+            f"diff={timings['diff']:.4f}s, write={timings['write']:.4f}s."
+        )
+        return result
+
+
+class PriceHistoryService:
+    """
+    История цен: сырые тики (PriceTick) и свёрнутые свечи OHLC (Candle).
+
+    Тики пишутся из MoexDataService.apply_market_data, фоновые задачи сворачивают
+    их в минутные свечи, минутные — в часовые, часовые — в дневные, а prune()
+    удаляет данные старше срока хранения своего уровня.
+    """
+
+    # Из какого уровня собирается каждый интервал (None — из сырых тиков)
+    ROLLUP_SOURCE = {
+        Candle.INTERVAL_1M: None,
+        Candle.INTERVAL_1H: Candle.INTERVAL_1M,
+        Candle.INTERVAL_1D: Candle.INTERVAL_1H,
+    }
+
+    # Сколько последних интервалов пересчитывается при каждом запуске свёртки
+    ROLLUP_LOOKBACK = {
+        Candle.INTERVAL_1M: timedelta(minutes=15),
+        Candle.INTERVAL_1H: timedelta(hours=3),
+        Candle.INTERVAL_1D: timedelta(days=2),
+    }
+
+    # Срок хранения: сырые тики и каждый уровень свечей (None — хранить всегда)
+    TICK_RETENTION = timedelta(days=2)
+    CANDLE_RETENTION = {
+        Candle.INTERVAL_1M: timedelta(days=7),
+        Candle.INTERVAL_1H: timedelta(days=365),
+        Candle.INTERVAL_1D: None,
+    }
+
+    # Какой уровень отдавать графику в зависимости от длины запрошенного диапазона
+    INTERVAL_FOR_SPAN = (
+        (timedelta(days=2), Candle.INTERVAL_1M),
+        (timedelta(days=90), Candle.INTERVAL_1H),
+    )
+
+    @staticmethod
+    def record_ticks(changes, now) -> int:
+        """Пишет тики одной пачкой для акций, у которых изменилась цена."""
+        ticks = [
+            PriceTick(stock_id=change['stock_id'], price=change['price'], timestamp=now)
+            for change in changes
+            if change['price'] != change['old_price']
+        ]
+        PriceTick.objects.bulk_create(ticks, batch_size=PRICE_HISTORY_BATCH_SIZE)
+        return len(ticks)
+
+    @staticmethod
+    def bucket_start(moment, interval):
+        """Начало интервала, в который попадает moment. Дни считаются по локальному времени (TIME_ZONE)."""
+        if interval == Candle.INTERVAL_1M:
+            return moment.replace(second=0, microsecond=0)
+        if interval == Candle.INTERVAL_1H:
+            return moment.replace(minute=0, second=0, microsecond=0)
+        local = timezone.localtime(moment)
+        return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def interval_for_span(span) -> str:
+        for max_span, interval in PriceHistoryService.INTERVAL_FOR_SPAN:
+            if span <= max_span:
+                return interval
+        return Candle.INTERVAL_1D
+
+    @staticmethod
+    def _source_rows(interval, since, until):
+        """Строки (stock_id, время, open, high, low, close, ticks) источника свёртки в порядке времени."""
+        source = PriceHistoryService.ROLLUP_SOURCE[interval]
+        if source is None:
+            rows = PriceTick.objects.filter(
+                timestamp__gte=since, timestamp__lt=until
+            ).order_by('timestamp', 'id').values_list('stock_id', 'timestamp', 'price')
+            for stock_id, moment, price in rows.iterator(chunk_size=PRICE_HISTORY_BATCH_SIZE):
+                yield stock_id, moment, price, price, price, price, 1
+        else:
+            rows = Candle.objects.filter(
+                interval=source, bucket_start__gte=since, bucket_start__lt=until
+            ).order_by('bucket_start').values_list(
+                'stock_id', 'bucket_start', 'open', 'high', 'low', 'close', 'ticks'
+            )
+            yield from rows.iterator(chunk_size=PRICE_HISTORY_BATCH_SIZE)
+
+    @staticmethod
+    def rollup(interval, now=None, lookback=None) -> int:
+        """
+        Пересчитывает свечи интервала interval за последние lookback.
+
+        Свечи последних интервалов пересобираются целиком из нижнего уровня и пишутся
+        одним upsert-запросом на пачку, поэтому повторный запуск идемпотентен.
+        Возвращает количество записанных свечей.
+        """
+        now = now or timezone.now()
+        lookback = lookback or PriceHistoryService.ROLLUP_LOOKBACK[interval]
+        since = PriceHistoryService.bucket_start(now - lookback, interval)
+
+        candles = {}
+        for stock_id, moment, open_, high, low, close, ticks in PriceHistoryService._source_rows(interval, since, now):
+            key = (stock_id, PriceHistoryService.bucket_start(moment, interval))
+            candle = candles.get(key)
+            if candle is None:
+                candles[key] = Candle(
+                    stock_id=stock_id, interval=interval, bucket_start=key[1],
+                    open=open_, high=high, low=low, close=close, ticks=ticks,
+                )
+                continue
+            # Источник упорядочен по времени: open — первый, close — последний
+            candle.high = max(candle.high, high)
+            candle.low = min(candle.low, low)
+            candle.close = close
+            candle.ticks += ticks
+
+        Candle.objects.bulk_create(
+            candles.values(),
+            batch_size=PRICE_HISTORY_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['stock', 'interval', 'bucket_start'],
+            update_fields=['open', 'high', 'low', 'close', 'ticks'],
+        )
+        logger.info(f"Price history rollup {interval}: {len(candles)} candles since {since:%Y-%m-%d %H:%M}.")
+        return len(candles)
+
+    @staticmethod
+    def _delete_in_batches(queryset) -> int:
+        """Удаляет строки небольшими пачками, чтобы не держать долгую блокировку записи."""
+        deleted = 0
+        while True:
+            ids = list(queryset.values_list('id', flat=True)[:PRICE_HISTORY_BATCH_SIZE])
+            if not ids:
+                return deleted
+            deleted += queryset.model.objects.filter(id__in=ids).delete()[0]
+
+    @staticmethod
+    def prune(now=None) -> dict:
+        """Удаляет тики и свечи старше срока хранения своего уровня."""
+        now = now or timezone.now()
+        result = {
+            'ticks': PriceHistoryService._delete_in_batches(
+                PriceTick.objects.filter(timestamp__lt=now - PriceHistoryService.TICK_RETENTION)
+            ),
+        }
+        for interval, retention in PriceHistoryService.CANDLE_RETENTION.items():
+            if retention is None:
+                continue
+            result[interval] = PriceHistoryService._delete_in_batches(
+                Candle.objects.filter(interval=interval, bucket_start__lt=now - retention)
+            )
+        logger.info(f"Price history pruned: {result}.")
+        return result
+
+    @staticmethod
+    def get_candles(stock, interval=None, date_from=None, date_to=None):
+        """
+        Свечи акции за диапазон [date_from, date_to).
+
+        Если интервал не задан, уровень выбирается по длине диапазона. Запрос идёт
+        только по таблице свечей и покрывается индексом (stock, interval, bucket_start).
+        """
+        date_to = date_to or timezone.now()
+        date_from = date_from or date_to - timedelta(days=1)
+        interval = interval or PriceHistoryService.interval_for_span(date_to - date_from)
 
+        candles = Candle.objects.filter(
+            stock=stock,
+            interval=interval,
+            bucket_start__gte=date_from,
+            bucket_start__lt=date_to,
+        ).order_by('bucket_start')[:MAX_CANDLES_PER_REQUEST]
+        return interval, candles
@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+# Отправляется внутри транзакции записи цен в MoexDataService.apply_market_data, сразу
+# после bulk_update Stock: подписчик видит новые цены и пишет в той же транзакции.
+# Аргументы те же, что у prices_updated (changes не пуст). Подписчик должен быть быстрым
+# и сам оборачивать запись в transaction.atomic(), чтобы его ошибка не сорвала запись цен.
+prices_written = Signal()
+
+# Отправляется в конце каждого прогона MoexDataService.apply_market_data, уже после
+# публикации снимка цен. Аргументы: changes — список изменений прогона
+# (stock_id, ticker, old_price, price, old_lot_size, lot_size), может быть пустым.
+# Подписчики из других приложений подключаются в AppConfig.ready().
+prices_updated = Signal()
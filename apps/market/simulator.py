@@ -0,0 +1,152 @@
+import logging
+import time
+
+import numpy as np
+from django.db.models import Count, Max
+
+from .models import Stock
+from .sources import MarketDataSource
+
+logger = logging.getLogger(__name__)
+
+# Годовые drift и волатильность по секторам (Stock.SECTOR_CHOICES)
+SECTOR_PARAMS = {
+    'OGAS': (0.08, 0.30),
+    'FINS': (0.10, 0.28),
+    'MTLS': (0.06, 0.35),
+    'TLCM': (0.05, 0.22),
+    'RTIL': (0.07, 0.30),
+    'IT': (0.15, 0.45),
+    'ELC': (0.04, 0.25),
+    'OTHR': (0.05, 0.40),
+}
+DEFAULT_SECTOR = 'OTHR'
+
+# Корреляция доходностей: любых двух акций (общий рыночный фактор)
+# и двух акций одного сектора (рыночный + секторный фактор)
+MARKET_CORRELATION = 0.30
+SECTOR_CORRELATION = 0.55
+
+# Торговый год: 252 дня по 8.5 часов основной сессии
+SECONDS_PER_TRADING_YEAR = 252 * 8.5 * 3600
+# Цена для акций, у которых в базе ещё нет котировки
+DEFAULT_START_PRICE = 100.0
+MIN_PRICE = 0.01
+
+
+class PriceSimulator:
+    """
+    Векторный генератор цен: геометрическое броуновское движение с корреляцией.
+
+    Шок каждой акции складывается из общего рыночного фактора, фактора её сектора
+    и собственного шума, поэтому один шаг — это несколько операций NumPy над
+    массивами длины N без циклов Python.
+    """
+
+    def __init__(self, prices, sectors, seed=None,
+                 market_correlation=MARKET_CORRELATION, sector_correlation=SECTOR_CORRELATION):
+        self.rng = np.random.default_rng(seed)
+        self.log_prices = np.log(np.maximum(np.asarray(prices, dtype=np.float64), MIN_PRICE))
+
+        sector_names = sorted(SECTOR_PARAMS)
+        sector_index = {name: index for index, name in enumerate(sector_names)}
+        sectors = [sector if sector in SECTOR_PARAMS else DEFAULT_SECTOR for sector in sectors]
+        self.sector_idx = np.array([sector_index[sector] for sector in sectors], dtype=np.intp)
+        self.n_sectors = len(sector_names)
+
+        drift = np.array([SECTOR_PARAMS[name][0] for name in sector_names])
+        volatility = np.array([SECTOR_PARAMS[name][1] for name in sector_names])
+        self.mu = drift[self.sector_idx]
+        self.sigma = volatility[self.sector_idx]
+
+        # Нагрузки на факторы: corr(i, j) = a² для разных секторов и a² + b² внутри сектора
+        self.market_loading = np.sqrt(market_correlation)
+        self.sector_loading = np.sqrt(sector_correlation - market_correlation)
+        self.idio_loading = np.sqrt(1.0 - sector_correlation)
+
+    def step(self, dt_seconds) -> np.ndarray:
+        """Сдвигает все цены на dt_seconds торгового времени и возвращает новые цены (float64)."""
+        dt = dt_seconds / SECONDS_PER_TRADING_YEAR
+        n = self.log_prices.shape[0]
+
+        shocks = self.idio_loading * self.rng.standard_normal(n)
+        shocks += self.market_loading * self.rng.standard_normal()
+        shocks += self.sector_loading * self.rng.standard_normal(self.n_sectors)[self.sector_idx]
+
+        self.log_prices += (self.mu - 0.5 * self.sigma ** 2) * dt + self.sigma * np.sqrt(dt) * shocks
+        return np.exp(self.log_prices)
+
+
+class SimulatedSource(MarketDataSource):
+    """
+    Синтетический источник цен для игры вне торговых часов MOEX и для нагрузочных прогонов.
+
+    Стартовые цены, лоты и секторы берутся из таблицы Stock при первом обращении.
+    Если набор акций изменился (initialize_top_stocks добавил бумаги, админка удалила),
+    список перечитывается: цены уже известных акций продолжают свой путь, новые
+    стартуют с цены из базы. tick_seconds — сколько торгового времени проходит за один вызов marketdata()
+    (None — реально прошедшее время), time_scale ускоряет рынок. С фиксированными
+    seed и tick_seconds последовательность цен воспроизводима.
+    """
+
+    def __init__(self, seed=None, tick_seconds=None, time_scale=1.0):
+        self.seed = seed
+        self.tick_seconds = tick_seconds
+        self.time_scale = float(time_scale)
+        self.simulator = None
+        self._stock_set = None
+        self._tickers = []
+        self._lot_sizes = []
+        self._last_tick_at = None
+
+    @staticmethod
+    def _current_stock_set():
+        """Дешёвый отпечаток набора акций: количество и последний id."""
+        stats = Stock.objects.aggregate(count=Count('id'), last_id=Max('id'))
+        return stats['count'], stats['last_id']
+
+    def _load(self, stock_set):
+        # Смоделированные цены и генератор переживают перечитывание списка
+        carried = {}
+        seed = self.seed
+        if self.simulator is not None:
+            carried = dict(zip(self._tickers, np.exp(self.simulator.log_prices).tolist()))
+            seed = self.simulator.rng
+
+        rows = list(Stock.objects.order_by('ticker').values_list('ticker', 'current_price', 'lot_size', 'sector'))
+        self._tickers = [row[0] for row in rows]
+        self._lot_sizes = [row[2] for row in rows]
+        prices = [
+            carried.get(row[0]) or (float(row[1]) if row[1] and row[1] > 0 else DEFAULT_START_PRICE)
+            for row in rows
+        ]
+        self.simulator = PriceSimulator(prices, [row[3] for row in rows], seed=seed)
+        self._stock_set = stock_set
+        logger.info(f"Price simulator loaded {len(rows)} stocks (seed={self.seed}).")
+
+    def _elapsed(self):
+        now = time.monotonic()
+        if self.tick_seconds is not None:
+            elapsed = self.tick_seconds
+        elif self._last_tick_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = now - self._last_tick_at
+        self._last_tick_at = now
+        return elapsed * self.time_scale
+
+    def marketdata(self) -> list:
+        stock_set = self._current_stock_set()
+        if self.simulator is None or stock_set != self._stock_set:
+            self._load(stock_set)
+        prices = np.round(self.simulator.step(self._elapsed()), 2)
+        return [
+            {'ticker': ticker, 'last': price, 'lotsize': lot_size}
+            for ticker, price, lot_size in zip(self._tickers, prices.tolist(), self._lot_sizes)
+        ]
+
+    def tickers(self) -> list:
+        return [
+            {'ticker': ticker, 'shortname': name, 'lotsize': lot_size}
+            for ticker, name, lot_size in Stock.objects.values_list('ticker', 'name', 'lot_size')
+        ]
@@ -0,0 +1,171 @@
+import gzip
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from moexalgo import Market
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MARKET_DATA_SOURCE = {
+    'BACKEND': 'apps.market.sources.MoexAlgoSource',
+    'OPTIONS': {},
+}
+
+
+def _as_rows(data) -> list:
+    """Приводит ответ moexalgo (list[dict] или DataFrame) к списку словарей."""
+    if data is None:
+        return []
+    if hasattr(data, 'to_dict'):
+        return data.to_dict('records')
+    return list(data)
+
+
+class MarketDataSource(ABC):
+    """
+    Источник рыночных данных для MoexDataService.
+
+    marketdata() — текущие котировки (ключи 'ticker', 'last', 'lotsize'),
+    tickers() — метаданные бумаг (ключи 'ticker', 'shortname', 'lotsize').
+    Источник без любого из методов не создаётся (TypeError при инстанцировании).
+    """
+
+    @abstractmethod
+    def marketdata(self) -> list:
+        """Текущие котировки."""
+
+    @abstractmethod
+    def tickers(self) -> list:
+        """Метаданные бумаг."""
+
+
+class MoexAlgoSource(MarketDataSource):
+    """Живые данные MOEX ISS через moexalgo (по умолчанию акции, режим TQBR)."""
+
+    def __init__(self, engine='shares', board='tqbr'):
+        self.engine = engine
+        self.board = board
+
+    def _market(self):
+        return Market(self.engine, self.board)
+
+    def marketdata(self) -> list:
+        return _as_rows(self._market().marketdata())
+
+    def tickers(self) -> list:
+        return _as_rows(self._market().tickers('*'))
+
+
+class SnapshotRecorder:
+    """
+    Записывает срезы источника в сжатый файл (gzip, по одному JSON на строку).
+
+    Каждая строка: {"kind": "marketdata" | "tickers", "recorded_at": <unix time>, "rows": [...]}.
+    Файл дописывается, поэтому запись можно продолжать между запусками.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, kind, rows, recorded_at=None) -> int:
+        snapshot = {
+            'kind': kind,
+            'recorded_at': recorded_at if recorded_at is not None else time.time(),
+            'rows': rows,
+        }
+        with gzip.open(self.path, 'at', encoding='utf-8') as fh:
+            # default=str: даты/время и Decimal из фида сохраняются строками
+            fh.write(json.dumps(snapshot, ensure_ascii=False, default=str))
+            fh.write('\n')
+        return len(rows)
+
+    def capture(self, source, kinds=('marketdata',)) -> dict:
+        """Снимает по одному срезу каждого вида из source и дописывает в файл."""
+        return {kind: self.record(kind, getattr(source, kind)()) for kind in kinds}
+
+
+def read_snapshots(path, kind=None):
+    """Последовательно читает срезы из файла записи (необязательно только одного вида)."""
+    with gzip.open(path, 'rt', encoding='utf-8') as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            snapshot = json.loads(line)
+            if kind is None or snapshot['kind'] == kind:
+                yield snapshot
+
+
+class ReplaySource(MarketDataSource):
+    """
+    Проигрывает записанные SnapshotRecorder срезы.
+
+    Каждый вызов marketdata() отдаёт следующий записанный срез. speed задаёт темп:
+    1 — в реальном времени, 100 — в 100 раз быстрее, 0 — без пауз (насколько быстро
+    успевает потребитель). После конца записи возвращает пустой список либо, при
+    loop=True, начинает сначала.
+    """
+
+    def __init__(self, path, speed=0, loop=False):
+        self.path = path
+        self.speed = float(speed or 0)
+        self.loop = loop
+        self.exhausted = False
+        self._snapshots = None
+        self._previous_recorded_at = None
+        self._previous_served_at = None
+        self._tickers = None
+
+    def _next_snapshot(self):
+        if self._snapshots is None:
+            self._snapshots = read_snapshots(self.path, 'marketdata')
+        try:
+            return next(self._snapshots)
+        except StopIteration:
+            if not self.loop:
+                self.exhausted = True
+                return None
+            self._snapshots = None
+            self._previous_recorded_at = None
+            return self._next_snapshot()
+
+    def _wait(self, recorded_at):
+        """Выдерживает паузу между срезами пропорционально записанной, делённой на speed."""
+        if self.speed > 0 and self._previous_recorded_at is not None:
+            delay = (recorded_at - self._previous_recorded_at) / self.speed
+            elapsed = time.monotonic() - self._previous_served_at
+            if delay > elapsed:
+                time.sleep(delay - elapsed)
+        self._previous_recorded_at = recorded_at
+        self._previous_served_at = time.monotonic()
+
+    def marketdata(self) -> list:
+        snapshot = self._next_snapshot()
+        if snapshot is None:
+            return []
+        self._wait(snapshot['recorded_at'])
+        return snapshot['rows']
+
+    def tickers(self) -> list:
+        """Последний записанный срез метаданных бумаг."""
+        if self._tickers is None:
+            self._tickers = []
+            for snapshot in read_snapshots(self.path, 'tickers'):
+                self._tickers = snapshot['rows']
+        return self._tickers
+
+
+@lru_cache(maxsize=None)
+def get_market_data_source() -> MarketDataSource:
+    """
+    Источник из настройки MARKET_DATA_SOURCE ({'BACKEND': ..., 'OPTIONS': {...}}).
+    Экземпляр один на процесс, чтобы источники с состоянием (replay) продолжали с места.
+    """
+    config = getattr(settings, 'MARKET_DATA_SOURCE', DEFAULT_MARKET_DATA_SOURCE)
+    source_class = import_string(config['BACKEND'])
+    logger.info(f"Market data source: {config['BACKEND']}")
+    return source_class(**config.get('OPTIONS', {}))
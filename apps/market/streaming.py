@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+
+from .cache import PriceCache
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер проверяет версию снимка цен в общем кэше (секунды)
+POLL_INTERVAL = 1.0
+# Сколько событий может ждать отправки медленному клиенту; дальше старые выбрасываются
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+class Subscriber:
+    """Один открытый поток: набор тикеров (None — все) и ограниченная очередь событий."""
+
+    def __init__(self, tickers=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.tickers = set(tickers) if tickers else None
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, version, prices):
+        """Кладёт в очередь изменения по своим тикерам; при переполнении выбрасывает самое старое событие."""
+        if self.tickers is not None:
+            prices = {ticker: quote for ticker, quote in prices.items() if ticker in self.tickers}
+        if not prices:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait({'version': version, 'prices': prices})
+
+
+class PriceBroadcaster:
+    """
+    Рассылка изменений цен всем открытым потокам одного воркера.
+
+    Один фоновый цикл на процесс раз в POLL_INTERVAL сверяет версию снимка PriceCache;
+    при новой версии читает снимок один раз, находит тикеры с изменившейся ценой или
+    лотом и раздаёт их подписчикам. Цикл работает, только пока есть подписчики.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.version = None
+        self.prices = {}
+        self._task = None
+
+    @staticmethod
+    def _quote(stock):
+        return {'price': str(stock['price']), 'lot_size': stock['lot_size']}
+
+    def _diff(self, snapshot) -> dict:
+        changed = {}
+        prices = {}
+        for ticker, stock in snapshot['stocks'].items():
+            quote = self._quote(stock)
+            prices[ticker] = quote
+            if self.prices.get(ticker) != quote:
+                changed[ticker] = quote
+        self.prices = prices
+        self.version = snapshot['version']
+        return changed
+
+    async def _refresh(self):
+        """Сверяет версию снимка; если она новая — раздаёт изменения подписчикам."""
+        version = await sync_to_async(PriceCache.version)()
+        if version != self.version:
+            snapshot = await sync_to_async(PriceCache.get_snapshot)()
+            changed = self._diff(snapshot)
+            for subscriber in list(self.subscribers):
+                subscriber.offer(self.version, changed)
+
+    async def _run(self):
+        try:
+            while self.subscribers:
+                try:
+                    await self._refresh()
+                except Exception as e:
+                    logger.error(f"Price broadcaster poll failed: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            self._task = None
+
+    async def subscribe(self, tickers=None) -> Subscriber:
+        """Регистрирует подписчика; первым событием он получает текущие цены своих тикеров."""
+        # Без подписчиков цикл опроса стоит, и цены в памяти могли устареть
+        await self._refresh()
+        subscriber = Subscriber(tickers)
+        subscriber.offer(self.version, self.prices)
+        self.subscribers.add(subscriber)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+
+broadcaster = PriceBroadcaster()
+
+
+def format_event(event, dropped=0) -> str:
+    """Событие в формате Server-Sent Events."""
+    payload = dict(event, dropped=dropped)
+    return f"id: {event['version']}\nevent: prices\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
@@ -1,5 +1,5 @@
 from config import celery_app
-from .services import MoexDataService
+from .services import MoexDataService, PriceHistoryService
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,7 +23,26 @@ def initialize_all_stocks_task():
     """
     logger.info("Celery Beat: Начинаю инициализацию всех акций TQBR.")
     try:
-        MoexDataService.initialize_top_stocks()
-        logger.info("Celery Beat: Инициализация акций завершена.")
+        report = MoexDataService.initialize_top_stocks()
+        logger.info(
+            f"Celery Beat: Инициализация акций завершена. Добавлено {report['inserted']}, "
+            f"обновлено {report['updated']}, без изменений {report['unchanged']}."
+        )
     except Exception as e:
-        logger.error(f"Celery Beat: Ошибка при инициализации акций: {e}")
\ No newline at end of file
+        logger.error(f"Celery Beat: Ошибка при инициализации акций: {e}")
+
+@celery_app.task
+def rollup_price_history_task(interval):
+    """Celery-задача свёртки истории цен в свечи интервала interval ('1m', '1h', '1d')."""
+    try:
+        PriceHistoryService.rollup(interval)
+    except Exception as e:
+        logger.error(f"Price history rollup {interval} failed: {e}")
+
+@celery_app.task
+def prune_price_history_task():
+    """Celery-задача удаления тиков и свечей старше срока хранения."""
+    try:
+        PriceHistoryService.prune()
+    except Exception as e:
+        logger.error(f"Price history prune failed: {e}")
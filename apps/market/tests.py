@@ -1,3 +1,542 @@
-from django.test import TestCase
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, RequestFactory
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+
+from apps.portfolio.services import PortfolioService
+from apps.users.authentication import CachedTokenAuthentication
+from .cache import PRICE_CACHE_MAX_AGE, VERSION_KEY, PriceCache
+from .models import Stock, PriceTick, Candle
+from .search import StockSearchIndex, get_search_index
+from .services import MoexDataService, PriceHistoryService
+from .signals import prices_written
+from .simulator import SimulatedSource
+from .sources import MarketDataSource, ReplaySource, SnapshotRecorder
+from .views import STREAM_RETRY_MS, MarketListView
+
+# Размер синтетического рынка: на паре десятков строк SQLite сканирует таблицу
+# при любых индексах, поэтому планы проверяем на "боевом" объёме
+SYNTHETIC_STOCKS = 5000
+
+SECTORS = [code for code, _ in Stock.SECTOR_CHOICES]
+LISTING_LEVELS = [code for code, _ in Stock.LISTING_LEVEL_CHOICES]
+STOCK_TYPES = [code for code, _ in Stock.STOCK_TYPE_CHOICES]
+
+# Все комбинации фильтров, которые отправляет market_list.js
+FILTER_VALUES = {
+    'sector': [None, 'FINS'],
+    'listing_level': [None, '1'],
+    'stock_type': [None, 'PREFERRED'],
+    'blue_chip': [None, 'true'],
+}
+
+
+class MarketListQueryPlanTests(TestCase):
+    """
+    Регрессия планов запросов MarketListView: для каждой комбинации фильтров
+    запрос должен идти по индексу и не сортировать результат во временном B-дереве.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(42)
+        Stock.objects.bulk_create([
+            Stock(
+                ticker=f"T{i:05d}",
+                name=f"Synthetic {i}",
+                # Часть бумаг без цены — их список должен отсекать
+                current_price=Decimal(rng.choice(['0', '12.50', '245.10', '3150.00'])),
+                lot_size=rng.choice([1, 10, 100]),
+                sector=rng.choice(SECTORS),
+                listing_level=rng.choice(LISTING_LEVELS),
+                stock_type=rng.choice(STOCK_TYPES),
+                is_blue_chip=rng.random() < 0.05,
+            )
+            for i in range(SYNTHETIC_STOCKS)
+        ], batch_size=500)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _queryset(self, params):
+        request = Request(RequestFactory().get('/api/market/list/', params))
+        view = MarketListView()
+        view.setup(request)
+        view.request = request
+        return view.get_queryset()
+
+    def _plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_filter_combinations_use_partial_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Планы сверяются с форматом EXPLAIN QUERY PLAN SQLite')
+
+        keys = list(FILTER_VALUES)
+        for values in itertools.product(*FILTER_VALUES.values()):
+            params = {key: value for key, value in zip(keys, values) if value is not None}
+            with self.subTest(params=params):
+                plan = self._plan(self._queryset(params))
+                details = ' | '.join(plan)
+                self.assertTrue(
+                    any('USING INDEX market_stock_' in step for step in plan),
+                    f"Запрос не использует индексы Stock: {details}",
+                )
+                self.assertFalse(
+                    any('TEMP B-TREE' in step for step in plan),
+                    f"Сортировка во временном B-дереве: {details}",
+                )
+
+    def test_priceless_stocks_are_excluded(self):
+        tickers = set(self._queryset({}).values_list('ticker', flat=True))
+        priced = set(Stock.objects.filter(current_price__gt=0).values_list('ticker', flat=True))
+        self.assertEqual(tickers, priced)
+        self.assertLess(len(tickers), SYNTHETIC_STOCKS)
+
+
+class ApplyMarketDataTests(TestCase):
+    """Применение среза цен: счётчики прогона, запись и публикация только при изменениях."""
+
+    def setUp(self):
+        cache.clear()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'), lot_size=10)
+        PriceCache.publish()
+
+        self.written = []
+        receiver = lambda sender, changes, **kwargs: self.written.append(changes)
+        prices_written.connect(receiver, weak=False, dispatch_uid='market.tests.written')
+        self.addCleanup(prices_written.disconnect, dispatch_uid='market.tests.written')
+
+    def apply(self, rows):
+        with mock.patch.object(PriceCache, 'publish', wraps=PriceCache.publish) as publish:
+            result = MoexDataService.apply_market_data(rows)
+        return result, publish.call_count
+
+    def test_counts_and_writes_only_changed_rows(self):
+        result, published = self.apply([
+            # Округляется до той же цены в копейках — не изменение
+            {'ticker': 'sber', 'last': 100.004, 'lotsize': 10},
+            {'ticker': 'GAZP', 'last': 151.5, 'lotsize': 10},
+            {'ticker': 'NOPE', 'last': 1, 'lotsize': 1},
+            {'last': 5},
+        ])
+
+        self.assertEqual((result['scanned'], result['changed'], result['skipped'], result['ticks']), (4, 1, 2, 1))
+        self.assertEqual([change['ticker'] for change in result['changes']], ['GAZP'])
+        self.assertEqual(Stock.objects.get(ticker='GAZP').current_price, Decimal('151.50'))
+        self.assertEqual(published, 1)
+        self.assertEqual([[change['ticker'] for change in changes] for changes in self.written], [['GAZP']])
+        self.assertEqual(PriceCache.get_quote('GAZP')['price'], Decimal('151.50'))
+
+    def test_lot_change_without_price_change(self):
+        result, published = self.apply([{'ticker': 'SBER', 'last': 100, 'lotsize': 1}])
+        self.assertEqual((result['changed'], result['ticks']), (1, 0))
+        self.assertEqual(Stock.objects.get(ticker='SBER').lot_size, 1)
+        self.assertEqual(published, 1)
+
+    def test_unchanged_feed_does_not_write_or_publish(self):
+        updated_at = Stock.objects.get(ticker='SBER').updated_at
+        version = PriceCache.version()
+        result, published = self.apply([
+            {'ticker': 'SBER', 'last': 100, 'lotsize': 10},
+            # Неверные цена и лот из фида игнорируются
+            {'ticker': 'GAZP', 'last': 'NaN', 'lotsize': 0},
+        ])
+
+        self.assertEqual((result['scanned'], result['changed'], result['skipped']), (2, 0, 0))
+        self.assertEqual(published, 0)
+        self.assertEqual(self.written, [])
+        self.assertEqual(PriceCache.version(), version)
+        self.assertEqual(Stock.objects.get(ticker='SBER').updated_at, updated_at)
+
+
+class StaticSource(MarketDataSource):
+    """Источник с заранее заданными срезами."""
+
+    def __init__(self, tickers=(), marketdata=()):
+        self._tickers = list(tickers)
+        self._marketdata = list(marketdata)
+
+    def tickers(self) -> list:
+        return self._tickers
+
+    def marketdata(self) -> list:
+        return self._marketdata
+
+
+class InitializeStocksTests(TestCase):
+    """Пакетный upsert списка акций: новые, изменённые, без изменений, невалидные."""
+
+    def setUp(self):
+        cache.clear()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'), lot_size=10)
+        self.source = StaticSource(
+            tickers=[
+                {'ticker': 'SBER', 'shortname': 'Сбербанк', 'lotsize': 10},
+                {'ticker': 'gazp', 'shortname': 'ГАЗПРОМ ао', 'lotsize': 10},
+                {'ticker': 'LKOH', 'shortname': 'ЛУКОЙЛ', 'lotsize': 1},
+                # Дубль в фиде схлопывается
+                {'ticker': 'LKOH', 'shortname': 'ЛУКОЙЛ', 'lotsize': 1},
+                {'ticker': 'BAD', 'shortname': 'Без лота', 'lotsize': 0},
+                {'ticker': 'X' * 20, 'shortname': 'Длинный тикер', 'lotsize': 1},
+                {'shortname': 'Без тикера', 'lotsize': 1},
+            ],
+            marketdata=[{'ticker': 'LKOH', 'last': 7000, 'lotsize': 1}],
+        )
+
+    def test_upsert_report_and_rows(self):
+        report = MoexDataService.initialize_top_stocks(source=self.source)
+
+        self.assertEqual(
+            {key: report[key] for key in ('fetched', 'invalid', 'inserted', 'updated', 'unchanged')},
+            {'fetched': 7, 'invalid': 3, 'inserted': 1, 'updated': 1, 'unchanged': 1},
+        )
+        self.assertEqual(Stock.objects.get(ticker='GAZP').name, 'ГАЗПРОМ ао')
+        self.assertEqual(Stock.objects.get(ticker='LKOH').current_price, Decimal('7000.00'))
+        self.assertEqual(report['prices']['changed'], 1)
+
+        # Повторный прогон ничего не меняет
+        report = MoexDataService.initialize_top_stocks(source=self.source)
+        self.assertEqual((report['inserted'], report['updated'], report['unchanged']), (0, 0, 3))
+
+    def test_dry_run_writes_nothing(self):
+        with self.assertNumQueries(1):
+            report = MoexDataService.initialize_top_stocks(dry_run=True, source=self.source)
+        self.assertEqual((report['inserted'], report['updated']), (1, 1))
+        self.assertIsNone(report['prices'])
+        self.assertFalse(Stock.objects.filter(ticker='LKOH').exists())
+        self.assertEqual(Stock.objects.get(ticker='GAZP').name, 'Газпром')
+
+
+class PriceHistoryTests(TestCase):
+    """Свёртка тиков в свечи и выбор свечей для графика."""
+
+    def setUp(self):
+        self.stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'))
+        self.start = timezone.make_aware(datetime(2025, 3, 3, 10, 0))
+        for offset, price in ((5, '100'), (40, '105'), (50, '98'), (70, '101')):
+            PriceTick.objects.create(stock=self.stock, price=Decimal(price), timestamp=self.start + timedelta(seconds=offset))
+        self.now = self.start + timedelta(minutes=2)
+
+    def candles(self, interval):
+        return list(
+            Candle.objects.filter(interval=interval).order_by('bucket_start')
+            .values_list('bucket_start', 'open', 'high', 'low', 'close', 'ticks')
+        )
+
+    def test_rollup_is_idempotent(self):
+        self.assertEqual(PriceHistoryService.rollup(Candle.INTERVAL_1M, now=self.now), 2)
+        minutes = self.candles(Candle.INTERVAL_1M)
+        self.assertEqual(minutes, [
+            (self.start, Decimal('100'), Decimal('105'), Decimal('98'), Decimal('98'), 3),
+            (self.start + timedelta(minutes=1), Decimal('101'), Decimal('101'), Decimal('101'), Decimal('101'), 1),
+        ])
+
+        self.assertEqual(PriceHistoryService.rollup(Candle.INTERVAL_1M, now=self.now), 2)
+        self.assertEqual(self.candles(Candle.INTERVAL_1M), minutes)
+
+        # Следующие уровни собираются из предыдущего
+        PriceHistoryService.rollup(Candle.INTERVAL_1H, now=self.now)
+        PriceHistoryService.rollup(Candle.INTERVAL_1H, now=self.now)
+        self.assertEqual(self.candles(Candle.INTERVAL_1H), [
+            (self.start, Decimal('100'), Decimal('105'), Decimal('98'), Decimal('101'), 4),
+        ])
+        PriceHistoryService.rollup(Candle.INTERVAL_1D, now=self.now)
+        # День — по местному времени (TIME_ZONE)
+        day = self.candles(Candle.INTERVAL_1D)
+        self.assertEqual(len(day), 1)
+        self.assertEqual(timezone.localtime(day[0][0]).replace(tzinfo=None), datetime(2025, 3, 3))
+
+    def test_get_candles_picks_level_and_range(self):
+        for interval in (Candle.INTERVAL_1M, Candle.INTERVAL_1H, Candle.INTERVAL_1D):
+            PriceHistoryService.rollup(interval, now=self.now)
+
+        interval, candles = PriceHistoryService.get_candles(self.stock, date_from=self.start, date_to=self.now)
+        self.assertEqual((interval, len(candles)), (Candle.INTERVAL_1M, 2))
+        # Конец диапазона не включается
+        _, candles = PriceHistoryService.get_candles(self.stock, date_from=self.start, date_to=self.start + timedelta(minutes=1))
+        self.assertEqual([candle.bucket_start for candle in candles], [self.start])
+
+        interval, candles = PriceHistoryService.get_candles(self.stock, date_from=self.now - timedelta(days=30), date_to=self.now)
+        self.assertEqual((interval, [candle.close for candle in candles]), (Candle.INTERVAL_1H, [Decimal('101')]))
+        interval, _ = PriceHistoryService.get_candles(self.stock, date_from=self.now - timedelta(days=200), date_to=self.now)
+        self.assertEqual(interval, Candle.INTERVAL_1D)
+
+
+class MarketDataSourceTests(TestCase):
+    """Источники данных: запись и воспроизведение срезов."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        os.remove(self.path)
+        self.addCleanup(lambda: os.path.exists(self.path) and os.remove(self.path))
+
+    def test_incomplete_source_is_rejected_at_creation(self):
+        class TickersOnly(MarketDataSource):
+            def tickers(self) -> list:
+                return []
+
+        with self.assertRaises(TypeError):
+            TickersOnly()
+
+    def test_replay_reproduces_recording(self):
+        recorder = SnapshotRecorder(self.path)
+        slices = [
+            [{'ticker': 'SBER', 'last': 100.5, 'lotsize': 10}],
+            [{'ticker': 'SBER', 'last': 101.0, 'lotsize': 10}, {'ticker': 'GAZP', 'last': 150.0, 'lotsize': 10}],
+        ]
+        for recorded_at, rows in enumerate(slices):
+            recorder.record('marketdata', rows, recorded_at=recorded_at)
+        recorder.record('tickers', [{'ticker': 'SBER', 'shortname': 'Сбербанк', 'lotsize': 10}])
+
+        for _ in range(2):
+            source = ReplaySource(self.path)
+            self.assertEqual([source.marketdata(), source.marketdata()], slices)
+            self.assertEqual(source.marketdata(), [])
+            self.assertTrue(source.exhausted)
+            self.assertEqual(source.tickers()[0]['shortname'], 'Сбербанк')
+
+        looped = ReplaySource(self.path, loop=True)
+        self.assertEqual([looped.marketdata() for _ in range(3)], slices + slices[:1])
+
+
+class SimulatedSourceTests(TestCase):
+    """Синтетический источник: воспроизводимость по seed и новые акции без перезапуска."""
+
+    def setUp(self):
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10, sector='FINS')
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'), lot_size=10, sector='OGAS')
+
+    @staticmethod
+    def path(source, ticks=5):
+        return [source.marketdata() for _ in range(ticks)]
+
+    def test_same_seed_same_prices(self):
+        first = self.path(SimulatedSource(seed=7, tick_seconds=60))
+        self.assertEqual(first, self.path(SimulatedSource(seed=7, tick_seconds=60)))
+        self.assertNotEqual(first, self.path(SimulatedSource(seed=8, tick_seconds=60)))
+        self.assertEqual([row['ticker'] for row in first[0]], ['GAZP', 'SBER'])
+        self.assertEqual({row['lotsize'] for row in first[0]}, {10})
+
+    def test_new_stocks_join_running_simulation(self):
+        # Год торгового времени за тик: цены заметно уходят от стартовых
+        source = SimulatedSource(seed=7, tick_seconds=252 * 8.5 * 3600)
+        before = {row['ticker']: row['last'] for row in source.marketdata()}
+        self.assertNotEqual(before['SBER'], 100.0)
+        Stock.objects.create(ticker='LKOH', name='ЛУКОЙЛ', current_price=Decimal('7000.00'), lot_size=1)
+
+        # Нулевой шаг показывает цены сразу после перечитывания списка
+        source.tick_seconds = 0
+        after = {row['ticker']: row['last'] for row in source.marketdata()}
+        self.assertEqual(after, {**before, 'LKOH': 7000.0})
+
+
+class PriceCacheTests(TestCase):
+    """Снимок цен: чтение без базы, пока он свежий, и возврат к базе, когда устарел."""
+
+    def setUp(self):
+        cache.clear()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        PriceCache.publish()
+        # Цена в базе меняется в обход прогона обновления (снимок о ней не знает)
+        Stock.objects.filter(ticker='SBER').update(current_price=Decimal('120.00'))
+
+    def age_snapshot(self, seconds):
+        marker = cache.get(VERSION_KEY)
+        marker['checked_at'] = time.time() - seconds
+        cache.set(VERSION_KEY, marker, timeout=None)
+
+    def test_fresh_snapshot_is_served_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(PriceCache.get_fresh_quote('sber')['price'], Decimal('100.00'))
+            self.assertEqual(PortfolioService.get_quote('SBER')['price'], Decimal('100.00'))
+            self.assertIsNone(PriceCache.get_fresh_quote('NOPE'))
+
+    def test_stale_snapshot_falls_back_to_database(self):
+        self.age_snapshot(PRICE_CACHE_MAX_AGE + 1)
+        self.assertFalse(PriceCache.is_fresh())
+        self.assertIsNone(PriceCache.get_fresh_quote('SBER'))
+        # Сам снимок по-прежнему доступен, но сделки берут цену из базы
+        self.assertEqual(PriceCache.get_quote('SBER')['price'], Decimal('100.00'))
+        self.assertEqual(PortfolioService.get_quote('SBER')['price'], Decimal('120.00'))
+        self.assertEqual(PortfolioService.get_quotes(['SBER'])['SBER']['price'], Decimal('120.00'))
+
+        # Прогон без изменений (touch) снова делает снимок свежим
+        PriceCache.touch()
+        self.assertEqual(PriceCache.get_fresh_quote('SBER')['price'], Decimal('100.00'))
+
+    def test_empty_shared_cache_is_rebuilt_from_database(self):
+        cache.clear()
+        self.assertEqual(PriceCache.get_fresh_quote('SBER')['price'], Decimal('120.00'))
+
+
+class PriceStreamTests(TestCase):
+    """Поток цен: только под ASGI, вход по заголовку или одноразовому билету."""
+
+    def setUp(self):
+        cache.clear()
+        CachedTokenAuthentication.local.clear()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'), lot_size=10)
+        PriceCache.publish()
+        self.token = Token.objects.create(user=get_user_model().objects.create(username='streamer'))
+        self.auth = {'Authorization': f'Token {self.token.key}'}
+
+    def test_wsgi_gets_not_implemented(self):
+        self.assertEqual(self.client.get('/api/market/stream/', headers=self.auth).status_code, 501)
+        self.assertEqual(self.client.post('/api/market/stream/ticket/', headers=self.auth).status_code, 501)
+
+    async def test_bad_credentials_are_rejected(self):
+        self.assertEqual((await self.async_client.get('/api/market/stream/')).status_code, 401)
+        self.assertEqual((await self.async_client.get('/api/market/stream/?ticket=bogus')).status_code, 401)
+        # Постоянный токен в адресе больше не принимается
+        response = await self.async_client.get(f'/api/market/stream/?token={self.token.key}')
+        self.assertEqual(response.status_code, 401)
+        # Выход (удаление токена) сразу закрывает доступ и по заголовку
+        await self.token.adelete()
+        self.assertEqual((await self.async_client.get('/api/market/stream/', headers=self.auth)).status_code, 401)
+
+    async def test_ticket_opens_stream_once(self):
+        response = await self.async_client.post('/api/market/stream/ticket/', headers=self.auth)
+        self.assertEqual(response.status_code, 201)
+        ticket = response.json()['ticket']
+        self.assertNotIn(self.token.key, ticket)
+
+        response = await self.async_client.get(f'/api/market/stream/?tickers=sber&ticket={ticket}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        try:
+            self.assertEqual(await anext(chunks), f'retry: {STREAM_RETRY_MS}\n\n'.encode())
+            event = (await anext(chunks)).decode()
+        finally:
+            await response._iterator.aclose()
+
+        # Первое событие — текущие цены подписанных тикеров
+        self.assertTrue(event.startswith(f'id: {PriceCache.version()}\nevent: prices\n'))
+        payload = json.loads(event.split('data: ', 1)[1])
+        self.assertEqual(payload['prices'], {'SBER': {'price': '100.00', 'lot_size': 10}})
+        self.assertEqual(payload['dropped'], 0)
+
+        # Билет одноразовый
+        response = await self.async_client.get(f'/api/market/stream/?ticket={ticket}')
+        self.assertEqual(response.status_code, 401)
+
+
+class StockSearchTests(TestCase):
+    """Поиск акций по индексу в памяти: ранжирование, раскладка, перестройка индекса."""
+
+    STOCKS = [
+        {'ticker': 'SBER', 'name': 'Сбербанк'},
+        {'ticker': 'SBERP', 'name': 'Сбербанк-п'},
+        {'ticker': 'GAZP', 'name': 'Газпром'},
+        {'ticker': 'MTSS', 'name': 'МТС'},
+        {'ticker': 'AFLT', 'name': 'Аэрофлот'},
+        {'ticker': 'ABIO', 'name': 'Артген Ёлка'},
+    ]
+
+    def setUp(self):
+        self.index = StockSearchIndex(self.STOCKS)
+
+    def tickers(self, query, limit=10):
+        return [stock['ticker'] for stock in self.index.search(query, limit=limit)]
+
+    def test_ranking(self):
+        # Точный тикер, затем начало тикера
+        self.assertEqual(self.tickers('sber'), ['SBER', 'SBERP'])
+        self.assertEqual(self.tickers('SBERP'), ['SBERP'])
+        # Начало слова в названии раньше подстроки
+        self.assertEqual(self.tickers('газ'), ['GAZP'])
+        self.assertEqual(self.tickers('флот'), ['AFLT'])
+        self.assertEqual(self.tickers('s', limit=1), ['SBER'])
+        self.assertEqual(self.tickers('  '), [])
+
+    def test_keyboard_layout_and_yo(self):
+        # SBER, набранный в русской раскладке
+        self.assertEqual(self.tickers('ЫИУК'), ['SBER', 'SBERP'])
+        # "Сбербанк" в английской раскладке
+        self.assertEqual(self.tickers('c,th'), ['SBER', 'SBERP'])
+        # Клавиша ` даёт "ё": после перевода раскладки ё тоже сводится к е
+        self.assertEqual(self.tickers('c,`h'), ['SBER', 'SBERP'])
+        self.assertEqual(self.tickers('елка'), ['ABIO'])
+        self.assertEqual(self.tickers('`krf'), ['ABIO'])
+
+    def test_index_follows_metadata_not_prices(self):
+        cache.clear()
+        stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'))
+        index = get_search_index()
+        PriceCache.publish()
+        MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': 101, 'lotsize': 1}])
+        self.assertIs(get_search_index(), index)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.name = 'Сбер'
+            stock.save()
+        self.assertEqual(get_search_index().search('сбер'), [{'ticker': 'SBER', 'name': 'Сбер'}])
+
+
+class MarketListConditionalGetTests(TestCase):
+    """ETag списка рынка: 304 до нового прогона цен или правки акции."""
+
+    URL = '/api/market/list/'
+
+    def setUp(self):
+        cache.clear()
+        CachedTokenAuthentication.local.clear()
+        self.stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        PriceCache.publish()
+        token = Token.objects.create(user=get_user_model().objects.create(username='lister'))
+        self.auth = {'Authorization': f'Token {token.key}'}
+
+    def get(self, etag=None, params=None):
+        headers = dict(self.auth)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client.get(self.URL, params or {}, headers=headers)
+
+    def test_not_modified_until_prices_change(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        self.assertEqual(self.get(etag).status_code, 304)
+        self.assertEqual(self.get(f'"other", {etag}').status_code, 304)
+        self.assertEqual(self.get('*').status_code, 304)
+        # Другие параметры — другой ETag
+        self.assertEqual(self.get(etag, {'sector': 'FINS'}).status_code, 200)
+
+        MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': 101, 'lotsize': 10}])
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()[0]['current_price'], '101.00')
+
+    def test_metadata_edit_changes_etag(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stock.name = 'Сбербанк России'
+            self.stock.sector = 'FINS'
+            self.stock.save(update_fields=['name', 'sector'])
+
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['name'], 'Сбербанк России')
@@ -1,8 +1,14 @@
 from django.urls import path
-from .views import StockSearchView, MarketListView
+from .views import StockSearchView, MarketListView, CandleListView, StreamTicketView, price_stream
 
 urlpatterns = [
     # Маршрут: /api/market/search/
     path('search/', StockSearchView.as_view(), name='stock_search'),
     path('list/', MarketListView.as_view(), name='market_list_api'),
+    # Маршрут: /api/market/stream/?tickers=SBER,GAZP (Server-Sent Events)
+    path('stream/', price_stream, name='price_stream'),
+    # Маршрут: /api/market/stream/ticket/ (POST, одноразовый билет для EventSource)
+    path('stream/ticket/', StreamTicketView.as_view(), name='price_stream_ticket'),
+    # Маршрут: /api/market/SBER/candles/?interval=1h&from=...&to=...
+    path('<str:ticker>/candles/', CandleListView.as_view(), name='stock_candles'),
 ]
@@ -1,48 +1,153 @@
-from decimal import Decimal
-from rest_framework import generics, permissions
-from django.db.models import Q
-from .models import Stock
-from .serializers import StockSearchSerializer, MarketStockSerializer
+import asyncio
+import hashlib
+import json
+import secrets
+from datetime import datetime, time
+from asgiref.sync import sync_to_async
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date, parse_http_date_safe
+from .models import Stock, Candle
+from .serializers import StockSearchSerializer, MarketStockSerializer, CandleSerializer
+from .cache import PriceCache, StockMetadata
+from .search import get_search_index
+from .services import PriceHistoryService
+from .streaming import broadcaster, format_event
+from apps.users.authentication import CachedTokenAuthentication
+
+# Кэш ответов /api/market/list/: ключ включает версии цен и метаданных, старые версии просто истекают
+MARKET_LIST_CACHE_PREFIX = 'market:list'
+MARKET_LIST_CACHE_TIMEOUT = 15 * 60
+
+# Сколько подсказок возвращает поиск акций
+SEARCH_RESULTS_LIMIT = 10
+
+# Поток цен: через сколько секунд тишины слать keepalive и через сколько мс клиенту переподключаться
+STREAM_KEEPALIVE = 15
+STREAM_RETRY_MS = 3000
+
+# Одноразовый билет на поток цен. EventSource не умеет слать заголовки, а постоянный
+# токен в адресе оседал бы в логах доступа веб-сервера и прокси; билет в адресе
+# живёт STREAM_TICKET_TTL секунд и годится на одно подключение
+STREAM_TICKET_PREFIX = 'market:stream:ticket:'
+STREAM_TICKET_TTL = 60
+
+STREAM_REQUIRES_ASGI = 'Поток цен доступен только при запуске через ASGI.'
 
 class StockSearchView(generics.ListAPIView):
     """
     Поиск акций по тикеру или названию.
     Доступно: /api/market/search/?q=SBER
-    Переделать полноценный поиск на postgres.
+    Ищет по индексу в памяти (apps.market.search) без запросов к базе: регистр, ё/е
+    и раскладка клавиатуры не важны ("ЫИУК" найдёт SBER).
     """
     serializer_class = StockSearchSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        queryset = Stock.objects.all()
+        return Stock.objects.all()
+
+    def list(self, request, *args, **kwargs):
         query = self.request.query_params.get('q', None)
-        if query:
-            title_query = query.title()
-            queryset = queryset.filter(Q(ticker__icontains=query) | Q(name__contains=query) | Q(name__contains=title_query))[:10]
-        return queryset
+        if not query:
+            return super().list(request, *args, **kwargs)
+        return Response(get_search_index().search(query, limit=SEARCH_RESULTS_LIMIT))
+
+class OptionalCursorPagination(CursorPagination):
+    """Курсорная пагинация по тикеру, только если клиент передал ?limit=."""
+    ordering = 'ticker'
+    page_size_query_param = 'limit'
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
 
 class MarketListView(generics.ListAPIView):
     """
     Возвращает полный список доступных акций с ценами и поддерживает фильтрацию
     по сектору, уровню листинга, типу акции и статусу "Голубая фишка".
+
+    Ответ для каждого набора параметров кэшируется до следующей версии снимка цен
+    (см. PriceCache) или метаданных акций (StockMetadata) и отдаётся с ETag и
+    Last-Modified: пока не изменилось ни то, ни другое, повторный запрос
+    с If-None-Match получает 304 Not Modified.
+    Дополнительно: ?fields=ticker,current_price — только нужные поля,
+    ?limit=50[&cursor=...] — постраничная выдача по тикеру.
     """
     serializer_class = MarketStockSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = OptionalCursorPagination
 
     queryset = Stock.objects.all().order_by('ticker')
 
+    def get_serializer(self, *args, **kwargs):
+        fields = self.request.query_params.get('fields')
+        if fields:
+            kwargs['fields'] = [field.strip() for field in fields.split(',') if field.strip()]
+        return super().get_serializer(*args, **kwargs)
+
+    def _params_digest(self) -> str:
+        """Хэш всех параметров запроса (фильтры, fields, limit, cursor)."""
+        params = sorted(self.request.query_params.lists())
+        return hashlib.sha1(json.dumps(params, ensure_ascii=False).encode()).hexdigest()[:16]
+
+    def _not_modified(self, etag, last_modified) -> bool:
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
+        if_modified_since = parse_http_date_safe(self.request.headers.get('If-Modified-Since') or '')
+        return if_modified_since is not None and last_modified <= if_modified_since
+
+    def list(self, request, *args, **kwargs):
+        version = PriceCache.version()
+        metadata_version = StockMetadata.version()
+        digest = self._params_digest()
+        # Сильный ETag: версии цен и метаданных акций (правка в админке меняет
+        # название/сектор без нового прогона цен) + параметры запроса
+        etag = f'"{version}-{metadata_version}-{digest}"'
+        # Обе версии — время изменения в микросекундах
+        last_modified = max(version, metadata_version) // 1_000_000
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': 'private, no-cache',
+        }
+
+        if self._not_modified(etag, last_modified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        cache_key = f"{MARKET_LIST_CACHE_PREFIX}:{version}:{metadata_version}:{digest}"
+        data = cache.get(cache_key)
+        if data is None:
+            response = super().list(request, *args, **kwargs)
+            # В кэш кладём простые list/dict, без ссылок на сериализатор
+            data = json.loads(JSONRenderer().render(response.data))
+            cache.set(cache_key, data, MARKET_LIST_CACHE_TIMEOUT)
+
+        return Response(data, headers=headers)
+
     def get_queryset(self):
         queryset = self.queryset
         params = self.request.query_params
 
         query = params.get('q', None)
         if query:
-            title_query = query.title()
-            queryset = queryset.filter(
-                Q(ticker__icontains=query) |
-                Q(name__contains=query) |
-                Q(name__contains=title_query)
-            )
+            # Поиск по индексу в памяти, в базу уходит только ticker IN (...)
+            tickers = [stock['ticker'] for stock in get_search_index().search(query, limit=None)]
+            queryset = queryset.filter(ticker__in=tickers)
 
         # --- 1. Фильтрация по Сектору (sector) ---
         # Ожидаемый параметр: ?sector=FINS
@@ -70,7 +175,138 @@ class MarketListView(generics.ListAPIView):
             queryset = queryset.filter(is_blue_chip=True)
 
         # --- 5. Дополнительная фильтрация: Цена > 0 (для безопасности) ---
-        # Это гарантирует, что мы не показываем "мертвые" акции, если они не были отфильтрованы
-        queryset = queryset.exclude(Q(current_price__isnull=True) | Q(current_price__lte=Decimal('0')))
+        # Это гарантирует, что мы не показываем "мертвые" акции, если они не были отфильтрованы.
+        # Условие должно буквально совпадать с condition частичных индексов Stock.Meta
+        # (NULL отсекается сравнением сам), иначе планировщик их не возьмёт.
+        queryset = queryset.filter(current_price__gt=0)
+
+        return queryset
+
+class CandleListView(generics.ListAPIView):
+    """
+    Свечи OHLC по акции для графика.
+    Доступно: /api/market/SBER/candles/?interval=1h&from=2025-01-01&to=2025-02-01
+    Если interval не указан, уровень (1m/1h/1d) выбирается по длине диапазона.
+    """
+    serializer_class = CandleSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    @staticmethod
+    def _parse_moment(value, param):
+        if not value:
+            return None
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValidationError({param: 'Ожидается дата (YYYY-MM-DD) или дата и время в формате ISO 8601.'})
+            moment = datetime.combine(day, time.min)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment
+
+    def get_queryset(self):
+        params = self.request.query_params
+        stock = get_object_or_404(Stock, ticker=self.kwargs['ticker'].upper())
+
+        interval = params.get('interval') or None
+        if interval is not None and interval not in dict(Candle.INTERVAL_CHOICES):
+            raise ValidationError({'interval': f"Допустимые значения: {', '.join(dict(Candle.INTERVAL_CHOICES))}."})
+
+        date_from = self._parse_moment(params.get('from'), 'from')
+        date_to = self._parse_moment(params.get('to'), 'to')
+        if date_from and date_to and date_from >= date_to:
+            raise ValidationError({'from': 'Начало диапазона должно быть раньше конца.'})
+
+        self.interval, candles = PriceHistoryService.get_candles(stock, interval, date_from, date_to)
+        return candles
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        response.data = {
+            'ticker': self.kwargs['ticker'].upper(),
+            'interval': self.interval,
+            'candles': response.data,
+        }
+        return response
+
+
+class StreamTicketView(APIView):
+    """
+    Билет на поток цен: POST /api/market/stream/ticket/ с заголовком Authorization.
+    Ответ: {"ticket": ..., "expires_in": 60}; билет передаётся потоку как ?ticket=.
+    Под WSGI потока нет — 501, клиент остаётся на обычных запросах.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        if not isinstance(request._request, ASGIRequest):
+            return Response({'detail': STREAM_REQUIRES_ASGI}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        ticket = secrets.token_urlsafe(32)
+        # В билете — токен, а не пользователь: при подключении он проверяется заново
+        cache.set(STREAM_TICKET_PREFIX + ticket, request.auth, STREAM_TICKET_TTL)
+        return Response({'ticket': ticket, 'expires_in': STREAM_TICKET_TTL}, status=status.HTTP_201_CREATED)
+
+
+def _stream_user(request):
+    """
+    Пользователь потока: по заголовку Authorization (клиенты API) или по одноразовому
+    билету ?ticket= (браузер). Токен проверяется общим CachedTokenAuthentication — с его
+    кэшем, отрицательным кэшем и сбросом при выходе.
+    """
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Token '):
+        key = header[len('Token '):].strip()
+    else:
+        ticket_key = STREAM_TICKET_PREFIX + request.GET.get('ticket', '')
+        key = cache.get(ticket_key)
+        # Билет гасится при первом подключении; delete() ложно, если его уже погасили
+        if key is None or not cache.delete(ticket_key):
+            return None
+    if not key:
+        return None
+    try:
+        user, _ = CachedTokenAuthentication().authenticate_credentials(key)
+    except AuthenticationFailed:
+        return None
+    return user
+
+
+async def price_stream(request):
+    """
+    Поток изменений цен (Server-Sent Events).
+    Доступно: /api/market/stream/?tickers=SBER,GAZP&ticket=<билет из StreamTicketView>
+    Без tickers приходят изменения по всем акциям. Первое событие — текущие цены,
+    дальше — только тикеры, изменившиеся в очередном прогоне обновления цен.
+
+    Требует запуска через ASGI (uvicorn/daphne config.asgi:application). Под WSGI
+    бесконечный асинхронный поток собирался бы в список и навсегда занимал воркер,
+    поэтому там ответ — 501.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'detail': STREAM_REQUIRES_ASGI}, status=501)
+    if await sync_to_async(_stream_user)(request) is None:
+        return JsonResponse({'detail': 'Учетные данные не были предоставлены.'}, status=401)
+
+    tickers = [ticker.strip().upper() for ticker in request.GET.get('tickers', '').split(',') if ticker.strip()]
+    subscriber = await broadcaster.subscribe(tickers or None)
+
+    async def events():
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE не даёт прокси закрыть простаивающее соединение
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event(event, subscriber.dropped)
+                subscriber.dropped = 0
+        finally:
+            broadcaster.unsubscribe(subscriber)
 
-        return queryset
\ No newline at end of file
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
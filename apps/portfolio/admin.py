@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Portfolio, Asset, Transaction
+from .models import Portfolio, Asset, Transaction, Order, EquitySnapshot, TransactionArchive, ArchivedPosition
 
 class AssetInline(admin.TabularInline):
     model = Asset
@@ -7,10 +7,30 @@ class AssetInline(admin.TabularInline):
 
 @admin.register(Portfolio)
 class PortfolioAdmin(admin.ModelAdmin):
-    list_display = ('user', 'balance')
+    list_display = ('user', 'balance', 'reserved_balance', 'market_value', 'net_worth')
     inlines = [AssetInline] # Позволит видеть акции сразу внутри портфеля
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('portfolio', 'action', 'stock', 'quantity', 'price', 'timestamp')
-    list_filter = ('action', 'timestamp')
\ No newline at end of file
+    list_filter = ('action', 'timestamp')
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('portfolio', 'order_type', 'action', 'stock', 'quantity', 'trigger_price', 'status', 'created_at')
+    list_filter = ('status', 'order_type', 'action')
+
+@admin.register(EquitySnapshot)
+class EquitySnapshotAdmin(admin.ModelAdmin):
+    list_display = ('portfolio', 'date', 'balance', 'market_value', 'net_worth')
+    list_filter = ('date',)
+
+@admin.register(TransactionArchive)
+class TransactionArchiveAdmin(admin.ModelAdmin):
+    list_display = ('portfolio', 'month', 'transactions', 'first_id', 'last_id', 'updated_at')
+    list_filter = ('month',)
+    exclude = ('data',)  # Сжатые строки — читаются через историю транзакций
+
+@admin.register(ArchivedPosition)
+class ArchivedPositionAdmin(admin.ModelAdmin):
+    list_display = ('portfolio', 'stock', 'transactions', 'quantity', 'average_buy_price', 'buy_amount', 'sell_amount')
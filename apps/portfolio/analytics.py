@@ -0,0 +1,220 @@
+import logging
+from bisect import bisect_left
+from datetime import timedelta
+from functools import lru_cache
+
+import numpy as np
+from django.db.models import F, FloatField, Window
+from django.db.models.functions import Cast, DenseRank
+from django.utils import timezone
+
+from apps.market.cache import PriceCache
+from apps.market.models import Stock, Candle
+from apps.market.services import PriceHistoryService
+from .models import Asset
+
+logger = logging.getLogger(__name__)
+
+TRADING_DAYS_PER_YEAR = 252
+# Годовая безрисковая ставка для коэффициента Шарпа (ориентир — ключевая ставка ЦБ)
+RISK_FREE_RATE = 0.16
+ANALYTICS_DAYS = 365
+ANALYTICS_MIN_DAYS = 30
+ANALYTICS_MAX_DAYS = 5 * 365
+# Сколько результатов держать в LRU-кэше процесса
+ANALYTICS_CACHE_SIZE = 1024
+
+SECTOR_NAMES = dict(Stock.SECTOR_CHOICES)
+
+
+def _forward_fill(prices):
+    """
+    Заполняет пропуски (NaN) в столбцах цен последним известным значением, а пропуски
+    в начале столбца — первым известным: бумага без истории считается неизменной.
+    """
+    rows = np.arange(len(prices))[:, None]
+    known = ~np.isnan(prices)
+    last = np.maximum.accumulate(np.where(known, rows, 0), axis=0)
+    filled = prices[last, np.arange(prices.shape[1])]
+    first = np.where(known.any(axis=0), known.argmax(axis=0), 0)
+    return np.where(np.isnan(filled), prices[first, np.arange(prices.shape[1])], filled)
+
+
+def compute_metrics(values, market_returns=None, risk_free_rate: float = RISK_FREE_RATE) -> dict:
+    """
+    Метрики ряда стоимости портфеля values (по дням): доходность за период, годовая
+    волатильность, максимальная просадка, коэффициент Шарпа и бета к дневным
+    доходностям рынка market_returns (та же длина, что у доходностей портфеля).
+    Проценты — в процентах; если точек меньше трёх — None.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 3 or values[0] <= 0:
+        return {'total_return_percent': None, 'volatility_percent': None, 'max_drawdown_percent': None,
+                'sharpe': None, 'beta': None}
+
+    returns = values[1:] / values[:-1] - 1
+    volatility = returns.std(ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    drawdown = values / np.maximum.accumulate(values) - 1
+    annual_return = returns.mean() * TRADING_DAYS_PER_YEAR
+
+    beta = None
+    if market_returns is not None and len(market_returns) == len(returns):
+        market_variance = market_returns.var(ddof=1)
+        if market_variance > 0:
+            beta = float(np.cov(returns, market_returns, ddof=1)[0, 1] / market_variance)
+
+    return {
+        'total_return_percent': round(float(values[-1] / values[0] - 1) * 100, 2),
+        'volatility_percent': round(float(volatility) * 100, 2),
+        'max_drawdown_percent': round(float(drawdown.min()) * 100, 2),
+        'sharpe': round(float((annual_return - risk_free_rate) / volatility), 2) if volatility > 0 else None,
+        'beta': round(beta, 2) if beta is not None else None,
+    }
+
+
+class PortfolioAnalytics:
+    """
+    Риск и доходность портфеля по дневным свечам (Candle 1d).
+
+    Цены закрытия бумаг портфеля и голубых фишек выравниваются в матрицу "дни × бумаги"
+    (пропуски — последней известной ценой), последняя строка — текущие цены. Дни, которые
+    свёртка свечей уже не пересчитывает, читаются для всех бумаг раз в день и держатся
+    в процессе; из базы на запрос — только свечи последних двух дней. Стоимость портфеля по дням — матрица цен × текущие
+    количества (позиции считаются неизменными за период), рынок — равновзвешенный индекс
+    голубых фишек (is_blue_chip). Всё остальное — векторные операции NumPy.
+
+    Результат кэшируется в LRU процесса по (портфель, позиции и цены, версия PriceCache):
+    сделка или новый прогон обновления цен дают новый ключ, старые вытесняются.
+    """
+
+    @staticmethod
+    def get_analytics(portfolio, days: int = ANALYTICS_DAYS) -> dict:
+        holdings = tuple(
+            Asset.objects.filter(portfolio=portfolio, quantity__gt=0)
+            .order_by('stock_id')
+            .values_list('stock_id', 'stock__ticker', 'quantity', 'stock__current_price', 'stock__sector')
+        )
+        return PortfolioAnalytics._cached(portfolio.pk, holdings, days, PriceCache.version())
+
+    @staticmethod
+    @lru_cache(maxsize=ANALYTICS_CACHE_SIZE)
+    def _cached(portfolio_id, holdings, days, data_version) -> dict:
+        return PortfolioAnalytics.compute(holdings, days)
+
+    @staticmethod
+    def _price_matrix(candles):
+        """(даты, id бумаг по возрастанию, матрица цен закрытия дни × бумаги, пропуски — NaN) из дневных свечей."""
+        buckets = list(candles.values_list('bucket_start', flat=True).distinct().order_by('bucket_start'))
+        if not buckets:
+            return [], np.empty(0, dtype=np.int64), np.empty((0, 0))
+        # Свеча дня, закрытого между запросами, не должна сдвинуть нумерацию
+        candles = candles.filter(bucket_start__lte=buckets[-1])
+        # Номер дня и цена считаются в базе: без разбора datetime и Decimal
+        # на каждую из десятков тысяч строк
+        rows = np.array(
+            list(
+                candles.annotate(
+                    day=Window(DenseRank(), order_by=F('bucket_start').asc()),
+                    close_value=Cast('close', FloatField()),
+                ).values_list('stock_id', 'day', 'close_value')
+            ),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        stock_ids, columns = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+
+        prices = np.full((len(buckets), len(stock_ids)), np.nan)
+        prices[rows[:, 1].astype(np.int64) - 1, columns] = rows[:, 2]
+        return [timezone.localtime(bucket).date() for bucket in buckets], stock_ids, prices
+
+    @staticmethod
+    @lru_cache(maxsize=2)
+    def _settled_history(until):
+        """
+        Закрытия всех бумаг за ANALYTICS_MAX_DAYS до until. Свёртка пересчитывает только
+        дни начиная с until, эти свечи уже не меняются: матрица читается раз в день на процесс.
+        """
+        since = until - timedelta(days=ANALYTICS_MAX_DAYS)
+        return PortfolioAnalytics._price_matrix(
+            Candle.objects.filter(interval=Candle.INTERVAL_1D, bucket_start__gte=since, bucket_start__lt=until)
+        )
+
+    @staticmethod
+    def _history(stock_ids, days):
+        """(даты, матрица цен закрытия дни × stock_ids, пропуски — NaN) за последние days дней."""
+        now = timezone.now()
+        until = PriceHistoryService.bucket_start(
+            now - PriceHistoryService.ROLLUP_LOOKBACK[Candle.INTERVAL_1D], Candle.INTERVAL_1D
+        )
+        settled_dates, settled_ids, settled = PortfolioAnalytics._settled_history(until)
+        recent_dates, recent_ids, recent = PortfolioAnalytics._price_matrix(
+            Candle.objects.filter(interval=Candle.INTERVAL_1D, stock_id__in=stock_ids, bucket_start__gte=until)
+        )
+
+        # Строки за последние days дней, столбцы — в порядке stock_ids (нет истории — NaN)
+        first = bisect_left(settled_dates, timezone.localtime(now - timedelta(days=days)).date())
+        wanted = np.asarray(stock_ids)
+        prices = np.full((len(settled_dates) - first + len(recent_dates), len(stock_ids)), np.nan)
+        for dates, ids, matrix, offset in ((settled_dates, settled_ids, settled[first:], 0),
+                                           (recent_dates, recent_ids, recent, len(settled_dates) - first)):
+            if not len(ids):
+                continue
+            positions = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1)
+            found = ids[positions] == wanted
+            prices[offset:offset + len(matrix), found] = matrix[:, positions[found]]
+        return settled_dates[first:] + recent_dates, prices
+
+    @staticmethod
+    def compute(holdings, days: int = ANALYTICS_DAYS) -> dict:
+        """Аналитика для позиций holdings: (stock_id, тикер, количество, текущая цена, сектор)."""
+        today = timezone.localdate()
+        result = {'period': {'from': None, 'to': today, 'points': 0}, 'positions': len(holdings), 'sector_exposure': []}
+
+        # Распределение по секторам — по текущей стоимости позиций
+        market_values = np.array([float(quantity * price) for _, _, quantity, price, _ in holdings])
+        total = market_values.sum()
+        sectors = {}
+        for (_, _, _, _, sector), market_value in zip(holdings, market_values):
+            sectors[sector] = sectors.get(sector, 0.0) + market_value
+        result['sector_exposure'] = [
+            {
+                'sector': sector,
+                'name': SECTOR_NAMES.get(sector, sector),
+                'market_value': round(value, 2),
+                'weight_percent': round(value / total * 100, 2) if total > 0 else 0.0,
+            }
+            for sector, value in sorted(sectors.items(), key=lambda item: -item[1])
+        ]
+        if not holdings:
+            return {**result, **compute_metrics([])}
+
+        held_ids = [stock_id for stock_id, *_ in holdings]
+        blue_chips = list(
+            Stock.objects.filter(is_blue_chip=True, current_price__gt=0).order_by('id').values_list('id', 'current_price')
+        )
+        held = set(held_ids)
+        stock_ids = held_ids + [stock_id for stock_id, _ in blue_chips if stock_id not in held]
+        dates, prices = PortfolioAnalytics._history(stock_ids, days)
+
+        # Последняя точка — текущие цены (сегодняшняя свеча ещё не закрыта)
+        current = {stock_id: float(price) for stock_id, _, _, price, _ in holdings}
+        current.update((stock_id, float(price)) for stock_id, price in blue_chips)
+        now_row = np.array([current[stock_id] for stock_id in stock_ids])[None, :]
+        if dates and dates[-1] == today:
+            prices[-1] = now_row
+        else:
+            dates.append(today)
+            prices = np.vstack([prices, now_row])
+        prices = _forward_fill(prices)
+
+        quantities = np.array([quantity for _, _, quantity, _, _ in holdings], dtype=np.float64)
+        values = prices[:, :len(held_ids)] @ quantities
+
+        market_returns = None
+        columns = {stock_id: index for index, stock_id in enumerate(stock_ids)}
+        blue_chip_columns = [columns[stock_id] for stock_id, _ in blue_chips]
+        if blue_chip_columns:
+            market = prices[:, blue_chip_columns]
+            market_returns = (market[1:] / market[:-1] - 1).mean(axis=1)
+
+        result['period'] = {'from': dates[0], 'to': dates[-1], 'points': len(dates)}
+        return {**result, **compute_metrics(values, market_returns)}
@@ -6,3 +6,16 @@ class PortfolioConfig(AppConfig):
     name = 'apps.portfolio'
     label = 'portfolio'
     verbose_name = 'портфель'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_save
+        from apps.market.signals import prices_updated, prices_written
+        from .matching import on_prices_updated
+        from .services import on_prices_written, on_user_created
+        # Отложенные заявки исполняются в конце каждого прогона обновления цен
+        prices_updated.connect(on_prices_updated, dispatch_uid='portfolio.matching')
+        # Оценка портфелей меняется в той же транзакции, что и цены
+        prices_written.connect(on_prices_written, dispatch_uid='portfolio.valuation')
+        # Портфель создаётся при регистрации, а не на первом запросе
+        post_save.connect(on_user_created, sender=get_user_model(), dispatch_uid='portfolio.user_created')
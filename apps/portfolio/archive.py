@@ -0,0 +1,242 @@
+import json
+import logging
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.utils import timezone
+
+from .locking import write_transaction
+from .models import Transaction, TransactionArchive, ArchivedPosition
+
+logger = logging.getLogger(__name__)
+
+# Транзакции старше стольких дней (целыми месяцами) уходят в архив
+ARCHIVE_HORIZON_DAYS = 365
+# Сколько транзакций переносить за одну транзакцию базы: блокировка записи SQLite — миллисекунды
+ARCHIVE_BATCH_SIZE = 1000
+# Пауза между пачками, чтобы сделки успевали занять блокировку записи
+ARCHIVE_PAUSE = 0.05
+ARCHIVE_COMPRESSION_LEVEL = 6
+# Столбцы строки архива (в data хранится по столбцам)
+ARCHIVE_FIELDS = ('id', 'stock_id', 'ticker', 'action', 'quantity', 'price', 'commission', 'timestamp')
+
+KOPECK = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+class LedgerPosition:
+    """Позиция по журналу: количество и взвешенная средняя цена (комиссия в неё НЕ входит)."""
+
+    __slots__ = ('quantity', 'average_buy_price')
+
+    def __init__(self, quantity: int = 0, average_buy_price: Decimal = ZERO):
+        self.quantity = quantity
+        self.average_buy_price = average_buy_price
+
+    def buy(self, price: Decimal, quantity: int):
+        # Та же формула, что у сделок: (средняя * кол-во + стоимость) / новое кол-во, до копеек
+        self.average_buy_price = (
+            (self.average_buy_price * self.quantity + price * quantity) / (self.quantity + quantity)
+        ).quantize(KOPECK, rounding=ROUND_HALF_UP)
+        self.quantity += quantity
+
+    def sell(self, quantity: int):
+        self.quantity -= quantity
+
+
+def month_of(moment) -> date:
+    """Первое число месяца, в который попадает moment (по локальному времени)."""
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def pack(rows) -> bytes:
+    """Сжимает строки (кортежи по ARCHIVE_FIELDS) в столбцы JSON под zlib."""
+    columns = {field: [] for field in ARCHIVE_FIELDS}
+    for row in rows:
+        for field, value in zip(ARCHIVE_FIELDS, row):
+            columns[field].append(value)
+    columns['price'] = [str(value) for value in columns['price']]
+    columns['commission'] = [str(value) for value in columns['commission']]
+    columns['timestamp'] = [value.isoformat() for value in columns['timestamp']]
+    return zlib.compress(json.dumps(columns, separators=(',', ':')).encode(), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def unpack(data: bytes) -> list:
+    """Строки архива (кортежи по ARCHIVE_FIELDS) в порядке id."""
+    columns = json.loads(zlib.decompress(data))
+    columns['price'] = [Decimal(value) for value in columns['price']]
+    columns['commission'] = [Decimal(value) for value in columns['commission']]
+    columns['timestamp'] = [datetime.fromisoformat(value) for value in columns['timestamp']]
+    return list(zip(*(columns[field] for field in ARCHIVE_FIELDS)))
+
+
+class TransactionArchiveService:
+    """
+    Архив старых транзакций: строки старше ARCHIVE_HORIZON_DAYS (целыми месяцами)
+    переносятся из Transaction в сжатые части "портфель × месяц" (TransactionArchive),
+    а перед этим сворачиваются в итоги по позициям (ArchivedPosition) — с них сверка
+    с журналом продолжает проигрывать оставшиеся транзакции.
+
+    Перенос идёт пачками по ARCHIVE_BATCH_SIZE транзакций в порядке (портфель, id):
+    каждая пачка — своя короткая транзакция базы, прерванный прогон продолжается
+    с того же места. Транзакции портфеля архивируются от старых к новым, поэтому
+    архивные строки портфеля всегда старше оставшихся в таблице: история читает
+    сначала таблицу, затем архив по месяцам от новых к старым.
+    """
+
+    @staticmethod
+    def cutoff(horizon_days: int = ARCHIVE_HORIZON_DAYS, now=None):
+        """Граница архива: начало месяца, в который попадает now - horizon_days."""
+        local = timezone.localtime((now or timezone.now()) - timedelta(days=horizon_days))
+        return local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def archive_batch(cutoff, after_portfolio_id: int = 0, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+        """
+        Переносит в архив до batch_size транзакций старше cutoff, начиная с портфеля
+        after_portfolio_id. Возвращает {'archived', 'chunks', 'next_portfolio_id'}.
+        """
+        with write_transaction():
+            rows = list(
+                Transaction.objects.filter(portfolio_id__gte=after_portfolio_id, timestamp__lt=cutoff)
+                .order_by('portfolio_id', 'id')
+                .values_list('portfolio_id', 'id', 'stock_id', 'stock__ticker', 'action', 'quantity', 'price', 'commission', 'timestamp')
+                [:batch_size]
+            )
+            if not rows:
+                return {'archived': 0, 'chunks': 0, 'next_portfolio_id': None}
+
+            # Части "портфель × месяц": новые строки дописываются к уже архивированным
+            groups = {}
+            for portfolio_id, *row in rows:
+                groups.setdefault((portfolio_id, month_of(row[-1])), []).append(tuple(row))
+            portfolio_ids = {portfolio_id for portfolio_id, _ in groups}
+            existing = {
+                (chunk.portfolio_id, chunk.month): chunk
+                for chunk in TransactionArchive.objects.filter(
+                    portfolio_id__in=portfolio_ids, month__in={month for _, month in groups}
+                )
+            }
+            to_create, to_update = [], []
+            for (portfolio_id, month), group in groups.items():
+                chunk = existing.get((portfolio_id, month))
+                if chunk is None:
+                    chunk = TransactionArchive(portfolio_id=portfolio_id, month=month, first_id=group[0][0])
+                    to_create.append(chunk)
+                else:
+                    group = unpack(chunk.data) + group
+                    to_update.append(chunk)
+                chunk.transactions, chunk.last_id, chunk.data = len(group), group[-1][0], pack(group)
+            TransactionArchive.objects.bulk_create(to_create)
+            TransactionArchive.objects.bulk_update(to_update, ['transactions', 'last_id', 'data', 'updated_at'])
+
+            TransactionArchiveService._fold(rows, portfolio_ids)
+            Transaction.objects.filter(pk__in=[row[1] for row in rows]).delete()
+
+        return {'archived': len(rows), 'chunks': len(groups), 'next_portfolio_id': rows[-1][0]}
+
+    @staticmethod
+    def _fold(rows, portfolio_ids):
+        """Добавляет строки (в порядке портфель, id) к итогам архивированных позиций."""
+        summaries = {
+            (summary.portfolio_id, summary.stock_id): summary
+            for summary in ArchivedPosition.objects.filter(portfolio_id__in=portfolio_ids)
+        }
+        touched = {}
+        for portfolio_id, transaction_id, stock_id, _, action, quantity, price, commission, _ in rows:
+            key = (portfolio_id, stock_id)
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = ArchivedPosition(portfolio_id=portfolio_id, stock_id=stock_id)
+            touched[key] = summary
+            position = LedgerPosition(summary.quantity, summary.average_buy_price)
+            amount = price * quantity
+            if action == 'BUY':
+                position.buy(price, quantity)
+                summary.bought_quantity += quantity
+                summary.buy_amount += amount
+            else:
+                position.sell(quantity)
+                summary.sold_quantity += quantity
+                summary.sell_amount += amount
+            summary.quantity, summary.average_buy_price = position.quantity, position.average_buy_price
+            summary.commission += commission
+            summary.transactions += 1
+            summary.last_transaction_id = transaction_id
+
+        to_create = [summary for summary in touched.values() if summary.pk is None]
+        to_update = [summary for summary in touched.values() if summary.pk is not None]
+        ArchivedPosition.objects.bulk_create(to_create)
+        ArchivedPosition.objects.bulk_update(
+            to_update,
+            ['transactions', 'bought_quantity', 'sold_quantity', 'buy_amount', 'sell_amount', 'commission',
+             'quantity', 'average_buy_price', 'last_transaction_id'],
+        )
+
+    @staticmethod
+    def archive(horizon_days: int = ARCHIVE_HORIZON_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                max_batches=None, pause: float = ARCHIVE_PAUSE) -> dict:
+        """
+        Переносит в архив все транзакции старше границы (или не больше max_batches пачек).
+        Возвращает {'cutoff', 'archived', 'batches', 'done', 'seconds'}: done — архив догнал границу.
+        """
+        started = time.perf_counter()
+        cutoff = TransactionArchiveService.cutoff(horizon_days)
+        report = {'cutoff': cutoff, 'archived': 0, 'batches': 0, 'done': False, 'seconds': 0.0}
+
+        portfolio_id = 0
+        while max_batches is None or report['batches'] < max_batches:
+            if report['batches']:
+                time.sleep(pause)
+            result = TransactionArchiveService.archive_batch(cutoff, portfolio_id, batch_size)
+            report['archived'] += result['archived']
+            if result['next_portfolio_id'] is None:
+                report['done'] = True
+                break
+            report['batches'] += 1
+            portfolio_id = result['next_portfolio_id']
+
+        report['seconds'] = time.perf_counter() - started
+        logger.info(
+            f"Transactions archived before {cutoff:%Y-%m-%d}: {report['archived']} in {report['batches']} batches "
+            f"({'done' if report['done'] else 'to be continued'}) in {report['seconds']:.2f}s."
+        )
+        return report
+
+    @staticmethod
+    def history_rows(portfolio, filters=None, cursor=None):
+        """
+        Архивные транзакции портфеля от новых к старым строками истории
+        (id, action, ticker, quantity, price, commission, timestamp), с теми же фильтрами
+        и курсором, что и PortfolioService.history_queryset. Части читаются по одной
+        и только за нужные месяцы, отдельным запросом каждая.
+        """
+        filters = filters or {}
+        months = TransactionArchive.objects.filter(portfolio=portfolio)
+        if filters.get('date_from'):
+            months = months.filter(month__gte=month_of(filters['date_from']))
+        if filters.get('date_to'):
+            months = months.filter(month__lte=month_of(filters['date_to']))
+        if cursor is not None:
+            months = months.filter(month__lte=month_of(cursor[0]))
+        ticker = filters.get('ticker')
+
+        for chunk_id in list(months.order_by('-month').values_list('id', flat=True)):
+            data = TransactionArchive.objects.filter(pk=chunk_id).values_list('data', flat=True).first()
+            if data is None:
+                continue
+            rows = sorted(unpack(data), key=lambda row: (row[-1], row[0]), reverse=True)
+            for transaction_id, _, row_ticker, action, quantity, price, commission, timestamp in rows:
+                if ticker and row_ticker != ticker:
+                    continue
+                if filters.get('action') and action != filters['action']:
+                    continue
+                if filters.get('date_from') and timestamp < filters['date_from']:
+                    continue
+                if filters.get('date_to') and timestamp >= filters['date_to']:
+                    continue
+                if cursor is not None and (timestamp, transaction_id) >= cursor:
+                    continue
+                yield transaction_id, action, row_ticker, quantity, price, commission, timestamp
@@ -0,0 +1,119 @@
+import logging
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from apps.market.models import Stock
+from .models import Portfolio, Asset, EquitySnapshot
+
+logger = logging.getLogger(__name__)
+
+# Сколько портфелей считать и записывать за один шаг (одна транзакция на шаг)
+EQUITY_SNAPSHOT_CHUNK_SIZE = 5000
+EQUITY_SNAPSHOT_BATCH_SIZE = 1000
+# Кривая капитала по умолчанию и максимум — в днях
+EQUITY_CURVE_DAYS = 365
+EQUITY_CURVE_MAX_DAYS = 5 * 365
+
+CENT = Decimal('0.01')
+
+
+class EquitySnapshotService:
+    """
+    Ежедневные снимки капитала портфелей: баланс, стоимость акций, чистая стоимость и позиции.
+
+    Все портфели шага считаются разом в NumPy: позиции шага — массив строк
+    (портфель, акция, количество), цены — вектор в копейках по id акций, стоимость
+    портфелей — разреженное произведение "позиции × цены", свёрнутое np.bincount.
+    Шаги идут по возрастанию id портфеля и коммитятся по одному, поэтому прерванный
+    прогон продолжается с последнего записанного портфеля.
+    """
+
+    @staticmethod
+    def _price_vector():
+        """(id акций по возрастанию, цены в копейках int64, тикеры) из таблицы Stock."""
+        rows = list(Stock.objects.order_by('id').values_list('id', 'current_price', 'ticker'))
+        stock_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        prices = np.array([int(row[1] * 100) for row in rows], dtype=np.int64)
+        tickers = np.array([row[2] for row in rows], dtype=object)
+        return stock_ids, prices, tickers
+
+    @staticmethod
+    def snapshot_all(date=None, chunk_size: int = EQUITY_SNAPSHOT_CHUNK_SIZE) -> dict:
+        """
+        Снимает капитал всех портфелей на дату date (по умолчанию — сегодня) по текущим ценам.
+        Портфели, для которых снимок на эту дату уже есть, пропускаются: повторный запуск
+        после сбоя дописывает только недостающие. Возвращает {'date', 'created', 'resumed_after', 'seconds'}.
+        """
+        started = time.perf_counter()
+        date = date or timezone.localdate()
+        stock_ids, prices, tickers = EquitySnapshotService._price_vector()
+
+        last_id = EquitySnapshot.objects.filter(date=date).aggregate(last=Max('portfolio_id'))['last'] or 0
+        report = {'date': date, 'created': 0, 'resumed_after': last_id, 'seconds': 0.0}
+
+        while True:
+            portfolios = list(
+                Portfolio.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'balance')[:chunk_size]
+            )
+            if not portfolios:
+                break
+            portfolio_ids = np.array([row[0] for row in portfolios], dtype=np.int64)
+            first_id, last_id = portfolios[0][0], portfolios[-1][0]
+
+            holdings = np.array(
+                list(
+                    Asset.objects.filter(portfolio_id__gte=first_id, portfolio_id__lte=last_id, quantity__gt=0)
+                    .order_by('portfolio_id', 'stock_id')
+                    .values_list('portfolio_id', 'stock_id', 'quantity')
+                ),
+                dtype=np.int64,
+            ).reshape(-1, 3)
+            # Строки позиций -> индексы портфеля в шаге и акции в векторе цен
+            rows = np.searchsorted(portfolio_ids, holdings[:, 0])
+            columns = np.searchsorted(stock_ids, holdings[:, 1])
+            quantities = holdings[:, 2]
+            # Копейки, целые: сумма по портфелю точна, пока меньше 2**53 (~9e13 RUB)
+            market_values = np.bincount(rows, weights=quantities * prices[columns], minlength=len(portfolio_ids))
+            market_values = np.rint(market_values).astype(np.int64)
+            # Позиции отсортированы по портфелю: границы портфелей в массиве строк
+            bounds = np.searchsorted(rows, np.arange(len(portfolio_ids) + 1))
+            position_tickers = tickers[columns]
+
+            snapshots = []
+            for index, (portfolio_id, balance) in enumerate(portfolios):
+                start, end = bounds[index], bounds[index + 1]
+                market_value = Decimal(int(market_values[index])) * CENT
+                snapshots.append(EquitySnapshot(
+                    portfolio_id=portfolio_id,
+                    date=date,
+                    balance=balance,
+                    market_value=market_value,
+                    net_worth=balance + market_value,
+                    positions=dict(zip(position_tickers[start:end].tolist(), quantities[start:end].tolist())),
+                ))
+            with transaction.atomic():
+                EquitySnapshot.objects.bulk_create(snapshots, batch_size=EQUITY_SNAPSHOT_BATCH_SIZE, ignore_conflicts=True)
+            report['created'] += len(snapshots)
+
+        report['seconds'] = time.perf_counter() - started
+        logger.info(
+            f"Equity snapshots for {date}: {report['created']} portfolios "
+            f"(resumed after id {report['resumed_after']}) in {report['seconds']:.2f}s."
+        )
+        return report
+
+    @staticmethod
+    def get_equity_curve(portfolio, days: int = EQUITY_CURVE_DAYS) -> list:
+        """Кривая капитала за последние days дней, от старых снимков к новым."""
+        since = timezone.localdate() - timedelta(days=days)
+        return list(
+            EquitySnapshot.objects.filter(portfolio=portfolio, date__gt=since)
+            .order_by('date')
+            .values('date', 'balance', 'market_value', 'net_worth')
+        )
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .locking import write_transaction
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Заголовок ответа, отданного из хранилища, а не выполненного заново
+IDEMPOTENCY_REPLAY_HEADER = 'Idempotent-Replayed'
+# Сколько хранится ответ: повтор с тем же ключом позже выполнится как новый запрос
+IDEMPOTENCY_TTL = timedelta(hours=24)
+IDEMPOTENCY_CACHE_PREFIX = 'idempotency'
+IDEMPOTENCY_KEY_MAX_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+class IdempotencyStore:
+    """
+    Хранилище ответов по (пользователь, Idempotency-Key): кэш для быстрых повторов
+    и таблица IdempotencyKey как источник истины с уникальным ключом.
+    """
+
+    @staticmethod
+    def fingerprint(request) -> str:
+        """Хэш метода, пути и тела запроса."""
+        payload = json.dumps([request.method, request.path, request.data], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def _cache_key(user_id, key) -> str:
+        # Ключ клиента может содержать любые символы — в имя ключа кэша идёт его хэш
+        return f"{IDEMPOTENCY_CACHE_PREFIX}:{user_id}:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    @staticmethod
+    def get(user_id, key):
+        """Сохранённый ответ {'fingerprint', 'status', 'body'} или None."""
+        cache_key = IdempotencyStore._cache_key(user_id, key)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return entry
+
+        now = timezone.now()
+        record = IdempotencyKey.objects.filter(
+            user_id=user_id, key=key, expires_at__gt=now, response_status__isnull=False
+        ).values('fingerprint', 'response_status', 'response_body', 'expires_at').first()
+        if record is None:
+            return None
+        entry = {'fingerprint': record['fingerprint'], 'status': record['response_status'], 'body': record['response_body']}
+        cache.set(cache_key, entry, timeout=int((record['expires_at'] - now).total_seconds()))
+        return entry
+
+    @staticmethod
+    def claim(user, key, fingerprint):
+        """
+        Занимает ключ (INSERT с уникальным ограничением) в текущей транзакции.
+        Возвращает запись или None, если ключ уже занят другим запросом. Пока транзакция,
+        занявшая ключ, не завершена, параллельный INSERT того же ключа ждёт её.
+        """
+        now = timezone.now()
+        fields = {'user': user, 'key': key, 'fingerprint': fingerprint, 'expires_at': now + IDEMPOTENCY_TTL}
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(**fields)
+        except IntegrityError:
+            pass
+        # Просроченный ключ можно занять заново
+        deleted, _ = IdempotencyKey.objects.filter(user=user, key=key, expires_at__lte=now).delete()
+        if not deleted:
+            return None
+        return IdempotencyKey.objects.create(**fields)
+
+    @staticmethod
+    def complete(record, response) -> dict:
+        """Сохраняет ответ; в кэш он попадает после коммита транзакции."""
+        # Храним ответ в том виде, в каком его получил клиент (Decimal -> число и т.п.)
+        body = json.loads(JSONRenderer().render(response.data)) if response.data is not None else None
+        IdempotencyKey.objects.filter(pk=record.pk).update(response_status=response.status_code, response_body=body)
+
+        entry = {'fingerprint': record.fingerprint, 'status': response.status_code, 'body': body}
+        cache_key = IdempotencyStore._cache_key(record.user_id, record.key)
+        transaction.on_commit(lambda: cache.set(cache_key, entry, timeout=int(IDEMPOTENCY_TTL.total_seconds())))
+        return entry
+
+    @staticmethod
+    def prune(now=None) -> int:
+        """Удаляет просроченные ключи."""
+        deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()
+        return deleted
+
+
+def idempotent(view_method):
+    """
+    Делает POST-действие ViewSet идемпотентным по заголовку Idempotency-Key.
+
+    Первый запрос с ключом выполняется в одной транзакции с записью ключа и ответа.
+    Повторы получают сохранённый ответ (заголовок Idempotent-Replayed: true) без
+    обращения к Portfolio и Asset, параллельные дубли ждут завершения первого.
+    Ответы 5xx и исключения не сохраняются — такой запрос можно повторить.
+    Без заголовка действие выполняется как обычно.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return Response(
+                {'error': f"{IDEMPOTENCY_HEADER} длиннее {IDEMPOTENCY_KEY_MAX_LENGTH} символов."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        fingerprint = IdempotencyStore.fingerprint(request)
+        entry = IdempotencyStore.get(request.user.pk, key)
+        if entry is None:
+            with write_transaction():
+                record = IdempotencyStore.claim(request.user, key, fingerprint)
+                if record is not None:
+                    response = view_method(self, request, *args, **kwargs)
+                    if response.status_code >= 500:
+                        transaction.set_rollback(True)
+                    else:
+                        IdempotencyStore.complete(record, response)
+                    return response
+            entry = IdempotencyStore.get(request.user.pk, key)
+
+        if entry is None:
+            return Response(
+                {'error': "Запрос с этим ключом ещё выполняется, повторите позже."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        if entry['fingerprint'] != fingerprint:
+            return Response(
+                {'error': f"{IDEMPOTENCY_HEADER} уже использован для другого запроса."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+
+        logger.info(f"Повтор запроса {request.path} пользователя {request.user.username} по {IDEMPOTENCY_HEADER}.")
+        return Response(entry['body'], status=entry['status'], headers={IDEMPOTENCY_REPLAY_HEADER: 'true'})
+
+    return wrapper
@@ -0,0 +1,344 @@
+import logging
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Portfolio
+
+logger = logging.getLogger(__name__)
+
+# Снимок рангов целиком и короткий ключ с его версией (как у PriceCache)
+SNAPSHOT_KEY = 'portfolio:leaderboard:snapshot'
+VERSION_KEY = 'portfolio:leaderboard:version'
+# Журнал приращений поверх снимка: счётчик записей и сами записи по номеру
+DELTA_SEQ_KEY = 'portfolio:leaderboard:delta_seq'
+DELTA_KEY_PREFIX = 'portfolio:leaderboard:delta:'
+# Кто и когда сворачивает журнал в новый снимок (cache.add — один процесс на интервал)
+COMPACT_LOCK_KEY = 'portfolio:leaderboard:compact'
+# Размер пачки при чтении портфелей для полной пересборки
+LEADERBOARD_LOAD_CHUNK_SIZE = 5000
+# Не чаще раза в столько секунд журнал сворачивается в новый снимок: каждая публикация —
+# три массива на весь рейтинг, а тики цен и сделки идут непрерывно
+LEADERBOARD_PUBLISH_INTERVAL = 30
+# Сколько хранится запись журнала; свёртка идёт гораздо чаще, потерянная запись — пересборка
+LEADERBOARD_DELTA_TTL = 60 * 60
+LEADERBOARD_PAGE_SIZE = 20
+LEADERBOARD_MAX_PAGE_SIZE = 100
+# Сколько соседей сверху и снизу показывать вокруг игрока
+LEADERBOARD_AROUND = 5
+LEADERBOARD_MAX_AROUND = 25
+
+
+def to_cents(amount: Decimal) -> int:
+    """Сумма в копейках целым числом: в массивах снимка нет ошибок округления float."""
+    return int((amount * 100).to_integral_value())
+
+
+class RankSnapshot:
+    """
+    Ранги игроков по чистой стоимости в общем кэше: три массива numpy int64.
+
+    ids / worths — id портфелей по возрастанию и их стоимость в копейках (поиск
+    стоимости портфеля — searchsorted по ids), sorted_worths — те же стоимости по
+    возрастанию. Ранг стоимости v — 1 + число стоимостей больше v, один searchsorted:
+    O(log n) на запрос при любом числе игроков. Одинаковая стоимость — одинаковый ранг.
+
+    Снимок собирается из базы (rebuild) при первом обращении и периодической задачей.
+    Между пересборками прогоны обновления цен, сделки, исполнение заявок и регистрация
+    пишут после коммита приращения чистой стоимости и новые портфели в общий журнал
+    (apply_deltas): запись с номером из атомарного счётчика DELTA_SEQ_KEY. Снимок помнит
+    номер последней учтённой записи (seq), каждый процесс применяет к нему более новые
+    записи у себя, а раз в LEADERBOARD_PUBLISH_INTERVAL секунд один из процессов
+    сворачивает журнал в новую версию снимка. Правки не зависят от того, какой процесс
+    их сделал, и видны всем процессам сразу. Стоимость самого игрока и его соседей
+    всегда берётся из базы.
+    """
+
+    _local = {'version': None, 'seq': None, 'snapshot': None}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _current_seq() -> int:
+        cache.add(DELTA_SEQ_KEY, 0, timeout=None)
+        return cache.get(DELTA_SEQ_KEY) or 0
+
+    @staticmethod
+    def rebuild() -> dict:
+        """Читает чистую стоимость всех портфелей одним запросом и публикует новую версию."""
+        started = time.perf_counter()
+        # Номер журнала — до чтения: записи до него сделаны после коммита и уже в базе
+        seq = RankSnapshot._current_seq()
+        rows = Portfolio.objects.order_by('id').values_list('id', 'net_worth')
+        ids, worths = [], []
+        for portfolio_id, net_worth in rows.iterator(chunk_size=LEADERBOARD_LOAD_CHUNK_SIZE):
+            ids.append(portfolio_id)
+            worths.append(to_cents(net_worth))
+
+        worths = np.array(worths, dtype=np.int64)
+        snapshot = RankSnapshot._publish(np.array(ids, dtype=np.int64), worths, np.sort(worths), seq)
+        cache.set(COMPACT_LOCK_KEY, True, timeout=LEADERBOARD_PUBLISH_INTERVAL)
+        logger.info(
+            f"Leaderboard rebuilt: version {snapshot['version']}, {len(worths)} portfolios "
+            f"in {time.perf_counter() - started:.3f}s."
+        )
+        return snapshot
+
+    @staticmethod
+    def _publish(ids, worths, sorted_worths, seq) -> dict:
+        version = int(timezone.now().timestamp() * 1_000_000)
+        snapshot = {'version': version, 'seq': seq, 'ids': ids, 'worths': worths, 'sorted_worths': sorted_worths}
+        # Сначала снимок, затем версия: читатель, увидевший новую версию, найдёт и снимок
+        cache.set(SNAPSHOT_KEY, snapshot, timeout=None)
+        cache.set(VERSION_KEY, version, timeout=None)
+        with RankSnapshot._lock:
+            RankSnapshot._local = {'version': version, 'seq': seq, 'snapshot': snapshot}
+        return snapshot
+
+    @staticmethod
+    def version():
+        """Версия опубликованного снимка или None, если его ещё нет."""
+        return cache.get(VERSION_KEY)
+
+    @staticmethod
+    def get_snapshot() -> dict:
+        """
+        Текущий снимок: локальная копия процесса, если её версия совпадает с общей,
+        с применёнными записями журнала новее её seq.
+        """
+        state = cache.get_many([VERSION_KEY, DELTA_SEQ_KEY])
+        version, seq = state.get(VERSION_KEY), state.get(DELTA_SEQ_KEY, 0)
+        if version is None:
+            return RankSnapshot.rebuild()
+        local = RankSnapshot._local
+        if local['version'] == version:
+            snapshot = local['snapshot']
+        else:
+            snapshot = cache.get(SNAPSHOT_KEY)
+            if snapshot is None or snapshot['version'] != version:
+                return RankSnapshot.rebuild()
+        if snapshot['seq'] < seq:
+            snapshot = RankSnapshot._replay(snapshot, seq)
+        if local['version'] != version or local['seq'] != snapshot['seq']:
+            with RankSnapshot._lock:
+                RankSnapshot._local = {'version': version, 'seq': snapshot['seq'], 'snapshot': snapshot}
+        return snapshot
+
+    @staticmethod
+    def _replay(snapshot, seq) -> dict:
+        """
+        Снимок с записями журнала snapshot['seq'] + 1 .. seq. Запись, которую ещё не успели
+        положить после увеличения счётчика, и все следующие ждут следующего обращения.
+        """
+        keys = [f"{DELTA_KEY_PREFIX}{number}" for number in range(snapshot['seq'] + 1, seq + 1)]
+        entries = cache.get_many(keys)
+        changes, inserts = {}, {}
+        applied = snapshot['seq']
+        for key in keys:
+            entry = entries.get(key)
+            if entry is None:
+                break
+            for portfolio_id, worth in entry['inserts'].items():
+                inserts[portfolio_id] = worth
+            for portfolio_id, change in entry['changes'].items():
+                if portfolio_id in inserts:
+                    inserts[portfolio_id] += change
+                else:
+                    changes[portfolio_id] = changes.get(portfolio_id, 0) + change
+            applied += 1
+        if applied == snapshot['seq']:
+            return snapshot
+        ids, worths, sorted_worths = RankSnapshot._applied(snapshot, changes, inserts)
+        return dict(snapshot, seq=applied, ids=ids, worths=worths, sorted_worths=sorted_worths)
+
+    @staticmethod
+    def _applied(snapshot, changes: dict, inserts: dict):
+        """
+        Массивы снимка после приращений changes и новых портфелей inserts (id -> копейки).
+
+        Стоимости k изменившихся портфелей находятся поиском по ids, их старые значения
+        вырезаются из sorted_worths, новые вставляются по позициям из searchsorted:
+        O(k log n) поиска и один сдвиг массива вместо сортировки и чтения базы.
+        Новые портфели, которые уже есть в снимке (его пересобрали после их создания),
+        пропускаются; приращения портфелей, которых в снимке нет, тоже.
+        """
+        ids, worths, sorted_worths = snapshot['ids'], snapshot['worths'], snapshot['sorted_worths']
+
+        if inserts:
+            new_ids = np.fromiter(sorted(inserts), dtype=np.int64, count=len(inserts))
+            positions = np.searchsorted(ids, new_ids)
+            known = positions < len(ids)
+            known[known] = ids[positions[known]] == new_ids[known]
+            new_ids, positions = new_ids[~known], positions[~known]
+            new_worths = np.fromiter((inserts[int(portfolio_id)] for portfolio_id in new_ids), dtype=np.int64, count=len(new_ids))
+            ids = np.insert(ids, positions, new_ids)
+            worths = np.insert(worths, positions, new_worths)
+            new_worths = np.sort(new_worths)
+            sorted_worths = np.insert(sorted_worths, np.searchsorted(sorted_worths, new_worths), new_worths)
+
+        if not changes:
+            return ids, worths, sorted_worths
+        portfolio_ids = np.fromiter(changes.keys(), dtype=np.int64, count=len(changes))
+        deltas = np.fromiter(changes.values(), dtype=np.int64, count=len(changes))
+        positions = np.searchsorted(ids, portfolio_ids)
+        known = positions < len(ids)
+        known[known] = ids[positions[known]] == portfolio_ids[known]
+        positions, deltas = positions[known], deltas[known]
+        if not len(positions):
+            return ids, worths, sorted_worths
+
+        worths = worths.copy()
+        old = np.sort(worths[positions])
+        worths[positions] += deltas
+        new = np.sort(worths[positions])
+
+        # Старые значения могут повторяться: k-я копия значения — k-й слот после его начала
+        starts = np.searchsorted(sorted_worths, old, side='left')
+        starts += np.arange(len(old)) - np.searchsorted(old, old, side='left')
+        remaining = np.delete(sorted_worths, starts)
+        sorted_worths = np.insert(remaining, np.searchsorted(remaining, new), new)
+        return ids, worths, sorted_worths
+
+    @staticmethod
+    def apply_deltas(deltas: dict, inserts: dict = None) -> bool:
+        """
+        Пишет в журнал приращения чистой стоимости (portfolio_id -> Decimal) и новые
+        портфели (portfolio_id -> чистая стоимость). Вызывается после коммита изменений.
+
+        Если снимка ещё нет — ничего не делает: первая пересборка прочитает всё из базы.
+        Если с прошлой публикации прошло LEADERBOARD_PUBLISH_INTERVAL секунд, этот процесс
+        сворачивает журнал в новую версию снимка; не найденная запись журнала (вытеснена
+        из кэша) — повод пересобрать снимок из базы.
+        """
+        if cache.get(VERSION_KEY) is None:
+            return False
+        entry = {
+            'changes': {portfolio_id: to_cents(delta) for portfolio_id, delta in deltas.items() if delta},
+            'inserts': {portfolio_id: to_cents(worth) for portfolio_id, worth in (inserts or {}).items()},
+        }
+        if entry['changes'] or entry['inserts']:
+            RankSnapshot._current_seq()
+            seq = cache.incr(DELTA_SEQ_KEY)
+            cache.set(f"{DELTA_KEY_PREFIX}{seq}", entry, timeout=LEADERBOARD_DELTA_TTL)
+
+        if cache.add(COMPACT_LOCK_KEY, True, timeout=LEADERBOARD_PUBLISH_INTERVAL):
+            RankSnapshot.compact()
+        return True
+
+    @staticmethod
+    def compact() -> dict:
+        """
+        Сворачивает применённые записи журнала в новую версию снимка. Запись, которой
+        нет в кэше и после повторного чтения (вытеснена), — повод пересобрать снимок.
+        """
+        seq = RankSnapshot._current_seq()
+        snapshot = RankSnapshot.get_snapshot()
+        if snapshot['seq'] < seq and cache.get(f"{DELTA_KEY_PREFIX}{snapshot['seq'] + 1}") is None:
+            return RankSnapshot.rebuild()
+        return RankSnapshot._publish(snapshot['ids'], snapshot['worths'], snapshot['sorted_worths'], snapshot['seq'])
+
+    @staticmethod
+    def queue_deltas(deltas: dict, inserts: dict = None):
+        """
+        apply_deltas после коммита текущей транзакции. Ошибка кэша только пишется в лог:
+        сделка уже закоммичена, а снимок поправит ближайшая пересборка.
+        """
+        if deltas or inserts:
+            transaction.on_commit(lambda: RankSnapshot.apply_deltas(deltas, inserts), robust=True)
+
+    @staticmethod
+    def rank(snapshot, portfolio_id, net_worth: Decimal) -> int:
+        """
+        Место портфеля с текущей стоимостью net_worth: 1 + число портфелей снимка дороже него.
+        Собственная запись портфеля в снимке могла устареть — она не считается.
+        """
+        value = to_cents(net_worth)
+        sorted_worths = snapshot['sorted_worths']
+        above = len(sorted_worths) - int(np.searchsorted(sorted_worths, value, side='right'))
+        ids = snapshot['ids']
+        position = int(np.searchsorted(ids, portfolio_id))
+        if position < len(ids) and ids[position] == portfolio_id and snapshot['worths'][position] > value:
+            above -= 1
+        return above + 1
+
+
+class LeaderboardService:
+    """
+    Рейтинг игроков по чистой стоимости (баланс + акции).
+
+    Строки рейтинга читаются из индекса portfolio_net_worth_idx по ключу (net_worth, id):
+    страница, игрок и его соседи — диапазоны индекса, O(log n + размер страницы).
+    Места считаются по RankSnapshot.
+    """
+
+    @staticmethod
+    def encode_cursor(net_worth: Decimal, portfolio_id: int) -> str:
+        return f"{net_worth}_{portfolio_id}"
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        """(net_worth, id) из курсора страницы; ValueError, если курсор испорчен."""
+        net_worth, portfolio_id = cursor.split('_')
+        try:
+            return Decimal(net_worth), int(portfolio_id)
+        except InvalidOperation:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+    @staticmethod
+    def _fetch(queryset, limit) -> list:
+        return list(queryset.values_list('id', 'user__username', 'net_worth')[:limit])
+
+    @staticmethod
+    def _ranked(rows, snapshot) -> list:
+        """Строки (id, имя, стоимость) в ответ рейтинга, с местами по снимку."""
+        return [
+            {'rank': RankSnapshot.rank(snapshot, portfolio_id, net_worth), 'username': username, 'net_worth': net_worth}
+            for portfolio_id, username, net_worth in rows
+        ]
+
+    @staticmethod
+    def get_leaderboard(portfolio: Portfolio, limit: int = LEADERBOARD_PAGE_SIZE, cursor=None, around: int = LEADERBOARD_AROUND) -> dict:
+        """
+        Страница рейтинга (после курсора cursor — пары (net_worth, id) — или с первого
+        места), место игрока и по around соседей сверху и снизу от него. Четыре запроса
+        по индексу, сколько бы ни было игроков.
+        """
+        snapshot = RankSnapshot.get_snapshot()
+        ranked = Portfolio.objects.order_by('-net_worth', 'id')
+
+        page = ranked
+        if cursor is not None:
+            cursor_worth, cursor_id = cursor
+            page = page.filter(Q(net_worth__lt=cursor_worth) | Q(net_worth=cursor_worth, id__gt=cursor_id))
+        # Строка сверх limit только показывает, что есть следующая страница
+        top = LeaderboardService._fetch(page, limit + 1)
+        next_cursor = None
+        if len(top) > limit:
+            top = top[:limit]
+            last_id, _, last_worth = top[-1]
+            next_cursor = LeaderboardService.encode_cursor(last_worth, last_id)
+
+        # Имя — тем же запросом: у портфеля из resolve_portfolio пользователь не загружен
+        net_worth, username = Portfolio.objects.filter(pk=portfolio.pk).values_list('net_worth', 'user__username').first()
+        higher = Q(net_worth__gt=net_worth) | Q(net_worth=net_worth, id__lt=portfolio.pk)
+        lower = Q(net_worth__lt=net_worth) | Q(net_worth=net_worth, id__gt=portfolio.pk)
+        above = LeaderboardService._fetch(Portfolio.objects.filter(higher).order_by('net_worth', '-id'), around)
+        below = LeaderboardService._fetch(ranked.filter(lower), around)
+
+        return {
+            'total': len(snapshot['ids']),
+            'top': LeaderboardService._ranked(top, snapshot),
+            'next_cursor': next_cursor,
+            'me': {
+                'rank': RankSnapshot.rank(snapshot, portfolio.pk, net_worth),
+                'username': username,
+                'net_worth': net_worth,
+            },
+            'above': LeaderboardService._ranked(above[::-1], snapshot),
+            'below': LeaderboardService._ranked(below, snapshot),
+        }
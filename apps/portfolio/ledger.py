@@ -0,0 +1,307 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from itertools import repeat
+
+from django.db import connections
+from django.db.models import Max, Min, Sum
+
+from .archive import LedgerPosition
+from .locking import write_transaction
+from .models import Portfolio, Asset, Transaction, Order, ArchivedPosition
+from .services import VALUATION_UPDATE_BATCH_SIZE, ValuationService
+
+logger = logging.getLogger(__name__)
+
+# Сколько портфелей (диапазон id) проигрывает один шаг воркера
+LEDGER_RANGE_SIZE = 2000
+# Размер пачки при потоковом чтении транзакций
+LEDGER_ITERATOR_CHUNK_SIZE = 5000
+# Сколько расхождений хранить в отчёте (портфели с расхождениями считаются все)
+LEDGER_MAX_REPORTED = 1000
+
+ZERO = Decimal('0.00')
+
+
+class LedgerService:
+    """
+    Сверка состояния портфелей с журналом сделок (Transaction).
+
+    Баланс портфеля — стартовый капитал минус покупки с комиссией плюс продажи за
+    вычетом комиссии, позиции — количество и средняя цена, проигранные сделка за
+    сделкой, резервы — суммы по открытым заявкам (Order). Результат сравнивается
+    с Portfolio.balance / reserved_balance и Asset.quantity / average_buy_price /
+    reserved_quantity. Транзакции, перенесённые в архив, учитываются по итогам
+    ArchivedPosition: проигрывание портфеля начинается с них.
+
+    Портфели делятся на диапазоны id по LEDGER_RANGE_SIZE, диапазоны проигрываются
+    параллельно в пуле процессов. Внутри диапазона транзакции читаются потоком
+    (iterator) в порядке (портфель, id) — в порядке индекса внешнего ключа portfolio,
+    без сортировки, — и в памяти держится журнал только текущего портфеля.
+
+    Основной проход идёт без транзакции, чтобы воркеры не ждали друг друга на
+    блокировке SQLite. Портфели с расхождениями перепроверяются (и исправляются)
+    коротким вторым проходом в транзакции: сделка, записанная между чтениями журнала
+    и состояния, не даёт ложного расхождения.
+    """
+
+    @staticmethod
+    def ranges(range_size: int = LEDGER_RANGE_SIZE) -> list:
+        """Диапазоны id портфелей [first, last] по range_size, от меньших к большим."""
+        bounds = Portfolio.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return []
+        return [
+            (first, min(first + range_size - 1, bounds['last']))
+            for first in range(bounds['first'], bounds['last'] + 1, range_size)
+        ]
+
+    @staticmethod
+    def _opening(summaries) -> dict:
+        """
+        Состояние портфелей после архивированных транзакций по итогам ArchivedPosition:
+        portfolio_id -> (изменение баланса, {stock_id: LedgerPosition}, число транзакций).
+        """
+        opening = {}
+        for portfolio_id, stock_id, buy_amount, sell_amount, commission, quantity, average_buy_price, count in (
+            summaries.values_list(
+                'portfolio_id', 'stock_id', 'buy_amount', 'sell_amount', 'commission',
+                'quantity', 'average_buy_price', 'transactions',
+            )
+        ):
+            cash, positions, total = opening.get(portfolio_id, (ZERO, {}, 0))
+            if stock_id is not None:
+                positions[stock_id] = LedgerPosition(quantity, average_buy_price)
+            opening[portfolio_id] = (cash + sell_amount - buy_amount - commission, positions, total + count)
+        return opening
+
+    @staticmethod
+    def _replay(transactions, opening):
+        """
+        Проигрывает журнал, упорядоченный по (портфель, id), по одному портфелю, начиная
+        с состояния opening (см. _opening): (portfolio_id, изменение баланса,
+        {stock_id: LedgerPosition}, число транзакций).
+        """
+        rows = transactions.order_by('portfolio_id', 'id').values_list(
+            'portfolio_id', 'stock_id', 'action', 'quantity', 'price', 'commission'
+        )
+        current, cash, positions, count = None, ZERO, {}, 0
+        for portfolio_id, stock_id, action, quantity, price, commission in rows.iterator(chunk_size=LEDGER_ITERATOR_CHUNK_SIZE):
+            if portfolio_id != current:
+                if current is not None:
+                    yield current, cash, positions, count
+                current = portfolio_id
+                cash, positions, count = opening.get(portfolio_id, (ZERO, {}, 0))
+            count += 1
+            amount = price * quantity
+            cash += -(amount + commission) if action == 'BUY' else amount - commission
+            # Акцию удалили из справочника (stock = NULL): деньги учитываются, позиции нет
+            if stock_id is None:
+                continue
+            position = positions.get(stock_id)
+            if position is None:
+                position = positions[stock_id] = LedgerPosition()
+            if action == 'BUY':
+                position.buy(price, quantity)
+            else:
+                position.sell(quantity)
+        if current is not None:
+            yield current, cash, positions, count
+
+    @staticmethod
+    def _check(first_id: int, last_id: int, portfolio_ids=None):
+        """
+        Сравнивает журнал портфелей диапазона (или только portfolio_ids из него) с их
+        состоянием. Выдаёт по портфелю {'portfolio', 'balance', 'reserved_balance',
+        'positions', 'assets', 'reserved', 'transactions', 'drifts'}: ожидаемые значения,
+        сохранённые строки и список расхождений.
+        """
+        initial_balance = Portfolio._meta.get_field('balance').get_default()
+        portfolios = Portfolio.objects.filter(pk__gte=first_id, pk__lte=last_id)
+        assets = Asset.objects.filter(portfolio_id__gte=first_id, portfolio_id__lte=last_id)
+        orders = Order.objects.filter(portfolio_id__gte=first_id, portfolio_id__lte=last_id, status=Order.STATUS_OPEN)
+        transactions = Transaction.objects.filter(portfolio_id__gte=first_id, portfolio_id__lte=last_id)
+        summaries = ArchivedPosition.objects.filter(portfolio_id__gte=first_id, portfolio_id__lte=last_id)
+        if portfolio_ids is not None:
+            portfolios = portfolios.filter(pk__in=portfolio_ids)
+            assets = assets.filter(portfolio_id__in=portfolio_ids)
+            orders = orders.filter(portfolio_id__in=portfolio_ids)
+            transactions = transactions.filter(portfolio_id__in=portfolio_ids)
+            summaries = summaries.filter(portfolio_id__in=portfolio_ids)
+
+        stored_assets = {}
+        for asset in assets.only('portfolio_id', 'stock_id', 'quantity', 'average_buy_price', 'reserved_quantity'):
+            stored_assets.setdefault(asset.portfolio_id, {})[asset.stock_id] = asset
+        reserved_cash = dict(
+            orders.filter(action='BUY').values('portfolio_id').order_by('portfolio_id')
+            .annotate(total=Sum('reserved_cash')).values_list('portfolio_id', 'total')
+        )
+        reserved_quantity = {}
+        for portfolio_id, stock_id, total in (
+            orders.filter(action='SELL').values('portfolio_id', 'stock_id').order_by('portfolio_id', 'stock_id')
+            .annotate(total=Sum('quantity')).values_list('portfolio_id', 'stock_id', 'total')
+        ):
+            reserved_quantity.setdefault(portfolio_id, {})[stock_id] = total
+
+        # Журнал выдаёт портфели по возрастанию id, как и цикл ниже: слияние двух потоков
+        opening = LedgerService._opening(summaries)
+        replayed = LedgerService._replay(transactions, opening)
+        pending = next(replayed, None)
+        for portfolio in portfolios.order_by('pk').only('balance', 'reserved_balance').iterator(chunk_size=LEDGER_ITERATOR_CHUNK_SIZE):
+            while pending is not None and pending[0] < portfolio.pk:
+                pending = next(replayed, None)
+            cash, positions, count = opening.get(portfolio.pk, (ZERO, {}, 0))
+            if pending is not None and pending[0] == portfolio.pk:
+                _, cash, positions, count = pending
+                pending = next(replayed, None)
+
+            state = {
+                'portfolio': portfolio,
+                'balance': initial_balance + cash,
+                'reserved_balance': reserved_cash.get(portfolio.pk, ZERO),
+                'positions': positions,
+                'assets': stored_assets.get(portfolio.pk, {}),
+                'reserved': reserved_quantity.get(portfolio.pk, {}),
+                'transactions': count,
+            }
+            state['drifts'] = LedgerService._drifts(state)
+            yield state
+
+    @staticmethod
+    def _drifts(state) -> list:
+        """Расхождения сохранённого состояния портфеля с ожидаемым по журналу."""
+        portfolio = state['portfolio']
+        drifts = []
+
+        def compare(stock_id, field, stored, expected):
+            if stored != expected:
+                drifts.append({'portfolio_id': portfolio.pk, 'stock_id': stock_id, 'field': field, 'stored': stored, 'expected': expected})
+
+        compare(None, 'balance', portfolio.balance, state['balance'])
+        compare(None, 'reserved_balance', portfolio.reserved_balance, state['reserved_balance'])
+        assets, positions, reserved = state['assets'], state['positions'], state['reserved']
+        for stock_id in sorted(set(assets) | set(positions) | set(reserved)):
+            asset = assets.get(stock_id)
+            position = positions.get(stock_id) or LedgerPosition()
+            compare(stock_id, 'quantity', asset.quantity if asset else 0, position.quantity)
+            compare(stock_id, 'reserved_quantity', asset.reserved_quantity if asset else 0, reserved.get(stock_id, 0))
+            # Средняя цена закрытой позиции не имеет значения: строки Asset у неё нет
+            if position.quantity > 0:
+                compare(stock_id, 'average_buy_price', asset.average_buy_price if asset else ZERO, position.average_buy_price)
+        return drifts
+
+    @staticmethod
+    def _repair(states):
+        """Записывает ожидаемое состояние портфелей states и пересчитывает их оценку."""
+        portfolios, to_update, to_create, to_delete = [], [], [], []
+        for state in states:
+            portfolio = state['portfolio']
+            portfolio.balance, portfolio.reserved_balance = state['balance'], state['reserved_balance']
+            portfolios.append(portfolio)
+            assets, positions, reserved = state['assets'], state['positions'], state['reserved']
+            for stock_id in set(assets) | set(positions):
+                asset = assets.get(stock_id)
+                position = positions.get(stock_id) or LedgerPosition()
+                if position.quantity <= 0:
+                    if asset is not None:
+                        to_delete.append(asset.pk)
+                    continue
+                values = (position.quantity, position.average_buy_price, reserved.get(stock_id, 0))
+                if asset is None:
+                    to_create.append(Asset(
+                        portfolio_id=portfolio.pk, stock_id=stock_id,
+                        quantity=values[0], average_buy_price=values[1], reserved_quantity=values[2],
+                    ))
+                elif (asset.quantity, asset.average_buy_price, asset.reserved_quantity) != values:
+                    asset.quantity, asset.average_buy_price, asset.reserved_quantity = values
+                    to_update.append(asset)
+
+        Portfolio.objects.bulk_update(portfolios, ['balance', 'reserved_balance'], batch_size=VALUATION_UPDATE_BATCH_SIZE)
+        Asset.objects.bulk_update(to_update, ['quantity', 'average_buy_price', 'reserved_quantity'], batch_size=VALUATION_UPDATE_BATCH_SIZE)
+        Asset.objects.bulk_create(to_create, batch_size=VALUATION_UPDATE_BATCH_SIZE)
+        Asset.objects.filter(pk__in=to_delete).delete()
+
+        # Позиции поменялись — оценка этих портфелей тоже
+        portfolio_ids = [portfolio.pk for portfolio in portfolios]
+        valuations = ValuationService.recompute(portfolio_ids)
+        Portfolio.objects.bulk_update(
+            [
+                Portfolio(pk=portfolio_id, market_value=market_value, cost_basis=cost_basis)
+                for portfolio_id in portfolio_ids
+                for market_value, cost_basis in [valuations.get(portfolio_id, (ZERO, ZERO))]
+            ],
+            ['market_value', 'cost_basis'], batch_size=VALUATION_UPDATE_BATCH_SIZE,
+        )
+
+    @staticmethod
+    def replay_range(first_id: int, last_id: int, fix: bool = False) -> dict:
+        """
+        Сверяет с журналом портфели с id в [first_id, last_id]; с fix=True исправляет расхождения.
+        Возвращает {'portfolios', 'transactions', 'drifted', 'repaired', 'drifts': [...]},
+        расхождение — {'portfolio_id', 'stock_id', 'field', 'stored', 'expected'}.
+        """
+        report = {'portfolios': 0, 'transactions': 0, 'drifted': 0, 'repaired': 0, 'drifts': []}
+        suspects = []
+        for state in LedgerService._check(first_id, last_id):
+            report['portfolios'] += 1
+            report['transactions'] += state['transactions']
+            if state['drifts']:
+                suspects.append(state['portfolio'].pk)
+        if not suspects:
+            return report
+
+        with write_transaction():
+            drifted = [state for state in LedgerService._check(first_id, last_id, suspects) if state['drifts']]
+            if fix and drifted:
+                LedgerService._repair(drifted)
+                report['repaired'] = len(drifted)
+
+        report['drifted'] = len(drifted)
+        for state in drifted:
+            report['drifts'].extend(state['drifts'])
+        del report['drifts'][LEDGER_MAX_REPORTED:]
+        return report
+
+    @staticmethod
+    def replay_all(fix: bool = False, workers=None, range_size: int = LEDGER_RANGE_SIZE) -> dict:
+        """
+        Сверяет с журналом все портфели в workers процессах (по умолчанию — по числу ядер).
+        Возвращает отчёт replay_range, сложенный по диапазонам, плюс 'ranges' и 'seconds'.
+        """
+        started = time.perf_counter()
+        ranges = LedgerService.ranges(range_size)
+        workers = workers or os.cpu_count() or 1
+        # Процессы воркера Celery (prefork) — демоны и не могут запускать свои
+        if multiprocessing.current_process().daemon:
+            workers = 1
+
+        firsts, lasts = [first for first, _ in ranges], [last for _, last in ranges]
+        if workers > 1 and len(ranges) > 1:
+            # Дочерние процессы открывают свои соединения: унаследованные от родителя не используются
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(LedgerService.replay_range, firsts, lasts, repeat(fix)))
+        else:
+            results = [LedgerService.replay_range(first, last, fix) for first, last in ranges]
+
+        report = {'portfolios': 0, 'transactions': 0, 'drifted': 0, 'repaired': 0, 'drifts': []}
+        for result in results:
+            for key in ('portfolios', 'transactions', 'drifted', 'repaired'):
+                report[key] += result[key]
+            report['drifts'].extend(result['drifts'])
+        del report['drifts'][LEDGER_MAX_REPORTED:]
+        report.update(ranges=len(ranges), seconds=time.perf_counter() - started)
+
+        message = (
+            f"Ledger replay: {report['portfolios']} portfolios, {report['transactions']} transactions "
+            f"in {len(ranges)} ranges on {min(workers, max(len(ranges), 1))} workers, {report['drifted']} drifted, "
+            f"{report['repaired']} repaired in {report['seconds']:.2f}s."
+        )
+        if report['drifted']:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        return report
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+@contextmanager
+def write_transaction(using=None):
+    """
+    transaction.atomic(), который в SQLite сразу берёт блокировку записи (BEGIN IMMEDIATE).
+
+    Для блоков, которые сначала читают, а потом пишут (сделки, заявки, починка данных):
+    в режиме DEFERRED такая транзакция при встречной записи получает "database is locked"
+    сразу, без ожидания timeout, а с IMMEDIATE параллельные писатели ждут в очереди.
+    Остальные atomic(), в том числе только читающие, остаются DEFERRED и друг друга не
+    блокируют. Внутри уже открытой транзакции — обычная точка сохранения.
+    """
+    connection = transaction.get_connection(using)
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    # Режим транзакций соединение читает из настроек при подключении
+    connection.ensure_connection()
+    mode = connection.transaction_mode
+    # BEGIN выполняется при входе во внешний atomic(); режим соединения — только на него
+    connection.transaction_mode = 'IMMEDIATE'
+    try:
+        with transaction.atomic(using=using):
+            connection.transaction_mode = mode
+            yield
+    finally:
+        connection.transaction_mode = mode
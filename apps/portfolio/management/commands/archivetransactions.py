@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from apps.portfolio.archive import ARCHIVE_BATCH_SIZE, ARCHIVE_HORIZON_DAYS, ARCHIVE_PAUSE, TransactionArchiveService
+
+class Command(BaseCommand):
+    help = ('Moves transactions older than the horizon (whole months) into compressed per-month archive '
+            'chunks in small batches. An interrupted run continues where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon-days', type=int, default=ARCHIVE_HORIZON_DAYS, help='Archive transactions older than this.')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Transactions per write transaction.')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches.')
+        parser.add_argument('--pause', type=float, default=ARCHIVE_PAUSE, help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        report = TransactionArchiveService.archive(
+            options['horizon_days'], options['batch_size'], options['max_batches'], options['pause']
+        )
+        state = 'done' if report['done'] else 'more left, run again'
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['archived']} transactions before {report['cutoff']:%Y-%m-%d} archived "
+            f"in {report['batches']} batches ({state}) in {report['seconds']:.2f}s."
+        ))
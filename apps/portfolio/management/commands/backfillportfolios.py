@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from apps.portfolio.services import PORTFOLIO_BACKFILL_BATCH_SIZE, PortfolioService
+
+class Command(BaseCommand):
+    help = ('Creates portfolios for users registered before portfolios were created at sign-up. '
+            'Safe to run repeatedly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PORTFOLIO_BACKFILL_BATCH_SIZE, help='Portfolios per write transaction.')
+
+    def handle(self, *args, **options):
+        created = PortfolioService.create_missing_portfolios(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"{created} portfolios created."))
@@ -0,0 +1,152 @@
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from apps.market.cache import PriceCache
+from apps.market.models import Stock
+from apps.portfolio.models import Portfolio, Asset
+from apps.portfolio.services import PortfolioService, ValuationService
+
+BENCH_TICKER_PREFIX = 'BS'
+
+
+def summary_from_quotes(user) -> dict:
+    """
+    Прежний расчёт сводки: суммы по каждой позиции и итоги в цикле Python по ценам
+    из PriceCache. Эталон для сверки с get_portfolio_summary здесь и в тестах.
+    """
+    portfolio = PortfolioService.get_user_portfolio(user)
+    # Цены, названия и лоты берём из кэша цен, а не из таблицы Stock
+    assets = portfolio.assets.values('stock_id', 'quantity', 'reserved_quantity', 'average_buy_price')
+    quotes = PriceCache.get_quotes_by_id()
+
+    total_market_value = Decimal('0.00')
+    total_cost_basis = Decimal('0.00') # Сколько реально потрачено денег
+    total_profit_loss = Decimal('0.00')
+    asset_details = []
+
+    for asset in assets:
+        stock = quotes.get(asset['stock_id'])
+        if stock is None:
+            # Акции нет в снимке (опубликован до её появления) — публикуем заново
+            PriceCache.publish()
+            quotes = PriceCache.get_quotes_by_id()
+            stock = quotes[asset['stock_id']]
+        market_value = asset['quantity'] * stock['price']
+        cost_basis = asset['quantity'] * asset['average_buy_price']
+        profit_loss = market_value - cost_basis
+
+        # P&L % актива: (P&L / Cost Basis) * 100
+        profit_loss_percent = Decimal('0.00')
+        if cost_basis > 0:
+            profit_loss_percent = (profit_loss / cost_basis) * Decimal('100.00')
+
+        total_market_value += market_value
+        total_cost_basis += cost_basis
+        total_profit_loss += profit_loss
+
+        asset_details.append({
+            'ticker': stock['ticker'],
+            'name': stock['name'],
+            'quantity': asset['quantity'],
+            'reserved_quantity': asset['reserved_quantity'],
+            'current_price': stock['price'],
+            'average_buy_price': asset['average_buy_price'],
+            'market_value': market_value,
+            'profit_loss': profit_loss,
+            'profit_loss_percent': profit_loss_percent,
+            'lot_size': stock['lot_size'],
+        })
+
+    total_profit_loss_percent = Decimal('0.00')
+    if total_cost_basis > 0:
+        total_profit_loss_percent = (total_profit_loss / total_cost_basis) * Decimal('100.00')
+
+    return {
+        'balance': portfolio.balance,
+        'reserved_balance': portfolio.reserved_balance,
+        'total_market_value': total_market_value,
+        'total_cost_basis': total_cost_basis,
+        'net_worth': portfolio.balance + total_market_value,
+        'total_profit_loss': total_profit_loss,
+        'total_profit_loss_percent': total_profit_loss_percent,
+        'assets': asset_details,
+    }
+
+class Command(BaseCommand):
+    help = ('Benchmarks get_portfolio_summary (DB aggregation) against the legacy Python loop '
+            'on synthetic portfolios. Everything it creates is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,50,500', help='Comma-separated portfolio sizes (positions).')
+        parser.add_argument('--repeat', type=int, default=50, help='Calls per path and size.')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for prices and positions.')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            stocks = Stock.objects.bulk_create([
+                Stock(
+                    ticker=f"{BENCH_TICKER_PREFIX}{i:04d}",
+                    name=f"Bench {i}",
+                    current_price=Decimal(rng.randint(1, 500_000)) / 100,
+                    lot_size=rng.choice([1, 10, 100]),
+                )
+                for i in range(max(sizes))
+            ])
+            user = get_user_model().objects.create_user(username=f"benchsummary-{time.time_ns()}")
+            portfolio = Portfolio.objects.get(user=user)  # создан при регистрации
+            PriceCache.publish()
+
+            self.stdout.write(f"{'positions':>9} | {'path':<8} | {'ms/call':>8} | {'queries':>7} | {'peak KiB':>8}")
+            for size in sizes:
+                Asset.objects.filter(portfolio=portfolio).delete()
+                Asset.objects.bulk_create([
+                    Asset(
+                        portfolio=portfolio,
+                        stock=stock,
+                        quantity=rng.randint(1, 1000),
+                        average_buy_price=Decimal(rng.randint(1, 500_000)) / 100,
+                    )
+                    for stock in stocks[:size]
+                ])
+                # Позиции созданы в обход сделок — материализуем их оценку
+                market_value, cost_basis = ValuationService.recompute([portfolio.pk])[portfolio.pk]
+                Portfolio.objects.filter(pk=portfolio.pk).update(market_value=market_value, cost_basis=cost_basis)
+
+                results = {}
+                for path, func in (('db', PortfolioService.get_portfolio_summary),
+                                   ('python', summary_from_quotes)):
+                    results[path] = func(user)
+
+                    with CaptureQueriesContext(connection) as queries:
+                        func(user)
+                    tracemalloc.start()
+                    func(user)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                    started = time.perf_counter()
+                    for _ in range(options['repeat']):
+                        func(user)
+                    elapsed = (time.perf_counter() - started) / options['repeat']
+
+                    self.stdout.write(
+                        f"{size:>9} | {path:<8} | {elapsed * 1000:>8.3f} | {len(queries):>7} | {peak / 1024:>8.1f}"
+                    )
+
+                if results['db'] != results['python']:
+                    self.stderr.write(self.style.ERROR(f"{size} positions: summaries differ"))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f"{size} positions: summaries match to the kopeck"))
+
+            transaction.set_rollback(True)
+
+        # Снимок цен публиковался с тестовыми акциями — публикуем заново
+        PriceCache.publish()
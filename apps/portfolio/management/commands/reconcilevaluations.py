@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from apps.portfolio.services import ValuationService
+
+class Command(BaseCommand):
+    help = ('Verifies materialized portfolio valuations (market value, cost basis) '
+            'against a full recompute from positions and current prices.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite mismatched valuations with recomputed values.')
+        parser.add_argument('--show', type=int, default=20, help='How many mismatches to print.')
+
+    def handle(self, *args, **options):
+        report = ValuationService.reconcile(fix=options['fix'])
+
+        for portfolio_id, stored, actual in report['mismatches'][:options['show']]:
+            self.stdout.write(
+                f"portfolio {portfolio_id}: stored market={stored[0]} cost={stored[1]}, "
+                f"recomputed market={actual[0]} cost={actual[1]}"
+            )
+
+        summary = f"{report['checked']} portfolios checked, {report['mismatched']} mismatched, {report['fixed']} fixed."
+        if report['mismatched'] and not report['fixed']:
+            self.stderr.write(self.style.ERROR(summary))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
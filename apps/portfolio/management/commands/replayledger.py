@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from apps.portfolio.ledger import LEDGER_RANGE_SIZE, LedgerService
+
+class Command(BaseCommand):
+    help = ('Replays the transaction ledger of every portfolio and compares balances, positions '
+            'and order reservations with the stored state. Runs portfolio id ranges in parallel.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite drifted state with the replayed ledger.')
+        parser.add_argument('--workers', type=int, help='Worker processes, one per CPU core by default.')
+        parser.add_argument('--range-size', type=int, default=LEDGER_RANGE_SIZE, help='Portfolios per worker step.')
+        parser.add_argument('--show', type=int, default=20, help='How many drifts to print.')
+
+    def handle(self, *args, **options):
+        report = LedgerService.replay_all(fix=options['fix'], workers=options['workers'], range_size=options['range_size'])
+
+        for drift in report['drifts'][:options['show']]:
+            position = f" stock {drift['stock_id']}" if drift['stock_id'] is not None else ''
+            self.stdout.write(
+                f"portfolio {drift['portfolio_id']}{position}: {drift['field']} "
+                f"stored={drift['stored']} ledger={drift['expected']}"
+            )
+
+        summary = (
+            f"{report['portfolios']} portfolios, {report['transactions']} transactions replayed in "
+            f"{report['seconds']:.2f}s: {report['drifted']} drifted, {report['repaired']} repaired."
+        )
+        if report['drifted'] and not report['repaired']:
+            self.stderr.write(self.style.ERROR(summary))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
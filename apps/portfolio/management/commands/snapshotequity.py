@@ -0,0 +1,18 @@
+from datetime import date
+from django.core.management.base import BaseCommand
+from apps.portfolio.equity import EQUITY_SNAPSHOT_CHUNK_SIZE, EquitySnapshotService
+
+class Command(BaseCommand):
+    help = ('Snapshots balance, market value and positions of every portfolio for a date. '
+            'Re-running for the same date only adds the missing snapshots.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help='Snapshot date (YYYY-MM-DD), today by default.')
+        parser.add_argument('--chunk-size', type=int, default=EQUITY_SNAPSHOT_CHUNK_SIZE, help='Portfolios per step.')
+
+    def handle(self, *args, **options):
+        report = EquitySnapshotService.snapshot_all(options['date'], options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['date']}: {report['created']} snapshots created "
+            f"(resumed after portfolio {report['resumed_after']}) in {report['seconds']:.2f}s."
+        ))
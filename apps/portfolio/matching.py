@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+from apps.market.cache import PriceCache
+from .models import Order
+from .services import OrderService
+
+logger = logging.getLogger(__name__)
+
+# Раз в сколько секунд книги собираются из базы заново: убирает отменённые заявки
+# и подхватывает заявки, закоммиченные не в порядке id
+ORDER_BOOK_RESYNC_SECONDS = 5 * 60
+# Сколько сработавших заявок исполнять одной транзакцией
+ORDER_EXECUTION_BATCH_SIZE = 500
+# Размер пачки при чтении открытых заявок из базы
+ORDER_LOAD_CHUNK_SIZE = 2000
+
+
+class TriggerBook:
+    """
+    Пороги срабатывания одной стороны книги тикера в отсортированном массиве.
+
+    Срабатывают все записи с ключом >= порога — это всегда хвост массива, поэтому
+    поиск делается через bisect, а сработавшие записи снимаются срезом хвоста:
+    O(log n + k), где k — число сработавших заявок, а не всех заявок в книге.
+    """
+
+    __slots__ = ('keys', 'ids')
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, order_id):
+        """Одна заявка: вставка в массив, O(n) — только для одиночных добавлений."""
+        index = bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.ids.insert(index, order_id)
+
+    def extend(self, entries):
+        """
+        Пачка (ключ, id) одной сортировкой: сборка книги из базы — O(n log n),
+        а не O(n²) на поэлементных вставках. Сортировка устойчива, поэтому при равных
+        ключах заявки, как и в add, остаются в порядке добавления.
+        """
+        if len(entries) == 1:
+            self.add(*entries[0])
+            return
+        merged = list(zip(self.keys, self.ids))
+        merged.extend(entries)
+        merged.sort(key=itemgetter(0))
+        self.keys = [key for key, _ in merged]
+        self.ids = [order_id for _, order_id in merged]
+
+    def pop_triggered(self, threshold) -> list:
+        index = bisect_left(self.keys, threshold)
+        triggered = self.ids[index:]
+        del self.keys[index:]
+        del self.ids[index:]
+        return triggered
+
+
+class MatchingEngine:
+    """
+    Движок отложенных заявок: по две книги TriggerBook на акцию.
+
+    "Ниже" — заявки, срабатывающие при цене <= порога (лимитная покупка, стоп на продажу),
+    ключ — сама цена срабатывания. "Выше" — при цене >= порога (лимитная продажа,
+    стоп на покупку), ключ — цена со знаком минус, чтобы сработавшие тоже были хвостом.
+
+    Книги живут в памяти процесса, который применяет цены (Celery, simulatemarket),
+    и догружаются из базы по id; полная пересборка — раз в ORDER_BOOK_RESYNC_SECONDS.
+    Отменённые заявки остаются в книге до срабатывания или пересборки и отбрасываются
+    при исполнении (OrderService.execute_orders берёт только активные).
+    """
+
+    BELOW_TYPES = {('BUY', Order.TYPE_LIMIT), ('SELL', Order.TYPE_STOP)}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Сбрасывает книги: при следующем прогоне они соберутся из базы заново."""
+        self._books = {}
+        self._last_order_id = 0
+        self._synced_at = None
+
+    def __len__(self):
+        return sum(len(below) + len(above) for below, above in self._books.values())
+
+    def add(self, order_id, stock_id, action, order_type, trigger_price):
+        below, above = self._books.setdefault(stock_id, (TriggerBook(), TriggerBook()))
+        if (action, order_type) in self.BELOW_TYPES:
+            below.add(trigger_price, order_id)
+        else:
+            above.add(-trigger_price, order_id)
+
+    def _extend(self, stock_id, below_entries, above_entries):
+        below, above = self._books.setdefault(stock_id, (TriggerBook(), TriggerBook()))
+        if below_entries:
+            below.extend(below_entries)
+        if above_entries:
+            above.extend(above_entries)
+
+    def match(self, prices: dict) -> list:
+        """Снимает с книг и возвращает id заявок, сработавших при ценах prices (stock_id -> цена)."""
+        triggered = []
+        for stock_id, price in prices.items():
+            books = self._books.get(stock_id)
+            if books is None:
+                continue
+            below, above = books
+            triggered.extend(below.pop_triggered(price))
+            triggered.extend(above.pop_triggered(-price))
+        return triggered
+
+    def _sync(self) -> set:
+        """Догружает новые открытые заявки; возвращает id акций, по которым они появились."""
+        if self._synced_at is None or time.monotonic() - self._synced_at > ORDER_BOOK_RESYNC_SECONDS:
+            self.reset()
+            self._synced_at = time.monotonic()
+
+        rows = (
+            Order.objects.filter(status=Order.STATUS_OPEN, id__gt=self._last_order_id)
+            .order_by('id')
+            .values_list('id', 'stock_id', 'action', 'order_type', 'trigger_price')
+        )
+        # Заявки копятся по книгам и встают в них одной сортировкой на книгу
+        loaded = {}  # stock_id -> ([(ключ, id) ниже], [(ключ, id) выше])
+        for order_id, stock_id, action, order_type, trigger_price in rows.iterator(chunk_size=ORDER_LOAD_CHUNK_SIZE):
+            below, above = loaded.setdefault(stock_id, ([], []))
+            if (action, order_type) in self.BELOW_TYPES:
+                below.append((trigger_price, order_id))
+            else:
+                above.append((-trigger_price, order_id))
+            self._last_order_id = order_id
+        for stock_id, (below, above) in loaded.items():
+            self._extend(stock_id, below, above)
+        return set(loaded)
+
+    def run(self, changes) -> dict:
+        """
+        Прогон после обновления цен: сверяет книги с новыми ценами из changes и
+        исполняет сработавшие заявки. Новые заявки сверяются и с текущей ценой —
+        они могли быть исполнимы уже в момент размещения.
+        """
+        report = {'triggered': 0, 'filled': 0, 'rejected': 0, 'skipped': 0}
+        with self._lock:
+            new_stock_ids = self._sync()
+            prices = {change['stock_id']: change['price'] for change in changes}
+            missing = new_stock_ids - prices.keys()
+            if missing:
+                quotes = PriceCache.get_quotes_by_id()
+                prices.update(
+                    (stock_id, quotes[stock_id]['price'])
+                    for stock_id in missing
+                    if stock_id in quotes and quotes[stock_id]['price']
+                )
+            triggered = self.match(prices)
+
+        report['triggered'] = len(triggered)
+        for start in range(0, len(triggered), ORDER_EXECUTION_BATCH_SIZE):
+            batch = triggered[start:start + ORDER_EXECUTION_BATCH_SIZE]
+            try:
+                result = OrderService.execute_orders(batch, prices)
+            except Exception as e:
+                # Снятые с книги заявки вернутся при пересборке
+                logger.error(f"Order execution failed for {len(batch)} orders: {e}")
+                with self._lock:
+                    self._synced_at = None
+                continue
+            for key, value in result.items():
+                report[key] += value
+
+        if triggered:
+            logger.info(
+                f"Orders matched: triggered={report['triggered']}, filled={report['filled']}, "
+                f"rejected={report['rejected']}, skipped={report['skipped']}."
+            )
+        return report
+
+
+# Один движок на процесс
+engine = MatchingEngine()
+
+
+def on_prices_updated(sender, changes, **kwargs):
+    """Подписчик сигнала apps.market.signals.prices_updated."""
+    return engine.run(changes)
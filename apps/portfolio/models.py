@@ -1,6 +1,7 @@
 from decimal import Decimal
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from apps.market.models import Stock
 
 # Кошелек пользователя.
@@ -17,10 +18,44 @@ class Portfolio(models.Model):
         default=Decimal('100000.00'),
         verbose_name="Баланс (RUB)"
     )
+    # Оценка позиций, поддерживается инкрементально (ValuationService):
+    # сделки меняют её сразу, обновление цен — на Δцены × количество.
+    # Сверка с полным пересчётом: manage.py reconcilevaluations
+    market_value = models.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        default=Decimal('0.00'),
+        verbose_name="Стоимость акций (RUB)"
+    )
+    cost_basis = models.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        default=Decimal('0.00'),
+        verbose_name="Себестоимость акций (RUB)"
+    )
+    # Чистая стоимость (баланс + акции) для рейтинга игроков: хранимая вычисляемая колонка,
+    # база пересчитывает её и индекс portfolio_net_worth_idx при каждой записи строки
+    net_worth = models.GeneratedField(
+        expression=models.F('balance') + models.F('market_value'),
+        output_field=models.DecimalField(max_digits=16, decimal_places=2),
+        db_persist=True,
+        verbose_name="Чистая стоимость (RUB)"
+    )
+    # Часть баланса, заблокированная под открытые заявки на покупку (Order)
+    reserved_balance = models.DecimalField(
+        max_digits=14,
+        decimal_places=2,
+        default=Decimal('0.00'),
+        verbose_name="Зарезервировано (RUB)"
+    )
 
     class Meta:
         verbose_name = 'портфель'
         verbose_name_plural = 'портфели'
+        indexes = [
+            # Рейтинг: страницы по ключу (net_worth, id) и соседи игрока — диапазоны индекса
+            models.Index(fields=['-net_worth', 'id'], name='portfolio_net_worth_idx'),
+        ]
 
     def __str__(self):
         return f"Портфель {self.user.username}"
@@ -38,6 +73,8 @@ class Asset(models.Model):
         default=0.00,
         verbose_name="Средняя цена покупки"
     )
+    # Сколько акций заблокировано под открытые заявки на продажу (Order)
+    reserved_quantity = models.PositiveIntegerField(default=0, verbose_name="Зарезервировано акций")
 
     class Meta:
         unique_together = ('portfolio', 'stock') # Одна запись на один тикер в портфеле
@@ -64,7 +101,158 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = 'транзакция'
         verbose_name_plural = 'транзакции'
+        indexes = [
+            # История портфеля от новых к старым, страницы по ключу (timestamp, id)
+            models.Index(fields=['portfolio', '-timestamp', '-id'], name='portfolio_tx_history_idx'),
+        ]
+
+
+    def __str__(self):
+        return f"{self.action} {self.stock.ticker} x {self.quantity}"
+
+# Отложенная заявка: лимитная или стоп, исполняется движком apps.portfolio.matching.
+class Order(models.Model):
+    ACTION_CHOICES = Transaction.ACTION_CHOICES
+
+    TYPE_LIMIT = 'LIMIT'
+    TYPE_STOP = 'STOP'
+    TYPE_CHOICES = (
+        (TYPE_LIMIT, 'Лимитная'),
+        (TYPE_STOP, 'Стоп'),
+    )
+
+    STATUS_OPEN = 'OPEN'
+    STATUS_FILLED = 'FILLED'
+    STATUS_CANCELLED = 'CANCELLED'
+    STATUS_REJECTED = 'REJECTED'
+    STATUS_CHOICES = (
+        (STATUS_OPEN, 'Активна'),
+        (STATUS_FILLED, 'Исполнена'),
+        (STATUS_CANCELLED, 'Отменена'),
+        (STATUS_REJECTED, 'Отклонена'),
+    )
+
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='orders')
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='orders')
+    action = models.CharField(max_length=4, choices=ACTION_CHOICES)
+    order_type = models.CharField(max_length=5, choices=TYPE_CHOICES, verbose_name="Тип заявки")
+    quantity = models.PositiveIntegerField()
+    # Лимит: покупка при цене <= trigger_price, продажа при цене >= trigger_price.
+    # Стоп: покупка при цене >= trigger_price, продажа при цене <= trigger_price.
+    trigger_price = models.DecimalField(max_digits=14, decimal_places=2, verbose_name="Цена срабатывания")
+    # Деньги, заблокированные под покупку (цена срабатывания * количество + комиссия)
+    reserved_cash = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'), verbose_name="Резерв (RUB)")
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    fill_price = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True, verbose_name="Цена исполнения")
+    created_at = models.DateTimeField(auto_now_add=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'заявка'
+        verbose_name_plural = 'заявки'
+        indexes = [
+            # Движок догружает новые открытые заявки по id
+            models.Index(fields=['id'], condition=models.Q(status='OPEN'), name='portfolio_order_open_idx'),
+            models.Index(fields=['portfolio', 'status'], name='portfolio_order_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.order_type} {self.action} {self.stock.ticker} x {self.quantity} @ {self.trigger_price}"
 
 
+# Ответ на запрос сделки с заголовком Idempotency-Key (см. apps.portfolio.idempotency).
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # Хэш метода, пути и тела запроса: тот же ключ с другим запросом — ошибка клиента
+    fingerprint = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = 'ключ идемпотентности'
+        verbose_name_plural = 'ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='portfolio_idempotency_user_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key}"
+
+
+# Капитал портфеля на конец дня (см. apps.portfolio.equity): точки кривой капитала.
+class EquitySnapshot(models.Model):
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='equity_snapshots')
+    date = models.DateField()
+    balance = models.DecimalField(max_digits=14, decimal_places=2, verbose_name="Баланс (RUB)")
+    market_value = models.DecimalField(max_digits=16, decimal_places=2, verbose_name="Стоимость акций (RUB)")
+    net_worth = models.DecimalField(max_digits=16, decimal_places=2, verbose_name="Чистая стоимость (RUB)")
+    # Позиции на момент снимка: тикер -> количество
+    positions = models.JSONField(default=dict)
+
+    class Meta:
+        verbose_name = 'снимок капитала'
+        verbose_name_plural = 'снимки капитала'
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'date'], name='portfolio_equity_portfolio_date_uniq'),
+        ]
+        indexes = [
+            # Продолжение прерванного прогона: последний портфель, снятый на дату
+            models.Index(fields=['date', 'portfolio'], name='portfolio_equity_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio_id} {self.date}: {self.net_worth}"
+
+
+# Транзакции портфеля за месяц, перенесённые в архив (см. apps.portfolio.archive): сжатые строки.
+class TransactionArchive(models.Model):
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='transaction_archives')
+    # Первое число месяца (по локальному времени)
+    month = models.DateField()
+    transactions = models.PositiveIntegerField(default=0, verbose_name="Транзакций")
+    first_id = models.PositiveBigIntegerField()
+    last_id = models.PositiveBigIntegerField()
+    # zlib(JSON по столбцам): id, stock_id, ticker, action, quantity, price, commission, timestamp
+    data = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'архив транзакций'
+        verbose_name_plural = 'архив транзакций'
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'month'], name='portfolio_tx_archive_month_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio_id} {self.month:%Y-%m}: {self.transactions}"
+
+
+# Итог архивированных транзакций по позиции: с него сверка с журналом (LedgerService)
+# продолжает проигрывать оставшиеся транзакции.
+class ArchivedPosition(models.Model):
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='archived_positions')
+    # NULL — акцию удалили из справочника: учитываются только деньги
+    stock = models.ForeignKey(Stock, on_delete=models.SET_NULL, null=True)
+    transactions = models.PositiveIntegerField(default=0, verbose_name="Транзакций")
+    bought_quantity = models.PositiveBigIntegerField(default=0, verbose_name="Куплено акций")
+    sold_quantity = models.PositiveBigIntegerField(default=0, verbose_name="Продано акций")
+    buy_amount = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal('0.00'), verbose_name="Сумма покупок")
+    sell_amount = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal('0.00'), verbose_name="Сумма продаж")
+    commission = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'), verbose_name="Комиссия")
+    # Позиция после последней архивированной транзакции
+    quantity = models.PositiveIntegerField(default=0, verbose_name="Количество акций")
+    average_buy_price = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'), verbose_name="Средняя цена покупки")
+    last_transaction_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'архивная позиция'
+        verbose_name_plural = 'архивные позиции'
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'stock'], name='portfolio_archived_position_uniq'),
+        ]
+
     def __str__(self):
-        return f"{self.action} {self.stock.ticker} x {self.quantity}"
\ No newline at end of file
+        return f"{self.portfolio_id} {self.stock_id}: {self.quantity} @ {self.average_buy_price}"
@@ -1,4 +1,12 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.utils import timezone
 from rest_framework import serializers
+from .models import Order
+from .services import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, PortfolioService
+from .analytics import ANALYTICS_DAYS, ANALYTICS_MIN_DAYS, ANALYTICS_MAX_DAYS
+from .equity import EQUITY_CURVE_DAYS, EQUITY_CURVE_MAX_DAYS
+from .leaderboard import LEADERBOARD_PAGE_SIZE, LEADERBOARD_MAX_PAGE_SIZE, LEADERBOARD_AROUND, LEADERBOARD_MAX_AROUND, LeaderboardService
 
 class TradeSerializer(serializers.Serializer):
     """Сериализатор для валидации данных при покупке/продаже."""
@@ -23,4 +31,141 @@ class TradeSerializer(serializers.Serializer):
         """Проверяет, что количество является положительным."""
         if value <= 0:
             raise serializers.ValidationError("Количество акций должно быть положительным числом.")
-        return value
\ No newline at end of file
+        return value
+
+# Максимум заявок в одном пакете (/api/portfolio/trade/batch/)
+BATCH_MAX_LEGS = 50
+
+
+class BatchLegSerializer(TradeSerializer):
+    """Одна заявка пакета: покупка или продажа."""
+
+    action = serializers.ChoiceField(
+        choices=(('BUY', 'Покупка'), ('SELL', 'Продажа')),
+        error_messages={'invalid_choice': 'Действие должно быть BUY или SELL.'}
+    )
+
+    def to_internal_value(self, data):
+        # Принимаем и "buy"/"sell" в нижнем регистре
+        if isinstance(data, dict) and isinstance(data.get('action'), str):
+            data = {**data, 'action': data['action'].upper()}
+        return super().to_internal_value(data)
+
+
+class BatchTradeSerializer(serializers.Serializer):
+    """Пакет заявок и режим исполнения."""
+
+    MODE_ALL_OR_NOTHING = 'all_or_nothing'
+    MODE_BEST_EFFORT = 'best_effort'
+
+    legs = BatchLegSerializer(
+        many=True,
+        allow_empty=False,
+        max_length=BATCH_MAX_LEGS,
+        error_messages={'empty': 'Пакет не содержит заявок.'}
+    )
+    mode = serializers.ChoiceField(
+        choices=(
+            (MODE_ALL_OR_NOTHING, 'Всё или ничего'),
+            (MODE_BEST_EFFORT, 'Исполнить то, что возможно'),
+        ),
+        default=MODE_ALL_OR_NOTHING
+    )
+
+
+class OrderCreateSerializer(BatchLegSerializer):
+    """Отложенная заявка: лимитная или стоп."""
+
+    order_type = serializers.ChoiceField(
+        choices=Order.TYPE_CHOICES,
+        error_messages={'invalid_choice': 'Тип заявки должен быть LIMIT или STOP.'}
+    )
+    trigger_price = serializers.DecimalField(max_digits=14, decimal_places=2, min_value=Decimal('0.01'))
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict) and isinstance(data.get('order_type'), str):
+            data = {**data, 'order_type': data['order_type'].upper()}
+        return super().to_internal_value(data)
+
+
+class OrderSerializer(serializers.ModelSerializer):
+    """Заявка для списка заявок пользователя."""
+
+    ticker = serializers.CharField(source='stock.ticker', read_only=True)
+
+    class Meta:
+        model = Order
+        fields = [
+            'id', 'ticker', 'action', 'order_type', 'quantity', 'trigger_price',
+            'reserved_cash', 'status', 'fill_price', 'created_at', 'closed_at',
+        ]
+
+
+class LeaderboardQuerySerializer(serializers.Serializer):
+    """Параметры /api/portfolio/leaderboard/: размер страницы, курсор и число соседей."""
+
+    limit = serializers.IntegerField(min_value=1, max_value=LEADERBOARD_MAX_PAGE_SIZE, default=LEADERBOARD_PAGE_SIZE)
+    cursor = serializers.CharField(required=False)
+    around = serializers.IntegerField(min_value=0, max_value=LEADERBOARD_MAX_AROUND, default=LEADERBOARD_AROUND)
+
+    def validate_cursor(self, value):
+        try:
+            return LeaderboardService.decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Некорректный курсор страницы.")
+
+
+class TransactionHistoryQuerySerializer(serializers.Serializer):
+    """
+    Параметры истории транзакций: фильтры по тикеру, действию и датам
+    (date_to включительно), размер страницы и курсор следующей страницы.
+    """
+
+    EXPORT_CSV = 'csv'
+    EXPORT_NDJSON = 'ndjson'
+
+    ticker = serializers.CharField(max_length=10, required=False)
+    action = serializers.ChoiceField(choices=(('BUY', 'Покупка'), ('SELL', 'Продажа')), required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=HISTORY_MAX_PAGE_SIZE, default=HISTORY_PAGE_SIZE)
+    cursor = serializers.CharField(required=False)
+    # Формат выгрузки (history/export/); параметр format занят DRF
+    type = serializers.ChoiceField(choices=((EXPORT_CSV, 'CSV'), (EXPORT_NDJSON, 'NDJSON')), default=EXPORT_CSV)
+
+    def to_internal_value(self, data):
+        data = {key: data[key] for key in data}
+        for key in ('ticker', 'action'):
+            if isinstance(data.get(key), str):
+                data[key] = data[key].upper()
+        return super().to_internal_value(data)
+
+    def validate_cursor(self, value):
+        try:
+            return PortfolioService.decode_history_cursor(value)
+        except (ValueError, OverflowError):
+            raise serializers.ValidationError("Некорректный курсор страницы.")
+
+    def validate(self, attrs):
+        # Границы дат — начало дня в текущем часовом поясе: фильтр идёт по индексу времени
+        if 'date_from' in attrs:
+            attrs['date_from'] = timezone.make_aware(datetime.combine(attrs['date_from'], time.min))
+        if 'date_to' in attrs:
+            attrs['date_to'] = timezone.make_aware(datetime.combine(attrs['date_to'] + timedelta(days=1), time.min))
+        return attrs
+
+    @property
+    def filters(self) -> dict:
+        return {key: self.validated_data.get(key) for key in ('ticker', 'action', 'date_from', 'date_to')}
+
+
+class EquityCurveQuerySerializer(serializers.Serializer):
+    """Параметры /api/portfolio/equity/: глубина кривой капитала в днях."""
+
+    days = serializers.IntegerField(min_value=1, max_value=EQUITY_CURVE_MAX_DAYS, default=EQUITY_CURVE_DAYS)
+
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    """Параметры /api/portfolio/analytics/: период истории цен в днях."""
+
+    days = serializers.IntegerField(min_value=ANALYTICS_MIN_DAYS, max_value=ANALYTICS_MAX_DAYS, default=ANALYTICS_DAYS)
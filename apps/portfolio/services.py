@@ -1,35 +1,202 @@
-from decimal import Decimal
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import islice
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, FloatField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Round
 from django.shortcuts import get_object_or_404
-from apps.portfolio.models import Portfolio, Asset, Transaction
+from django.utils import timezone
+from apps.portfolio.models import Portfolio, Asset, Transaction, Order
 from apps.market.models import Stock
+from apps.market.cache import PriceCache
+from apps.portfolio.archive import TransactionArchiveService
+from apps.portfolio.leaderboard import RankSnapshot
+from apps.portfolio.locking import write_transaction
 import logging
 
 logger = logging.getLogger(__name__)
 
 COMMISSION_RATE = Decimal('0.001')  # 0.1%
+KOPECK = Decimal('0.01')
+# Поле результата для денежных сумм сводки, посчитанных в базе: копейки, с запасом разрядов
+SUMMARY_MONEY_FIELD = DecimalField(max_digits=20, decimal_places=2)
+# Колонки строки PortfolioService._summary_queryset
+SUMMARY_COLUMNS = (
+    'stock__ticker', 'stock__name', 'quantity', 'reserved_quantity', 'average_buy_price',
+    'stock__current_price', 'stock__lot_size', 'market_value', 'cost_basis',
+    'portfolio__market_value', 'portfolio__cost_basis', 'portfolio__balance', 'portfolio__reserved_balance',
+)
+# Колонки оценки портфеля (одна строка Portfolio) для сводки без позиций
+VALUATION_COLUMNS = ('market_value', 'cost_basis', 'balance', 'reserved_balance')
+# История транзакций: размер страницы по умолчанию и максимальный, размер части выгрузки
+# Сколько портфелей создавать за одну транзакцию в manage.py backfillportfolios
+PORTFOLIO_BACKFILL_BATCH_SIZE = 1000
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+HISTORY_EXPORT_CHUNK_SIZE = 2000
+# Колонки строки PortfolioService.history_queryset; курсор — из последней (время) и первой (id)
+HISTORY_COLUMNS = ('id', 'action', 'stock__ticker', 'quantity', 'price', 'commission', 'timestamp')
+HISTORY_EXPORT_FIELDS = ('id', 'timestamp', 'action', 'ticker', 'quantity', 'price', 'total', 'commission')
+HISTORY_ACTION_LABELS = dict(Transaction.ACTION_CHOICES)
+HISTORY_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Сколько акций с изменившейся ценой брать в один запрос позиций при переоценке
+VALUATION_STOCK_CHUNK_SIZE = 500
+# Размер пачки bulk_update переоценённых портфелей
+VALUATION_UPDATE_BATCH_SIZE = 500
+# Оценка портфеля без позиций: (market_value, cost_basis)
+VALUATION_ZERO = (Decimal('0.00'), Decimal('0.00'))
+
+
+def to_kopecks(amount: Decimal) -> Decimal:
+    """Округляет сумму до копеек (комиссия списывается и хранится с точностью до копейки)."""
+    return amount.quantize(KOPECK, rounding=ROUND_HALF_UP)
+
 
 class PortfolioService:
 
     @staticmethod
     def get_user_portfolio(user) -> Portfolio:
-        """Получает или создает портфель пользователя."""
-        # Используем get_or_create, чтобы гарантировать существование портфеля
+        """
+        Читает портфель пользователя целиком — для путей, которым нужны баланс и резервы.
+        Портфель создаётся при регистрации (on_user_created); get_or_create остаётся
+        для пользователей, которых ещё не обошёл manage.py backfillportfolios.
+        """
         # (Начальный капитал 100000.00, как указано в модели)
         return Portfolio.objects.get_or_create(user=user)[0]
 
     @staticmethod
-    @transaction.atomic
+    def resolve_portfolio(user) -> Portfolio:
+        """
+        Портфель пользователя без запроса к базе, когда известен его id: аутентификация
+        (CachedTokenAuthentication) кэширует его вместе с пользователем в user.portfolio_id.
+        Загружен только id, остальные поля отложены — обращение к balance прочитает его
+        из базы, устаревший баланс из кэша в расчёт не попадает. Если id неизвестен —
+        один запрос, и id запоминается на пользователе запроса.
+        """
+        portfolio_id = getattr(user, 'portfolio_id', None)
+        if portfolio_id is None:
+            portfolio_id = user.portfolio_id = PortfolioService.get_user_portfolio(user).pk
+        return Portfolio.from_db(Portfolio.objects.db, ['id', 'user_id'], [portfolio_id, user.pk])
+
+    @staticmethod
+    def create_missing_portfolios(batch_size: int = PORTFOLIO_BACKFILL_BATCH_SIZE) -> int:
+        """Создаёт портфели пользователям, у которых их нет (зарегистрированы до on_user_created). Возвращает их число."""
+        User = get_user_model()
+        created = 0
+        while True:
+            user_ids = list(User.objects.filter(portfolio__isnull=True).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not user_ids:
+                break
+            with transaction.atomic():
+                Portfolio.objects.bulk_create([Portfolio(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+            created += len(user_ids)
+        logger.info(f"Portfolios backfilled: {created}.")
+        return created
+
+    @staticmethod
+    def get_quote(ticker_symbol: str) -> dict:
+        """
+        Возвращает котировку для сделки: id акции, цену и размер лота.
+
+        Правило согласованности: сделка исполняется по цене из общего снимка PriceCache,
+        версия которого сверяется с общим кэшем при каждом чтении, то есть по цене
+        последнего завершённого прогона обновления цен. Таблица Stock перечитывается,
+        только если тикера нет в снимке (бумага ещё не опубликована) или снимок устарел:
+        обновление цен не отмечалось дольше PRICE_CACHE_MAX_AGE, и кэш мог пропустить
+        изменения. Если акции нет и в базе — Http404.
+        """
+        ticker_symbol = ticker_symbol.upper()
+        quote = PriceCache.get_fresh_quote(ticker_symbol)
+        if quote is not None:
+            return quote
+
+        stock = get_object_or_404(Stock, ticker=ticker_symbol)
+        return PortfolioService._stock_quote(stock)
+
+    @staticmethod
+    def _stock_quote(stock) -> dict:
+        """Котировка в формате снимка PriceCache, собранная из строки Stock."""
+        return {
+            'id': stock.id,
+            'ticker': stock.ticker,
+            'name': stock.name,
+            'price': stock.current_price,
+            'lot_size': stock.lot_size,
+            'updated_at': stock.updated_at,
+        }
+
+    @staticmethod
+    def get_quotes(tickers) -> dict:
+        """
+        Котировки для нескольких тикеров: ticker -> котировка (как get_quote).
+        Правило то же: свежий снимок PriceCache, а чего в нём нет — одним запросом из Stock.
+        Неизвестных тикеров в результате нет.
+        """
+        tickers = {ticker.upper() for ticker in tickers}
+        quotes = {}
+        if PriceCache.is_fresh():
+            stocks = PriceCache.get_snapshot()['stocks']
+            quotes = {ticker: stocks[ticker] for ticker in tickers if ticker in stocks}
+
+        missing = tickers - quotes.keys()
+        if missing:
+            for stock in Stock.objects.filter(ticker__in=missing):
+                quotes[stock.ticker] = PortfolioService._stock_quote(stock)
+        return quotes
+
+    @staticmethod
+    def _portfolio_ref(user) -> Subquery:
+        """id портфеля пользователя как подзапрос: подставляется в INSERT/UPDATE без отдельного SELECT."""
+        return Subquery(Portfolio.objects.filter(user=user).values('id')[:1])
+
+    @staticmethod
+    def _queue_rank_delta(user, change: Decimal):
+        """
+        Изменение чистой стоимости портфеля пользователя — в снимок рейтинга после коммита.
+        id портфеля обычно известен из аутентификации; если нет, он ищется уже после
+        коммита, а не под блокировкой записи.
+        """
+        portfolio_id = getattr(user, 'portfolio_id', None)
+        if portfolio_id is not None:
+            RankSnapshot.queue_deltas({portfolio_id: change})
+        else:
+            transaction.on_commit(
+                lambda: RankSnapshot.apply_deltas({PortfolioService.resolve_portfolio(user).pk: change}), robust=True
+            )
+
+    @staticmethod
+    def _average_after_buy(quantity: int, stock_cost: Decimal):
+        """
+        Новая средняя цена позиции после покупки — выражение над полями Asset.
+        Взвешенная средняя (комиссия в неё НЕ входит): (старая средняя * старое кол-во + стоимость) / новое кол-во.
+        Делитель приводим к float: в SQLite NUMERIC / INTEGER — целочисленное деление.
+        """
+        return Round((F('average_buy_price') * F('quantity') + stock_cost) / Cast(F('quantity') + quantity, FloatField()), 2)
+
+    @staticmethod
     def buy_stock(user, ticker_symbol: str, quantity: int) -> dict:
         """
         Обрабатывает покупку акций.
         Проверяет баланс и лотность, обновляет Asset и Portfolio, создает Transaction.
-        """
-        portfolio = PortfolioService.get_user_portfolio(user)
 
-        # 1. Получаем Stock и проверяем, что он существует
-        stock = get_object_or_404(Stock, ticker=ticker_symbol.upper())
-        current_price = stock.current_price
+        Сделка — три запроса в одной транзакции: условное списание
+        (UPDATE ... WHERE balance >= сумма), которое заодно блокирует строку портфеля
+        до конца транзакции и меняет оценку портфеля (market_value, cost_basis),
+        обновление позиции F()-выражениями и запись Transaction.
+        Параллельные сделки одного пользователя (двойной клик, бот + веб) выстраиваются
+        в очередь на блокировке портфеля и не могут увести баланс в минус.
+        """
+        # 1. Получаем котировку (из кэша цен) и проверяем, что акция существует.
+        # Делаем это до открытия транзакции, чтобы не держать блокировку лишнее время.
+        quote = PortfolioService.get_quote(ticker_symbol)
+        current_price = quote['price']
 
         if current_price is None or current_price <= Decimal('0'):
             error_msg = f"Сделка по акции {ticker_symbol.upper()} невозможна: цена не определена ({current_price or '0.00'} RUB)."
@@ -37,217 +204,837 @@ class PortfolioService:
             return {'success': False, 'error': error_msg}
 
         # 2. Проверяем лотность (количество должно быть кратно лоту)
-        if quantity % stock.lot_size != 0:
-            return {'success': False, 'error': f"Количество {quantity} должно быть кратно размеру лота: {stock.lot_size}."}
+        if quantity % quote['lot_size'] != 0:
+            return {'success': False, 'error': f"Количество {quantity} должно быть кратно размеру лота: {quote['lot_size']}."}
 
         # 3. Рассчитываем общую стоимость сделки
         stock_cost = current_price * quantity
-        commission = stock_cost * COMMISSION_RATE
+        commission = to_kopecks(stock_cost * COMMISSION_RATE)
         # Общая сумма, которую списываем со счета
         total_debit = stock_cost + commission
 
-        # 4. Проверяем баланс
-        if portfolio.balance < total_debit:
-            return {'success': False, 'error': f"Недостаточно средств. Требуется {total_debit:.2f} RUB(включая комиссию {commission:.2f}), доступно {portfolio.balance:.2f} RUB."}
+        # Себестоимость позиции после сделки — новое кол-во * округлённая средняя цена,
+        # поэтому приращение cost_basis считаем по строке позиции до обновления
+        # (подзапрос в том же UPDATE). Новой позиции ещё нет — приращение равно стоимости.
+        average_price = PortfolioService._average_after_buy(quantity, stock_cost)
+        cost_delta = Coalesce(
+            Subquery(
+                Asset.objects.filter(portfolio=OuterRef('pk'), stock_id=quote['id'])
+                .annotate(cost_delta=ExpressionWrapper(
+                    (F('quantity') + quantity) * average_price - F('quantity') * F('average_buy_price'),
+                    output_field=SUMMARY_MONEY_FIELD,
+                ))
+                .values('cost_delta')[:1]
+            ),
+            Value(stock_cost),
+            output_field=SUMMARY_MONEY_FIELD,
+        )
+        valuation = {
+            'balance': F('balance') - total_debit,
+            'market_value': F('market_value') + stock_cost,
+            'cost_basis': F('cost_basis') + cost_delta,
+        }
 
-        # --- Логика покупки ---
+        with write_transaction():
+            # 4. Списываем деньги, только если их хватает с учётом резерва под заявки
+            # (проверка и запись — один UPDATE)
+            debited = Portfolio.objects.filter(user=user, balance__gte=F('reserved_balance') + total_debit).update(**valuation)
+            if not debited:
+                # Редкий путь: портфеля ещё нет или не хватает средств
+                portfolio = PortfolioService.get_user_portfolio(user)
+                debited = Portfolio.objects.filter(pk=portfolio.pk, balance__gte=F('reserved_balance') + total_debit).update(**valuation)
+                if not debited:
+                    return {'success': False, 'error': f"Недостаточно средств. Требуется {total_debit:.2f} RUB(включая комиссию {commission:.2f}), доступно {portfolio.balance - portfolio.reserved_balance:.2f} RUB."}
 
-        # 5. Обновляем/Создаем Asset (позицию)
-        asset, created = Asset.objects.get_or_create(
-            portfolio=portfolio,
-            stock=stock,
-            # Defaults для созданной позиции
-            defaults={'quantity': 0, 'average_buy_price': current_price}
-        )
+            # 5. Обновляем позицию и её среднюю цену
+            updated = Asset.objects.filter(portfolio__user=user, stock_id=quote['id']).update(
+                quantity=F('quantity') + quantity,
+                average_buy_price=average_price,
+            )
+            if not updated:
+                # Новой позиции ещё нет — создаём
+                Asset.objects.create(
+                    portfolio_id=PortfolioService._portfolio_ref(user),
+                    stock_id=quote['id'],
+                    quantity=quantity,
+                    average_buy_price=current_price,
+                )
 
-        # 6. Расчет новой взвешенной средней цены покупки
-        old_total_cost = asset.average_buy_price * asset.quantity
-        new_total_cost = stock_cost # В расчет средней цены комиссия НЕ входит
-        new_quantity = asset.quantity + quantity
-
-        # Формула взвешенной средней цены (Weighted Average Cost):
-        new_average_price = (old_total_cost + new_total_cost) / new_quantity
-
-        # 7. Обновляем Asset и баланс
-        asset.quantity = new_quantity
-        asset.average_buy_price = new_average_price
-        asset.save()
-
-        portfolio.balance -= total_debit
-        portfolio.save()
-
-        # 8. Создаем запись о транзакции
-        Transaction.objects.create(
-            portfolio=portfolio,
-            stock=stock,
-            action='BUY',
-            quantity=quantity,
-            price=current_price,
-            commission=commission,
-            # Примечание: Мы могли бы создать отдельную модель для учета комиссии,
-            # но для MVP просто фиксируем комиссию в логе.
-        )
+            # 6. Создаем запись о транзакции
+            Transaction.objects.create(
+                portfolio_id=PortfolioService._portfolio_ref(user),
+                stock_id=quote['id'],
+                action='BUY',
+                quantity=quantity,
+                price=current_price,
+                commission=commission,
+                # Примечание: Мы могли бы создать отдельную модель для учета комиссии,
+                # но для MVP просто фиксируем комиссию в логе.
+            )
+            # Чистая стоимость (баланс + акции по той же цене) уменьшилась на комиссию
+            PortfolioService._queue_rank_delta(user, -commission)
 
-        logger.info(f"{user.username} купил {quantity} шт. {ticker_symbol} по {current_price:.2f}. Комиссия: {commission:.2f}. Новая ср. цена: {new_average_price:.2f}.")
+        logger.info(f"{user.username} купил {quantity} шт. {ticker_symbol} по {current_price:.2f}. Комиссия: {commission:.2f}.")
 
         return {'success': True, 'message': f"Куплено {quantity} шт. {ticker_symbol}. Списано {total_debit:.2f} RUB (в т.ч. комиссия {commission:.2f})."}
 
     @staticmethod
-    @transaction.atomic
     def sell_stock(user, ticker_symbol: str, quantity: int) -> dict:
         """
         Обрабатывает продажу акций, включая расчет комиссии.
         Проверяет наличие, рассчитывает доход, обновляет Asset и Portfolio, создает Transaction.
+
+        Как и покупка, сначала блокирует строку портфеля (зачисление выручки), затем
+        условно списывает бумаги (UPDATE ... WHERE quantity > N или DELETE ... WHERE
+        quantity = N). Если бумаг не хватило, транзакция откатывается целиком.
         """
-        portfolio = PortfolioService.get_user_portfolio(user)
-        stock = get_object_or_404(Stock, ticker=ticker_symbol.upper())
-        current_price = stock.current_price
+        quote = PortfolioService.get_quote(ticker_symbol)
+        current_price = quote['price']
 
         if current_price is None or current_price <= Decimal('0'):
             error_msg = f"Сделка по акции {ticker_symbol.upper()} невозможна: цена не определена ({current_price or '0.00'} RUB)."
             logger.warning(f"Ошибка продажи для пользователя {user.username}: {error_msg}")
             return {'success': False, 'error': error_msg}
 
-        # 1. Получаем существующий Asset
-        try:
-            asset = Asset.objects.get(portfolio=portfolio, stock=stock)
-        except Asset.DoesNotExist:
-            return {'success': False, 'error': f"У вас нет акций {ticker_symbol} для продажи."}
-
-        # 2. Проверяем лотность и достаточное количество
-        if quantity % stock.lot_size != 0:
-            return {'success': False, 'error': f"Количество {quantity} должно быть кратно размеру лота: {stock.lot_size}."}
+        # 1. Проверяем лотность
+        if quantity % quote['lot_size'] != 0:
+            return {'success': False, 'error': f"Количество {quantity} должно быть кратно размеру лота: {quote['lot_size']}."}
 
-        if asset.quantity < quantity:
-            return {'success': False, 'error': f"Недостаточно акций. Доступно: {asset.quantity} шт."}
-
-        # --- Логика продажи ---
-
-        # 3. Рассчитываем доход и обновляем Asset
+        # 2. Рассчитываем доход
         stock_revenue = current_price * quantity
-        commission = stock_revenue * COMMISSION_RATE
+        commission = to_kopecks(stock_revenue * COMMISSION_RATE)
 
         total_credit = stock_revenue - commission
 
-        asset.quantity -= quantity
+        # Средняя цена при продаже не меняется: себестоимость уменьшается на кол-во * среднюю
+        sold_cost = Coalesce(
+            Subquery(
+                Asset.objects.filter(portfolio=OuterRef('pk'), stock_id=quote['id'])
+                .annotate(sold_cost=ExpressionWrapper(F('average_buy_price') * quantity, output_field=SUMMARY_MONEY_FIELD))
+                .values('sold_cost')[:1]
+            ),
+            Value(Decimal('0.00')),
+            output_field=SUMMARY_MONEY_FIELD,
+        )
 
-        # 4. Обновляем баланс
-        portfolio.balance += total_credit
-        portfolio.save()
+        with write_transaction():
+            # 3. Зачисляем выручку и меняем оценку — UPDATE блокирует портфель до конца транзакции,
+            # в том же порядке, что и покупка (сначала портфель, потом позиция)
+            credited = Portfolio.objects.filter(user=user).update(
+                balance=F('balance') + total_credit,
+                market_value=F('market_value') - stock_revenue,
+                cost_basis=F('cost_basis') - sold_cost,
+            )
+            if not credited:
+                PortfolioService.get_user_portfolio(user)
+                return {'success': False, 'error': f"У вас нет акций {ticker_symbol} для продажи."}
 
-        # 5. Создаем запись о транзакции
-        Transaction.objects.create(
-            portfolio=portfolio,
-            stock=stock,
-            action='SELL',
-            quantity=quantity,
-            price=current_price,
-            commission=commission,
-        )
+            # 4. Списываем бумаги: частичная продажа или закрытие позиции.
+            # Акции, зарезервированные под заявки на продажу, не продаются; продажа всех
+            # свободных при резерве оставляет позицию под заявками, закрывается только пустая.
+            position = Asset.objects.filter(portfolio__user=user, stock_id=quote['id'])
+            closed = False
+            remains = Q(quantity__gt=F('reserved_quantity') + quantity) | Q(
+                quantity=F('reserved_quantity') + quantity, reserved_quantity__gt=0
+            )
+            if not position.filter(remains).update(quantity=F('quantity') - quantity):
+                closed = bool(position.filter(quantity=quantity, reserved_quantity=0).delete()[0])
+                if not closed:
+                    # Бумаг нет или не хватает — отменяем зачисление
+                    available = position.values_list(F('quantity') - F('reserved_quantity'), flat=True).first()
+                    transaction.set_rollback(True)
+                    if available is None:
+                        return {'success': False, 'error': f"У вас нет акций {ticker_symbol} для продажи."}
+                    return {'success': False, 'error': f"Недостаточно акций. Доступно: {available} шт."}
 
-        # 6. Удаляем Asset, если она обнуляется
-        if asset.quantity == 0:
-            asset.delete()
-            message = f"Продано {quantity} шт. {ticker_symbol}. Получено {total_credit:.2f} RUB (вычтена комиссия {commission:.2f}). Позиция закрыта."
-        else:
-            asset.save()
-            message = f"Продано {quantity} шт. {ticker_symbol}. Получено {total_credit:.2f} RUB (вычтена комиссия {commission:.2f}). Остаток: {asset.quantity} шт."
+            # 5. Создаем запись о транзакции
+            Transaction.objects.create(
+                portfolio_id=PortfolioService._portfolio_ref(user),
+                stock_id=quote['id'],
+                action='SELL',
+                quantity=quantity,
+                price=current_price,
+                commission=commission,
+            )
+            PortfolioService._queue_rank_delta(user, -commission)
+
+        message = f"Продано {quantity} шт. {ticker_symbol}. Получено {total_credit:.2f} RUB (вычтена комиссия {commission:.2f})."
+        if closed:
+            message += " Позиция закрыта."
 
         logger.info(f"{user.username} продал {quantity} шт. {ticker_symbol} по {current_price:.2f}. Комиссия: {commission:.2f}.")
 
         return {'success': True, 'message': message}
 
     @staticmethod
-    def get_portfolio_summary(user) -> dict:
+    def execute_batch(user, legs: list, all_or_nothing: bool = True) -> dict:
         """
-        Возвращает сводку по портфелю пользователя, включая текущую стоимость,
-        включая P&L в абсолютных числах и процентах.
+        Исполняет пакет сделок (например, ребалансировку) в одной транзакции.
+
+        legs — список {'action': 'BUY'|'SELL', 'ticker', 'quantity'}. Все заявки проверяются
+        по одному набору котировок и лотов; продажи исполняются раньше покупок, чтобы
+        вырученные деньги можно было сразу потратить. В режиме all_or_nothing ошибка
+        в любой заявке отменяет весь пакет, иначе исполняется всё, что прошло проверку.
+
+        Число запросов не зависит от числа заявок: блокировка портфеля, чтение позиций,
+        затем пакетные записи баланса и оценки, позиций и транзакций.
         """
-        portfolio = PortfolioService.get_user_portfolio(user)
-        assets = portfolio.assets.select_related('stock') # Оптимизация
+        quotes = PortfolioService.get_quotes(leg['ticker'] for leg in legs)
+        results = [None] * len(legs)
+        # Сначала все продажи, затем все покупки; внутри группы — в порядке заявок
+        order = sorted(range(len(legs)), key=lambda index: legs[index]['action'] != 'SELL')
 
-        total_market_value = Decimal('0.00')
-        total_cost_basis = Decimal('0.00') # Сколько реально потрачено денег
-        total_profit_loss = Decimal('0.00')
-        asset_details = []
+        with write_transaction():
+            portfolio = Portfolio.objects.select_for_update().filter(user=user).first()
+            if portfolio is None:
+                portfolio = PortfolioService.get_user_portfolio(user)
+            positions = {
+                asset.stock_id: asset
+                for asset in Asset.objects.select_for_update().filter(
+                    portfolio=portfolio, stock_id__in=[quote['id'] for quote in quotes.values()]
+                )
+            }
 
-        for asset in assets:
-            stock = asset.stock
-            # Текущая рыночная стоимость
-            market_value = asset.quantity * stock.current_price
+            # Проигрываем пакет в памяти: stock_id -> (количество, средняя цена).
+            # Деньги и акции, зарезервированные под заявки (Order), недоступны.
+            balance = portfolio.balance
+            held = {stock_id: (asset.quantity, asset.average_buy_price) for stock_id, asset in positions.items()}
+            reserved = {stock_id: asset.reserved_quantity for stock_id, asset in positions.items()}
+            executed = []
 
-            # Сколько было потрачено на покупку (Cost Basis)
-            cost_basis = asset.quantity * asset.average_buy_price
+            for index in order:
+                leg = legs[index]
+                action, ticker, quantity = leg['action'], leg['ticker'].upper(), leg['quantity']
+                result = {'index': index, 'action': action, 'ticker': ticker, 'quantity': quantity}
+                results[index] = result
+                quote = quotes.get(ticker)
 
-            # Прибыль/Убыток по активу в деньгах
-            profit_loss = market_value - cost_basis
+                error = None
+                if quote is None:
+                    error = f"Акция {ticker} не найдена."
+                elif quote['price'] is None or quote['price'] <= Decimal('0'):
+                    error = f"Сделка по акции {ticker} невозможна: цена не определена ({quote['price'] or '0.00'} RUB)."
+                elif quantity % quote['lot_size'] != 0:
+                    error = f"Количество {quantity} должно быть кратно размеру лота: {quote['lot_size']}."
+
+                if error is None:
+                    amount = quote['price'] * quantity
+                    commission = to_kopecks(amount * COMMISSION_RATE)
+                    held_quantity, average_price = held.get(quote['id'], (0, Decimal('0.00')))
+
+                    if action == 'BUY':
+                        total = amount + commission
+                        if balance - portfolio.reserved_balance < total:
+                            error = f"Недостаточно средств. Требуется {total:.2f} RUB(включая комиссию {commission:.2f}), доступно {balance - portfolio.reserved_balance:.2f} RUB."
+                        else:
+                            balance -= total
+                            new_quantity = held_quantity + quantity
+                            # Взвешенная средняя цена, комиссия в неё НЕ входит
+                            held[quote['id']] = (new_quantity, to_kopecks((average_price * held_quantity + amount) / new_quantity))
+                    else:
+                        total = amount - commission
+                        available = held_quantity - reserved.get(quote['id'], 0)
+                        if held_quantity == 0:
+                            error = f"У вас нет акций {ticker} для продажи."
+                        elif available < quantity:
+                            error = f"Недостаточно акций. Доступно: {available} шт."
+                        else:
+                            balance += total
+                            held[quote['id']] = (held_quantity - quantity, average_price)
+
+                if error is not None:
+                    result.update(success=False, error=error)
+                    continue
+
+                result.update(success=True, price=quote['price'], commission=commission, total=total)
+                executed.append(Transaction(
+                    portfolio=portfolio,
+                    stock_id=quote['id'],
+                    action=action,
+                    quantity=quantity,
+                    price=quote['price'],
+                    commission=commission,
+                ))
+
+            failed = len(legs) - len(executed)
+            if failed and all_or_nothing:
+                # Ничего не записано: помечаем прошедшие проверку заявки как отменённые
+                for result in results:
+                    if result['success']:
+                        result.update(success=False, error="Пакет отменён из-за ошибки в другой заявке.")
+                        for key in ('price', 'commission', 'total'):
+                            result.pop(key)
+                executed = []
+                balance = portfolio.balance
+
+            if executed:
+                # Изменение оценки: стоимость — по цене сделок, себестоимость — по новым средним
+                prices = {quote['id']: quote['price'] for quote in quotes.values()}
+                market_delta = cost_delta = Decimal('0.00')
+                for stock_id, (quantity, average_price) in held.items():
+                    asset = positions.get(stock_id)
+                    old_quantity, old_average = (asset.quantity, asset.average_buy_price) if asset else (0, Decimal('0.00'))
+                    market_delta += (quantity - old_quantity) * prices[stock_id]
+                    cost_delta += quantity * average_price - old_quantity * old_average
+                Portfolio.objects.filter(pk=portfolio.pk).update(
+                    balance=balance,
+                    market_value=F('market_value') + market_delta,
+                    cost_basis=F('cost_basis') + cost_delta,
+                )
+
+                to_create, to_update, to_delete = [], [], []
+                for stock_id, (quantity, average_price) in held.items():
+                    asset = positions.get(stock_id)
+                    if asset is None:
+                        if quantity:
+                            to_create.append(Asset(portfolio=portfolio, stock_id=stock_id, quantity=quantity, average_buy_price=average_price))
+                    elif quantity == 0:
+                        to_delete.append(asset.pk)
+                    elif (asset.quantity, asset.average_buy_price) != (quantity, average_price):
+                        asset.quantity, asset.average_buy_price = quantity, average_price
+                        to_update.append(asset)
 
-            # Расчет P&L % для АКТИВА Формула: (P&L / Cost Basis) * 100
-            profit_loss_percent = Decimal('0.00')
-            if cost_basis > 0:
-                profit_loss_percent = (profit_loss / cost_basis) * Decimal('100.00')
+                if to_update:
+                    Asset.objects.bulk_update(to_update, ['quantity', 'average_buy_price'])
+                if to_create:
+                    Asset.objects.bulk_create(to_create)
+                if to_delete:
+                    Asset.objects.filter(pk__in=to_delete).delete()
+                Transaction.objects.bulk_create(executed)
+                RankSnapshot.queue_deltas({portfolio.pk: balance - portfolio.balance + market_delta})
 
-            total_market_value += market_value
-            total_cost_basis += cost_basis
-            total_profit_loss += profit_loss
+        logger.info(f"{user.username}: пакет из {len(legs)} заявок, исполнено {len(executed)}, отклонено {failed}.")
 
+        return {
+            'success': failed == 0,
+            'executed': len(executed),
+            'failed': failed,
+            'balance': balance,
+            'results': results,
+        }
+
+    @staticmethod
+    def _summary_queryset(user):
+        """
+        Позиции пользователя с суммами, посчитанными в базе: стоимость и себестоимость
+        каждой позиции, плюс итоги и баланс из строки портфеля (оценка поддерживается
+        инкрементально, см. ValuationService). Один запрос; строки — кортежи в порядке SUMMARY_COLUMNS.
+        """
+        return (
+            Asset.objects.filter(portfolio__user=user)
+            .order_by('id')
+            .annotate(
+                market_value=ExpressionWrapper(F('quantity') * F('stock__current_price'), output_field=SUMMARY_MONEY_FIELD),
+                cost_basis=ExpressionWrapper(F('quantity') * F('average_buy_price'), output_field=SUMMARY_MONEY_FIELD),
+            )
+            .values_list(*SUMMARY_COLUMNS)
+        )
+
+    @staticmethod
+    def _percent(profit_loss: Decimal, cost_basis: Decimal) -> Decimal:
+        """P&L в процентах от себестоимости: (P&L / Cost Basis) * 100."""
+        if cost_basis > 0:
+            return (profit_loss / cost_basis) * Decimal('100.00')
+        return Decimal('0.00')
+
+    @staticmethod
+    def get_portfolio_summary(user, include_assets: bool = True) -> dict:
+        """
+        Возвращает сводку по портфелю пользователя, включая текущую стоимость,
+        включая P&L в абсолютных числах и процентах.
+
+        Итоги (стоимость, себестоимость, баланс) читаются из строки портфеля — они
+        поддерживаются инкрементально. Без позиций (include_assets=False) это один
+        запрос к одной строке; с позициями суммы по каждой считает база тем же
+        запросом (_summary_queryset). В Python — округление до копеек, проценты и сборка ответа.
+        """
+        rows = list(PortfolioService._summary_queryset(user)) if include_assets else []
+        if rows:
+            *_, total_market_value, total_cost_basis, balance, reserved_balance = rows[0]
+        else:
+            valuation = Portfolio.objects.filter(user=user).values_list(*VALUATION_COLUMNS).first()
+            if valuation is None:
+                # Первый вход: создаём портфель
+                portfolio = PortfolioService.get_user_portfolio(user)
+                valuation = tuple(getattr(portfolio, column) for column in VALUATION_COLUMNS)
+            total_market_value, total_cost_basis, balance, reserved_balance = valuation
+        # Оценка копится приращениями; в SQLite они хранятся как float — приводим к копейкам
+        total_market_value, total_cost_basis = to_kopecks(total_market_value), to_kopecks(total_cost_basis)
+        total_profit_loss = total_market_value - total_cost_basis
+
+        asset_details = []
+        for ticker, name, quantity, reserved_quantity, average_buy_price, current_price, lot_size, market_value, cost_basis, *_ in rows:
+            market_value, cost_basis = to_kopecks(market_value), to_kopecks(cost_basis)
+            profit_loss = market_value - cost_basis
             asset_details.append({
-                'ticker': stock.ticker,
-                'name': stock.name,
-                'quantity': asset.quantity,
-                'current_price': stock.current_price,
-                'average_buy_price': asset.average_buy_price,
+                'ticker': ticker,
+                'name': name,
+                'quantity': quantity,
+                'reserved_quantity': reserved_quantity,
+                'current_price': current_price,
+                'average_buy_price': average_buy_price,
                 'market_value': market_value,
                 'profit_loss': profit_loss,
-                'profit_loss_percent': profit_loss_percent,
-                'lot_size': stock.lot_size,
+                'profit_loss_percent': PortfolioService._percent(profit_loss, cost_basis),
+                'lot_size': lot_size,
             })
 
-        # Расчет Общего P&L % для ПОРТФЕЛЯ
-        total_profit_loss_percent = Decimal('0.00')
-        if total_cost_basis > 0:
-            total_profit_loss_percent = (total_profit_loss / total_cost_basis) * Decimal('100.00')
-
         return {
-            'balance': portfolio.balance,
+            'balance': balance,
+            'reserved_balance': reserved_balance, # Заблокировано под заявки на покупку
             'total_market_value': total_market_value,
             'total_cost_basis': total_cost_basis,
-            'net_worth': portfolio.balance + total_market_value, # Чистая стоимость (Баланс + Акции)
+            'net_worth': balance + total_market_value, # Чистая стоимость (Баланс + Акции)
             'total_profit_loss': total_profit_loss,
-            'total_profit_loss_percent': total_profit_loss_percent,
+            'total_profit_loss_percent': PortfolioService._percent(total_profit_loss, total_cost_basis),
             'assets': asset_details,
         }
 
     @staticmethod
-    def get_transaction_history(user, limit=50) -> list:
-        """
-        Возвращает историю транзакций пользователя.
-        """
-        portfolio = PortfolioService.get_user_portfolio(user)
-
-        # Получаем транзакции, связанные с портфелем, сортируем по дате,
-        # и подтягиваем связанные акции для оптимизации.
-        transactions = Transaction.objects.filter(
-            portfolio=portfolio
-        ).select_related(
-            'stock'
-        ).order_by(
-            '-timestamp' # Сначала самые новые
-        )[:limit]
-
-        # Сериализуем данные вручную (для простоты, без DRF Serializers)
-        history = []
-        for tx in transactions:
-            transaction_value = tx.price * tx.quantity
-            history.append({
-                'id': tx.id,
-                'action': tx.get_action_display(), # 'Покупка' или 'Продажа'
-                'ticker': tx.stock.ticker if tx.stock else 'Удалено',
-                'quantity': tx.quantity,
-                'price': tx.price,
-                'total': transaction_value,
-                'commission': tx.commission,
-                'timestamp': tx.timestamp.isoformat(),
+    def encode_history_cursor(timestamp, transaction_id) -> str:
+        """Курсор страницы истории: время последней строки в микросекундах от эпохи и её id."""
+        return f"{(timestamp - HISTORY_CURSOR_EPOCH) // timedelta(microseconds=1)}_{transaction_id}"
+
+    @staticmethod
+    def decode_history_cursor(cursor: str):
+        """(timestamp, id) из курсора страницы; ValueError, если курсор испорчен."""
+        microseconds, transaction_id = cursor.split('_')
+        return HISTORY_CURSOR_EPOCH + timedelta(microseconds=int(microseconds)), int(transaction_id)
+
+    @staticmethod
+    def history_queryset(portfolio, filters=None, cursor=None):
+        """
+        Транзакции портфеля от новых к старым по ключу (timestamp, id) — порядок индекса
+        portfolio_tx_history_idx. filters: ticker, action, date_from (включительно) и
+        date_to (не включительно) — aware datetime. cursor — (timestamp, id) последней
+        строки предыдущей страницы: следующая начинается строго после неё, без OFFSET.
+        """
+        filters = filters or {}
+        queryset = Transaction.objects.filter(portfolio=portfolio)
+        if filters.get('ticker'):
+            queryset = queryset.filter(stock__ticker=filters['ticker'])
+        if filters.get('action'):
+            queryset = queryset.filter(action=filters['action'])
+        if filters.get('date_from'):
+            queryset = queryset.filter(timestamp__gte=filters['date_from'])
+        if filters.get('date_to'):
+            queryset = queryset.filter(timestamp__lt=filters['date_to'])
+        if cursor is not None:
+            timestamp, transaction_id = cursor
+            queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=transaction_id))
+        return queryset.order_by('-timestamp', '-id').values_list(*HISTORY_COLUMNS)
+
+    @staticmethod
+    def _history_row(row) -> dict:
+        transaction_id, action, ticker, quantity, price, commission, timestamp = row
+        return {
+            'id': transaction_id,
+            'action': HISTORY_ACTION_LABELS[action], # 'Покупка' или 'Продажа'
+            'ticker': ticker or 'Удалено',
+            'quantity': quantity,
+            'price': price,
+            'total': price * quantity,
+            'commission': commission,
+            'timestamp': timestamp.isoformat(),
+        }
+
+    @staticmethod
+    def get_transaction_history(user, limit=HISTORY_PAGE_SIZE, cursor=None, filters=None) -> dict:
+        """
+        Страница истории транзакций пользователя (сначала самые новые):
+        {'results': [...], 'next_cursor': курсор следующей страницы или None}.
+        Когда транзакции в таблице кончаются, страница дополняется из архива.
+        """
+        portfolio = PortfolioService.resolve_portfolio(user)
+        # Строка сверх limit только показывает, что есть следующая страница
+        rows = list(PortfolioService.history_queryset(portfolio, filters, cursor)[:limit + 1])
+        if len(rows) <= limit:
+            # Архивные строки портфеля старше любых оставшихся в таблице
+            rows += islice(TransactionArchiveService.history_rows(portfolio, filters, cursor), limit + 1 - len(rows))
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = PortfolioService.encode_history_cursor(rows[-1][-1], rows[-1][0])
+        return {
+            'results': [PortfolioService._history_row(row) for row in rows],
+            'next_cursor': next_cursor,
+        }
+
+    @staticmethod
+    def _history_chunks(portfolio, filters=None):
+        """Вся история портфеля частями по HISTORY_EXPORT_CHUNK_SIZE строк: сначала таблица, затем архив."""
+        cursor = None
+        while True:
+            rows = list(PortfolioService.history_queryset(portfolio, filters, cursor)[:HISTORY_EXPORT_CHUNK_SIZE])
+            if rows:
+                yield rows
+            if len(rows) < HISTORY_EXPORT_CHUNK_SIZE:
+                break
+            cursor = (rows[-1][-1], rows[-1][0])
+
+        archived = TransactionArchiveService.history_rows(portfolio, filters)
+        while rows := list(islice(archived, HISTORY_EXPORT_CHUNK_SIZE)):
+            yield rows
+
+    @staticmethod
+    def export_transaction_history(portfolio, filters=None, file_format='csv'):
+        """
+        Генератор выгрузки всей истории (CSV или NDJSON) частями по HISTORY_EXPORT_CHUNK_SIZE строк.
+
+        Каждая часть — отдельный запрос по ключу (timestamp, id) после предыдущей (архив —
+        по месяцу за запрос), поэтому в памяти одновременно только одна часть, а соединение
+        не держит открытый курсор базы между частями (генератор можно отдавать по кускам
+        и из асинхронного кода).
+        """
+        if file_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(HISTORY_EXPORT_FIELDS)
+
+        for rows in PortfolioService._history_chunks(portfolio, filters):
+            if file_format == 'csv':
+                writer.writerows(
+                    [row[field] for field in HISTORY_EXPORT_FIELDS]
+                    for row in map(PortfolioService._history_row, rows)
+                )
+                chunk = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                chunk = ''.join(
+                    json.dumps(PortfolioService._history_row(row), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+                    for row in rows
+                )
+            yield chunk
+
+        # Пустая история: CSV — только заголовок
+        if file_format == 'csv' and buffer.getvalue():
+            yield buffer.getvalue()
+
+
+class OrderService:
+    """
+    Отложенные заявки (лимитные и стоп): размещение с резервом денег или акций,
+    отмена с возвратом резерва и пакетное исполнение сработавших заявок.
+    Срабатывание по цене определяет движок apps.portfolio.matching.
+    """
+
+    @staticmethod
+    def reserve_for(price: Decimal, quantity: int) -> Decimal:
+        """Резерв под покупку: стоимость по цене срабатывания плюс комиссия."""
+        amount = price * quantity
+        return amount + to_kopecks(amount * COMMISSION_RATE)
+
+    @staticmethod
+    def place_order(user, action: str, order_type: str, ticker_symbol: str, quantity: int, trigger_price: Decimal) -> dict:
+        """
+        Размещает заявку. Покупка резервирует деньги (Portfolio.reserved_balance),
+        продажа — акции (Asset.reserved_quantity); проверка и резерв — один условный UPDATE.
+        """
+        quote = PortfolioService.get_quote(ticker_symbol)
+        ticker_symbol = quote['ticker']
+
+        if quantity % quote['lot_size'] != 0:
+            return {'success': False, 'error': f"Количество {quantity} должно быть кратно размеру лота: {quote['lot_size']}."}
+
+        reserve = Decimal('0.00')
+        with write_transaction():
+            if action == 'BUY':
+                reserve = OrderService.reserve_for(trigger_price, quantity)
+                reserved = Portfolio.objects.filter(user=user, balance__gte=F('reserved_balance') + reserve).update(
+                    reserved_balance=F('reserved_balance') + reserve
+                )
+                if not reserved:
+                    portfolio = PortfolioService.get_user_portfolio(user)
+                    return {'success': False, 'error': f"Недостаточно средств для заявки. Требуется {reserve:.2f} RUB, доступно {portfolio.balance - portfolio.reserved_balance:.2f} RUB."}
+            else:
+                reserved = Asset.objects.filter(
+                    portfolio__user=user, stock_id=quote['id'], quantity__gte=F('reserved_quantity') + quantity
+                ).update(reserved_quantity=F('reserved_quantity') + quantity)
+                if not reserved:
+                    return {'success': False, 'error': f"Недостаточно свободных акций {ticker_symbol} для заявки на продажу."}
+
+            order = Order.objects.create(
+                portfolio_id=PortfolioService._portfolio_ref(user),
+                stock_id=quote['id'],
+                action=action,
+                order_type=order_type,
+                quantity=quantity,
+                trigger_price=trigger_price,
+                reserved_cash=reserve,
+            )
+
+        logger.info(f"{user.username} разместил заявку {order_type} {action} {quantity} шт. {ticker_symbol} @ {trigger_price:.2f}.")
+        return {'success': True, 'order_id': order.pk, 'message': f"Заявка на {quantity} шт. {ticker_symbol} по {trigger_price:.2f} RUB размещена."}
+
+    @staticmethod
+    def cancel_order(user, order_id: int) -> dict:
+        """Отменяет активную заявку пользователя и возвращает резерв."""
+        with write_transaction():
+            # Порядок блокировок как у сделок: портфель, затем позиция и заявка
+            portfolio = Portfolio.objects.select_for_update().filter(user=user).first()
+            order = None
+            if portfolio is not None:
+                order = Order.objects.select_for_update().filter(
+                    pk=order_id, portfolio=portfolio, status=Order.STATUS_OPEN
+                ).first()
+            if order is None:
+                return {'success': False, 'error': "Заявка не найдена или уже не активна."}
+
+            if order.action == 'BUY':
+                Portfolio.objects.filter(pk=portfolio.pk).update(reserved_balance=F('reserved_balance') - order.reserved_cash)
+            else:
+                Asset.objects.filter(portfolio=portfolio, stock_id=order.stock_id).update(
+                    reserved_quantity=F('reserved_quantity') - order.quantity
+                )
+            Order.objects.filter(pk=order.pk).update(status=Order.STATUS_CANCELLED, closed_at=timezone.now())
+
+        logger.info(f"{user.username} отменил заявку #{order_id}.")
+        return {'success': True, 'message': f"Заявка #{order_id} отменена."}
+
+    @staticmethod
+    def execute_orders(order_ids, prices: dict) -> dict:
+        """
+        Исполняет сработавшие заявки по ценам prices (stock_id -> цена) одной транзакцией.
+
+        Запросов — фиксированное число на пачку, сколько бы заявок ни сработало:
+        блокировка портфелей, заявок и позиций, расчёт в памяти, затем bulk_update /
+        bulk_create. Заявки, которые уже не активны (отменены, исполнены другим
+        процессом), пропускаются. Покупка по стоп-заявке может стоить больше резерва:
+        разница берётся из свободных денег, а если их не хватает — заявка отклоняется.
+        """
+        report = {'filled': 0, 'rejected': 0, 'skipped': 0}
+        order_ids = list(order_ids)
+        if not order_ids:
+            return report
+        now = timezone.now()
+
+        with write_transaction():
+            portfolio_ids = set(
+                Order.objects.filter(pk__in=order_ids, status=Order.STATUS_OPEN).values_list('portfolio_id', flat=True)
+            )
+            portfolios = {
+                portfolio.pk: portfolio
+                for portfolio in Portfolio.objects.select_for_update().filter(pk__in=portfolio_ids).order_by('pk')
+            }
+            # Исполняем в порядке поступления заявок
+            orders = list(Order.objects.select_for_update().filter(pk__in=order_ids, status=Order.STATUS_OPEN).order_by('pk'))
+            report['skipped'] = len(order_ids) - len(orders)
+            assets = {
+                (asset.portfolio_id, asset.stock_id): asset
+                for asset in Asset.objects.select_for_update().filter(
+                    portfolio_id__in=portfolio_ids, stock_id__in={order.stock_id for order in orders}
+                )
+            }
+
+            # Чистая стоимость до исполнения: её изменение уйдёт в снимок рейтинга
+            net_worths = {portfolio.pk: portfolio.balance + portfolio.market_value for portfolio in portfolios.values()}
+            touched = set()
+            transactions = []
+            for order in orders:
+                portfolio = portfolios[order.portfolio_id]
+                key = (order.portfolio_id, order.stock_id)
+                asset = assets.get(key)
+                price = prices[order.stock_id]
+                amount = price * order.quantity
+                commission = to_kopecks(amount * COMMISSION_RATE)
+                order.closed_at = now
+
+                if order.action == 'BUY':
+                    total = amount + commission
+                    portfolio.reserved_balance -= order.reserved_cash
+                    if portfolio.balance - portfolio.reserved_balance < total:
+                        order.status = Order.STATUS_REJECTED
+                        report['rejected'] += 1
+                        continue
+                    portfolio.balance -= total
+                    if asset is None:
+                        asset = assets[key] = Asset(
+                            portfolio_id=order.portfolio_id, stock_id=order.stock_id, quantity=0, average_buy_price=Decimal('0.00')
+                        )
+                    old_cost = asset.average_buy_price * asset.quantity
+                    # Взвешенная средняя цена, комиссия в неё НЕ входит
+                    asset.average_buy_price = to_kopecks((old_cost + amount) / (asset.quantity + order.quantity))
+                    asset.quantity += order.quantity
+                    portfolio.market_value += amount
+                    portfolio.cost_basis += asset.average_buy_price * asset.quantity - old_cost
+                else:
+                    if asset is None or asset.reserved_quantity < order.quantity:
+                        # Резерв потерян (позицию удалили вручную) — продавать нечего
+                        order.status = Order.STATUS_REJECTED
+                        report['rejected'] += 1
+                        continue
+                    asset.reserved_quantity -= order.quantity
+                    asset.quantity -= order.quantity
+                    portfolio.balance += amount - commission
+                    portfolio.market_value -= amount
+                    portfolio.cost_basis -= asset.average_buy_price * order.quantity
+
+                touched.add(key)
+                order.status = Order.STATUS_FILLED
+                order.fill_price = price
+                report['filled'] += 1
+                transactions.append(Transaction(
+                    portfolio_id=order.portfolio_id,
+                    stock_id=order.stock_id,
+                    action=order.action,
+                    quantity=order.quantity,
+                    price=price,
+                    commission=commission,
+                ))
+
+            Portfolio.objects.bulk_update(portfolios.values(), ['balance', 'reserved_balance', 'market_value', 'cost_basis'])
+            to_create = [assets[key] for key in touched if assets[key].pk is None and assets[key].quantity]
+            to_delete = [assets[key].pk for key in touched if assets[key].pk is not None and assets[key].quantity == 0]
+            to_update = [assets[key] for key in touched if assets[key].pk is not None and assets[key].quantity]
+            if to_create:
+                Asset.objects.bulk_create(to_create)
+            if to_update:
+                Asset.objects.bulk_update(to_update, ['quantity', 'reserved_quantity', 'average_buy_price'])
+            if to_delete:
+                Asset.objects.filter(pk__in=to_delete).delete()
+            if orders:
+                Order.objects.bulk_update(orders, ['status', 'fill_price', 'closed_at'])
+            if transactions:
+                Transaction.objects.bulk_create(transactions)
+            RankSnapshot.queue_deltas({
+                portfolio.pk: portfolio.balance + portfolio.market_value - net_worths[portfolio.pk]
+                for portfolio in portfolios.values()
             })
 
-        return history
\ No newline at end of file
+        return report
+
+
+class ValuationService:
+    """
+    Материализованная оценка портфелей: Portfolio.market_value (кол-во * текущая цена)
+    и Portfolio.cost_basis (кол-во * средняя цена покупки) по всем позициям.
+
+    Сделки меняют оценку в своих запросах (PortfolioService, OrderService), обновление
+    цен — через apply_price_changes. Полный пересчёт и сверка — recompute / reconcile
+    (manage.py reconcilevaluations): расхождения возможны после ручной правки позиций
+    в админке или если сделка прошла по цене снимка, который ещё не опубликован заново.
+    """
+
+    @staticmethod
+    def apply_price_changes(changes) -> int:
+        """
+        Переоценивает портфели, держащие акции с изменившейся ценой: market_value += Δцены * кол-во.
+
+        Обратный индекс "акция -> портфели-держатели" — индекс внешнего ключа Asset.stock:
+        позиции читаются только по изменившимся акциям, приращения суммируются по портфелю
+        в памяти, и портфели обновляются пачками bulk_update с F()-выражениями, чтобы не
+        затереть сделки, записанные параллельно. Те же приращения после коммита применяются
+        к снимку рейтинга (RankSnapshot). Возвращает число переоценённых портфелей.
+        """
+        deltas = {
+            change['stock_id']: change['price'] - change['old_price']
+            for change in changes
+            if change['price'] != change['old_price']
+        }
+        if not deltas:
+            return 0
+
+        by_portfolio = defaultdict(Decimal)
+        stock_ids = list(deltas)
+        for start in range(0, len(stock_ids), VALUATION_STOCK_CHUNK_SIZE):
+            positions = Asset.objects.filter(stock_id__in=stock_ids[start:start + VALUATION_STOCK_CHUNK_SIZE])
+            for portfolio_id, stock_id, quantity in positions.values_list('portfolio_id', 'stock_id', 'quantity').iterator():
+                by_portfolio[portfolio_id] += deltas[stock_id] * quantity
+
+        portfolios = [
+            Portfolio(pk=portfolio_id, market_value=F('market_value') + delta)
+            for portfolio_id, delta in by_portfolio.items()
+            if delta
+        ]
+        Portfolio.objects.bulk_update(portfolios, ['market_value'], batch_size=VALUATION_UPDATE_BATCH_SIZE)
+
+        # Чистая стоимость изменилась на те же приращения: после коммита — в журнал снимка рейтинга
+        RankSnapshot.queue_deltas(by_portfolio)
+        return len(portfolios)
+
+    @staticmethod
+    def recompute(portfolio_ids=None) -> dict:
+        """
+        Полный пересчёт оценки по позициям и текущим ценам Stock:
+        portfolio_id -> (market_value, cost_basis). Портфели без позиций в результат не входят.
+        """
+        positions = Asset.objects.all()
+        if portfolio_ids is not None:
+            positions = positions.filter(portfolio_id__in=portfolio_ids)
+        rows = (
+            positions.values('portfolio_id')
+            .order_by('portfolio_id')
+            .annotate(
+                market_value=Sum(F('quantity') * F('stock__current_price'), output_field=SUMMARY_MONEY_FIELD),
+                cost_basis=Sum(F('quantity') * F('average_buy_price'), output_field=SUMMARY_MONEY_FIELD),
+            )
+            .values_list('portfolio_id', 'market_value', 'cost_basis')
+        )
+        return {
+            portfolio_id: (to_kopecks(market_value), to_kopecks(cost_basis))
+            for portfolio_id, market_value, cost_basis in rows
+        }
+
+    @staticmethod
+    def reconcile(fix: bool = False) -> dict:
+        """
+        Сверяет материализованную оценку всех портфелей с полным пересчётом.
+
+        Пересчёт и сверка — чтение без блокировки записи: сделки и тики идут параллельно,
+        поэтому расхождение может оказаться гонкой со сделкой. С fix=True расхождения
+        исправляются пачками по VALUATION_UPDATE_BATCH_SIZE в коротких транзакциях
+        записи, где каждая строка пересчитывается и сверяется заново.
+        Возвращает {'checked', 'mismatched', 'fixed', 'mismatches': [(id, сохранено, пересчитано), ...]}.
+        """
+        report = {'checked': 0, 'mismatched': 0, 'fixed': 0, 'mismatches': []}
+
+        expected = ValuationService.recompute()
+        for portfolio_id, market_value, cost_basis in Portfolio.objects.order_by('pk').values_list(
+            'pk', 'market_value', 'cost_basis'
+        ).iterator():
+            report['checked'] += 1
+            stored = (to_kopecks(market_value), to_kopecks(cost_basis))
+            actual = expected.get(portfolio_id, VALUATION_ZERO)
+            if stored != actual:
+                report['mismatches'].append((portfolio_id, stored, actual))
+        report['mismatched'] = len(report['mismatches'])
+
+        if fix:
+            mismatched_ids = [portfolio_id for portfolio_id, *_ in report['mismatches']]
+            for start in range(0, len(mismatched_ids), VALUATION_UPDATE_BATCH_SIZE):
+                report['fixed'] += ValuationService._fix_batch(mismatched_ids[start:start + VALUATION_UPDATE_BATCH_SIZE])
+
+        if report['mismatched']:
+            logger.warning(f"Valuation mismatches: {report['mismatched']} of {report['checked']} portfolios, fixed {report['fixed']}.")
+        return report
+
+    @staticmethod
+    def _fix_batch(portfolio_ids) -> int:
+        """Пересчитывает и исправляет оценку пачки портфелей под блокировкой записи; возвращает число исправленных."""
+        with write_transaction():
+            expected = ValuationService.recompute(portfolio_ids)
+            to_fix = []
+            for portfolio_id, market_value, cost_basis in Portfolio.objects.filter(pk__in=portfolio_ids).values_list(
+                'pk', 'market_value', 'cost_basis'
+            ):
+                actual = expected.get(portfolio_id, VALUATION_ZERO)
+                if (to_kopecks(market_value), to_kopecks(cost_basis)) != actual:
+                    to_fix.append(Portfolio(pk=portfolio_id, market_value=actual[0], cost_basis=actual[1]))
+            Portfolio.objects.bulk_update(to_fix, ['market_value', 'cost_basis'])
+        return len(to_fix)
+
+
+def on_prices_written(sender, changes, **kwargs):
+    """Подписчик сигнала apps.market.signals.prices_written: переоценка в транзакции записи цен."""
+    # Своя точка сохранения: ошибка переоценки не откатывает запись цен
+    with transaction.atomic():
+        return ValuationService.apply_price_changes(changes)
+
+
+def on_user_created(sender, instance, created, raw=False, **kwargs):
+    """Подписчик post_save пользователя: портфель создаётся один раз, при регистрации."""
+    if created and not raw:
+        portfolio = Portfolio.objects.create(user=instance)
+        # Новый игрок попадает в снимок рейтинга сразу, а не с ближайшей пересборкой
+        RankSnapshot.queue_deltas({}, {portfolio.pk: portfolio.balance + portfolio.market_value})
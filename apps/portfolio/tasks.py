@@ -0,0 +1,81 @@
+from config import celery_app
+from .archive import TransactionArchiveService
+from .equity import EquitySnapshotService
+from .idempotency import IdempotencyStore
+from .leaderboard import RankSnapshot
+from .ledger import LedgerService
+from .services import ValuationService
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Пачек архивации за один запуск задачи (по ARCHIVE_BATCH_SIZE транзакций)
+ARCHIVE_TASK_MAX_BATCHES = 500
+
+@celery_app.task
+def prune_idempotency_keys_task():
+    """Celery-задача удаления просроченных ключей идемпотентности."""
+    try:
+        deleted = IdempotencyStore.prune()
+        logger.info(f"Удалено просроченных ключей идемпотентности: {deleted}.")
+    except Exception as e:
+        logger.error(f"Idempotency keys prune failed: {e}")
+
+@celery_app.task
+def rebuild_leaderboard_task():
+    """Celery-задача пересборки снимка мест рейтинга из базы (только чтение)."""
+    try:
+        snapshot = RankSnapshot.rebuild()
+        logger.info(f"Рейтинг пересобран: {len(snapshot['ids'])} портфелей.")
+    except Exception as e:
+        logger.error(f"Leaderboard rebuild failed: {e}")
+
+@celery_app.task
+def reconcile_valuations_task():
+    """
+    Celery-задача сверки оценки портфелей с полным пересчётом: расхождения исправляются
+    короткими транзакциями (ValuationService.reconcile), снимок рейтинга пересобирается.
+    """
+    try:
+        report = ValuationService.reconcile(fix=True)
+        if report['fixed']:
+            RankSnapshot.rebuild()
+        logger.info(f"Оценка портфелей сверена: {report['checked']} портфелей, исправлено: {report['fixed']}.")
+    except Exception as e:
+        logger.error(f"Valuation reconcile failed: {e}")
+
+@celery_app.task
+def snapshot_equity_task():
+    """
+    Celery-задача ежедневного снимка капитала всех портфелей.
+    Повторный запуск в тот же день дописывает только недостающие снимки.
+    """
+    try:
+        report = EquitySnapshotService.snapshot_all()
+        logger.info(f"Снимки капитала за {report['date']}: {report['created']} портфелей за {report['seconds']:.2f} с.")
+    except Exception as e:
+        logger.error(f"Equity snapshot failed: {e}")
+
+@celery_app.task
+def replay_ledger_task(fix=False):
+    """
+    Celery-задача сверки портфелей с журналом сделок. В процессе воркера Celery
+    диапазоны проигрываются последовательно (пул процессов — в manage.py replayledger).
+    """
+    try:
+        report = LedgerService.replay_all(fix=fix)
+        logger.info(f"Сверка с журналом: {report['portfolios']} портфелей, расхождений: {report['drifted']}, исправлено: {report['repaired']}.")
+    except Exception as e:
+        logger.error(f"Ledger replay failed: {e}")
+
+@celery_app.task
+def archive_transactions_task(max_batches=ARCHIVE_TASK_MAX_BATCHES):
+    """
+    Celery-задача переноса старых транзакций в архив. За запуск — не больше
+    max_batches пачек, остаток перенесёт следующий запуск.
+    """
+    try:
+        report = TransactionArchiveService.archive(max_batches=max_batches)
+        logger.info(f"В архив перенесено транзакций: {report['archived']} (до {report['cutoff']:%Y-%m-%d}).")
+    except Exception as e:
+        logger.error(f"Transaction archival failed: {e}")
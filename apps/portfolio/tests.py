@@ -1,3 +1,1197 @@
-from django.test import TestCase
+import io
+import json
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from apps.market.cache import PriceCache
+from apps.market.models import Stock, Candle
+from apps.market.services import MoexDataService
+from apps.users.authentication import CachedTokenAuthentication
+from .archive import TransactionArchiveService
+from .analytics import PortfolioAnalytics, compute_metrics, _forward_fill
+from .equity import EquitySnapshotService
+from .leaderboard import (
+    COMPACT_LOCK_KEY, DELTA_KEY_PREFIX, DELTA_SEQ_KEY, SNAPSHOT_KEY, RankSnapshot, LeaderboardService,
+)
+from .locking import write_transaction
+from .management.commands.benchsummary import summary_from_quotes
+from .ledger import LedgerService
+from .matching import TriggerBook, engine
+from .models import Portfolio, Asset, Transaction, Order, EquitySnapshot, TransactionArchive, ArchivedPosition
+from .services import PortfolioService, OrderService, ValuationService
+from .tasks import rebuild_leaderboard_task, reconcile_valuations_task
+
+User = get_user_model()
+
+
+def funded_portfolio(user, balance=Decimal('100000.00')) -> Portfolio:
+    """Портфель пользователя (создан при регистрации) со стартовым балансом теста."""
+    Portfolio.objects.filter(user=user).update(balance=balance)
+    return Portfolio.objects.get(user=user)
+
+
+class TradeExecutionTests(TestCase):
+    """Сделки: бюджет запросов и корректность позиции."""
+
+    def assertStatements(self, expected, func, *args):
+        """Как assertNumQueries, но без SAVEPOINT/RELEASE, которые добавляет сам TestCase."""
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args)
+        statements = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), expected, '\n'.join(statements))
+        return result
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('10000.00'))
+        self.stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        # Котировки берутся из снимка, в базу за ценой сделка не ходит
+        PriceCache.publish()
+
+    def test_buy_existing_position_takes_three_queries(self):
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=10, average_buy_price=Decimal('50.00'))
+        result = self.assertStatements(3, PortfolioService.buy_stock, self.user, 'SBER', 20)
+        self.assertTrue(result['success'])
+
+        asset = Asset.objects.get(portfolio=self.portfolio, stock=self.stock)
+        self.assertEqual(asset.quantity, 30)
+        # (50 * 10 + 100 * 20) / 30
+        self.assertEqual(asset.average_buy_price, Decimal('83.33'))
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') - Decimal('2002.00'))
+
+    def test_partial_sell_takes_three_queries(self):
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=30, average_buy_price=Decimal('50.00'))
+        result = self.assertStatements(3, PortfolioService.sell_stock, self.user, 'SBER', 10)
+        self.assertTrue(result['success'])
+        self.assertEqual(Asset.objects.get(portfolio=self.portfolio, stock=self.stock).quantity, 20)
+
+    def test_sell_closes_position(self):
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=10, average_buy_price=Decimal('50.00'))
+        result = PortfolioService.sell_stock(self.user, 'SBER', 10)
+        self.assertTrue(result['success'])
+        self.assertFalse(Asset.objects.filter(portfolio=self.portfolio).exists())
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') + Decimal('999.00'))
+
+    def test_oversell_rolls_back_credit(self):
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=10, average_buy_price=Decimal('50.00'))
+        result = PortfolioService.sell_stock(self.user, 'SBER', 20)
+        self.assertFalse(result['success'])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00'))
+        self.assertEqual(Asset.objects.get(portfolio=self.portfolio).quantity, 10)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_insufficient_funds(self):
+        result = PortfolioService.buy_stock(self.user, 'SBER', 100)
+        self.assertFalse(result['success'])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00'))
+        self.assertFalse(Asset.objects.exists())
+
+
+class PortfolioSummaryTests(TestCase):
+    """Сводка, посчитанная в базе, совпадает с прежним расчётом в Python до копейки."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('1234.56'))
+        rng = random.Random(7)
+        stocks = Stock.objects.bulk_create([
+            Stock(ticker=f"S{i:02d}", name=f"Stock {i}", current_price=Decimal(rng.randint(1, 500_000)) / 100)
+            for i in range(50)
+        ])
+        Asset.objects.bulk_create([
+            Asset(
+                portfolio=self.portfolio,
+                stock=stock,
+                quantity=rng.randint(1, 1000),
+                average_buy_price=Decimal(rng.randint(1, 500_000)) / 100,
+            )
+            for stock in stocks
+        ])
+        PriceCache.publish()
+
+    def test_matches_python_loop(self):
+        # Позиции созданы в обход сделок — оценку материализует сверка
+        self.assertEqual(ValuationService.reconcile(fix=True)['fixed'], 1)
+        with self.assertNumQueries(1):
+            summary = PortfolioService.get_portfolio_summary(self.user)
+        self.assertEqual(summary, summary_from_quotes(self.user))
+        self.assertEqual(len(summary['assets']), 50)
+        self.assertEqual(summary['net_worth'], Decimal('1234.56') + summary['total_market_value'])
+
+    def test_empty_portfolio(self):
+        Asset.objects.all().delete()
+        summary = PortfolioService.get_portfolio_summary(self.user)
+        self.assertEqual(summary['total_market_value'], Decimal('0.00'))
+        self.assertEqual(summary['net_worth'], Decimal('1234.56'))
+        self.assertEqual(summary['assets'], [])
+
+    def test_totals_only_is_single_row_lookup(self):
+        ValuationService.reconcile(fix=True)
+        with self.assertNumQueries(1):
+            totals = PortfolioService.get_portfolio_summary(self.user, include_assets=False)
+        summary = PortfolioService.get_portfolio_summary(self.user)
+        self.assertEqual(totals, dict(summary, assets=[]))
+
+
+class BatchTradeTests(TestCase):
+    """Пакетное исполнение заявок."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('1000.00'))
+        self.stocks = [
+            Stock.objects.create(ticker=f"S{i:02d}", name=f"Stock {i}", current_price=Decimal('10.00'), lot_size=1)
+            for i in range(12)
+        ]
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stocks[0], quantity=100, average_buy_price=Decimal('5.00'))
+        PriceCache.publish()
+
+    def _count_statements(self, legs, all_or_nothing=True):
+        with CaptureQueriesContext(connection) as context:
+            result = PortfolioService.execute_batch(self.user, legs, all_or_nothing)
+        return result, len([query for query in context.captured_queries if 'SAVEPOINT' not in query['sql']])
+
+    def test_sells_fund_buys(self):
+        # Покупка на 1500 возможна только на выручку от продажи, хотя в заявке она первая
+        legs = [
+            {'action': 'BUY', 'ticker': 'S01', 'quantity': 150},
+            {'action': 'SELL', 'ticker': 'S00', 'quantity': 100},
+        ]
+        result = PortfolioService.execute_batch(self.user, legs)
+        self.assertTrue(result['success'], result)
+        self.assertEqual([leg['ticker'] for leg in result['results']], ['S01', 'S00'])
+
+        self.portfolio.refresh_from_db()
+        # 1000 + (1000 - 1) - (1500 + 1.5)
+        self.assertEqual(self.portfolio.balance, Decimal('497.50'))
+        self.assertFalse(Asset.objects.filter(stock=self.stocks[0]).exists())
+        self.assertEqual(Asset.objects.get(stock=self.stocks[1]).quantity, 150)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_all_or_nothing_writes_nothing_on_error(self):
+        legs = [
+            {'action': 'BUY', 'ticker': 'S01', 'quantity': 10},
+            {'action': 'SELL', 'ticker': 'S02', 'quantity': 10},
+        ]
+        result = PortfolioService.execute_batch(self.user, legs)
+        self.assertFalse(result['success'])
+        self.assertEqual(result['executed'], 0)
+        self.assertFalse(any(leg['success'] for leg in result['results']))
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('1000.00'))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_best_effort_executes_valid_legs(self):
+        legs = [
+            {'action': 'BUY', 'ticker': 'S01', 'quantity': 10},
+            {'action': 'SELL', 'ticker': 'S02', 'quantity': 10},
+            {'action': 'BUY', 'ticker': 'NOPE', 'quantity': 1},
+        ]
+        result = PortfolioService.execute_batch(self.user, legs, all_or_nothing=False)
+        self.assertEqual(result['executed'], 1)
+        self.assertEqual([leg['success'] for leg in result['results']], [True, False, False])
+        self.assertEqual(Asset.objects.get(stock=self.stocks[1]).quantity, 10)
+
+    def test_query_count_does_not_depend_on_leg_count(self):
+        small = [{'action': 'BUY', 'ticker': 'S01', 'quantity': 1}]
+        large = [{'action': 'SELL', 'ticker': 'S00', 'quantity': 1}] + [
+            {'action': 'BUY', 'ticker': stock.ticker, 'quantity': 1} for stock in self.stocks[1:]
+        ]
+        _, small_count = self._count_statements(small)
+        result, large_count = self._count_statements(large)
+        self.assertEqual(result['executed'], len(large))
+        self.assertLessEqual(large_count, 7)
+        self.assertLessEqual(large_count - small_count, 1)
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/portfolio/trade/batch/', {
+            'mode': 'best_effort',
+            'legs': [{'action': 'buy', 'ticker': 's01', 'quantity': 5}],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['executed'], 1)
+
+        response = client.post('/api/portfolio/trade/batch/', {'legs': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ValuationTests(TestCase):
+    """Материализованная оценка портфелей совпадает с полным пересчётом после сделок и тиков."""
+
+    def setUp(self):
+        engine.reset()
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.other = User.objects.create_user(username='other', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('100000.00'))
+        funded_portfolio(self.other, Decimal('100000.00'))
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'), lot_size=1)
+        Stock.objects.create(ticker='LKOH', name='Лукойл', current_price=Decimal('7000.00'), lot_size=1)
+        PriceCache.publish()
+
+    def _set_prices(self, **prices):
+        MoexDataService.apply_market_data([
+            {'ticker': ticker, 'last': price, 'lotsize': Stock.objects.get(ticker=ticker).lot_size}
+            for ticker, price in prices.items()
+        ])
+
+    def assertReconciled(self):
+        report = ValuationService.reconcile()
+        self.assertEqual(report['mismatches'], [])
+        self.assertEqual(report['checked'], 2)
+
+    def test_trades_and_ticks_keep_valuation_exact(self):
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 30)['success'])
+        self.assertTrue(PortfolioService.buy_stock(self.other, 'SBER', 10)['success'])
+        self._set_prices(SBER='103.17')
+        # Средняя цена округляется до копеек — себестоимость считается по округлённой
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 20)['success'])
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'GAZP', 7)['success'])
+        self.assertReconciled()
+
+        self._set_prices(SBER='99.91', GAZP='151.37')
+        self.assertTrue(PortfolioService.sell_stock(self.user, 'SBER', 40)['success'])
+        self.assertTrue(PortfolioService.sell_stock(self.other, 'SBER', 10)['success'])
+        self.assertReconciled()
+
+        result = PortfolioService.execute_batch(self.user, [
+            {'action': 'SELL', 'ticker': 'GAZP', 'quantity': 7},
+            {'action': 'BUY', 'ticker': 'LKOH', 'quantity': 3},
+            {'action': 'BUY', 'ticker': 'SBER', 'quantity': 10},
+        ])
+        self.assertTrue(result['success'], result)
+        self.assertTrue(OrderService.place_order(self.user, 'BUY', Order.TYPE_LIMIT, 'SBER', 10, Decimal('95.00'))['success'])
+        self.assertTrue(OrderService.place_order(self.user, 'SELL', Order.TYPE_STOP, 'LKOH', 2, Decimal('6900.00'))['success'])
+        self._set_prices(SBER='94.55', LKOH='6850.10')
+        self.assertEqual(Order.objects.filter(status=Order.STATUS_FILLED).count(), 2)
+        self.assertReconciled()
+
+        self.portfolio.refresh_from_db()
+        summary = PortfolioService.get_portfolio_summary(self.user)
+        self.assertEqual(summary['total_market_value'], sum(asset['market_value'] for asset in summary['assets']))
+        self.assertEqual(summary['net_worth'], self.portfolio.balance + self.portfolio.market_value)
+
+    def test_price_tick_revalues_only_holders(self):
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 10)['success'])
+        with CaptureQueriesContext(connection) as context:
+            self._set_prices(GAZP='200.00')
+        self.assertFalse(any('UPDATE "portfolio_portfolio"' in query['sql'] for query in context.captured_queries))
+
+        self._set_prices(SBER='110.00')
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.market_value, Decimal('1100.00'))
+        self.assertEqual(Portfolio.objects.get(user=self.other).market_value, Decimal('0.00'))
+
+    def test_reconcile_fixes_drift(self):
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 10)['success'])
+        # Правка позиции в обход сделок
+        Asset.objects.filter(portfolio=self.portfolio).update(quantity=20)
+
+        report = ValuationService.reconcile()
+        self.assertEqual(report['mismatches'], [
+            (self.portfolio.pk, (Decimal('1000.00'), Decimal('1000.00')), (Decimal('2000.00'), Decimal('2000.00'))),
+        ])
+        self.assertEqual(report['fixed'], 0)
+        self.assertEqual(ValuationService.reconcile(fix=True)['fixed'], 1)
+        self.assertReconciled()
+
+    def test_fix_rechecks_rows_under_write_lock(self):
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 10)['success'])
+        Asset.objects.filter(portfolio=self.portfolio).update(quantity=20)
+        mismatched = ValuationService.reconcile()['mismatches']
+        self.assertEqual(len(mismatched), 1)
+        # Между сверкой и исправлением позицию вернули: исправлять уже нечего
+        Asset.objects.filter(portfolio=self.portfolio).update(quantity=10)
+        self.assertEqual(ValuationService._fix_batch([self.portfolio.pk]), 0)
+        self.assertReconciled()
+
+    def test_leaderboard_task_does_not_touch_valuations(self):
+        self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 10)['success'])
+        Asset.objects.filter(portfolio=self.portfolio).update(quantity=20)
+        with CaptureQueriesContext(connection) as context:
+            rebuild_leaderboard_task()
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in context.captured_queries))
+        self.assertEqual(len(ValuationService.reconcile()['mismatches']), 1)
+
+        reconcile_valuations_task()
+        self.assertReconciled()
+
+
+class LeaderboardTests(TestCase):
+    """Рейтинг: страницы по курсору, место игрока и соседи, правка снимка приращениями."""
+
+    PLAYERS = 40
+
+    def setUp(self):
+        cache.clear()
+        rng = random.Random(3)
+        users = User.objects.bulk_create([User(username=f"player{i:02d}") for i in range(self.PLAYERS)])
+        # Несколько одинаковых сумм: у равных по стоимости одно место
+        Portfolio.objects.bulk_create([
+            Portfolio(user=user, balance=Decimal(rng.choice([50_000, 75_000, rng.randint(1, 200_000)])))
+            for user in users
+        ])
+        self.user = users[0]
+        self.portfolio = Portfolio.objects.get(user=self.user)
+
+    def _expected_rank(self, net_worth):
+        return 1 + Portfolio.objects.filter(net_worth__gt=net_worth).count()
+
+    def test_pages_cover_everyone_in_order(self):
+        seen, cursor = [], None
+        while True:
+            result = LeaderboardService.get_leaderboard(self.portfolio, limit=7, cursor=cursor)
+            seen.extend(result['top'])
+            if result['next_cursor'] is None:
+                break
+            cursor = LeaderboardService.decode_cursor(result['next_cursor'])
+
+        expected = list(Portfolio.objects.order_by('-net_worth', 'id').values_list('user__username', 'net_worth'))
+        self.assertEqual([(row['username'], row['net_worth']) for row in seen], expected)
+        for row in seen:
+            self.assertEqual(row['rank'], self._expected_rank(row['net_worth']))
+
+    def test_my_rank_and_neighbours(self):
+        result = LeaderboardService.get_leaderboard(self.portfolio, around=3)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(result['total'], self.PLAYERS)
+        self.assertEqual(result['me']['rank'], self._expected_rank(self.portfolio.net_worth))
+
+        ordered = list(Portfolio.objects.order_by('-net_worth', 'id').values_list('user__username', flat=True))
+        position = ordered.index(self.user.username)
+        self.assertEqual([row['username'] for row in result['above']], ordered[max(position - 3, 0):position])
+        self.assertEqual([row['username'] for row in result['below']], ordered[position + 1:position + 4])
+
+    def _assertSnapshotMatchesDatabase(self, snapshot):
+        rebuilt = RankSnapshot.rebuild()
+        for key in ('ids', 'worths', 'sorted_worths'):
+            self.assertEqual(snapshot[key].tolist(), rebuilt[key].tolist())
+
+    def test_price_tick_updates_snapshot_without_rebuild(self):
+        stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=1)
+        Asset.objects.create(portfolio=self.portfolio, stock=stock, quantity=1000, average_buy_price=Decimal('100.00'))
+        ValuationService.reconcile(fix=True)
+        RankSnapshot.rebuild()
+        version = RankSnapshot.version()
+        published = cache.get(SNAPSHOT_KEY)['worths'].tolist()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': '200.00', 'lotsize': 1}])
+        # Сразу после пересборки правка ложится в журнал, снимок в кэше не пересылается
+        self.assertEqual(RankSnapshot.version(), version)
+        self.assertEqual(cache.get(SNAPSHOT_KEY)['worths'].tolist(), published)
+        self.assertNotEqual(RankSnapshot.get_snapshot()['worths'].tolist(), published)
+
+        # Интервал публикации прошёл: следующий тик сворачивает журнал в новую версию
+        cache.delete(COMPACT_LOCK_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': '350.00', 'lotsize': 1}])
+        self.assertNotEqual(RankSnapshot.version(), version)
+
+        # Снимок, поправленный приращениями за оба тика, совпадает с пересобранным из базы
+        snapshot = cache.get(SNAPSHOT_KEY)
+        self._assertSnapshotMatchesDatabase(snapshot)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(RankSnapshot.rank(snapshot, self.portfolio.pk, self.portfolio.net_worth), self._expected_rank(self.portfolio.net_worth))
+
+    def test_ticks_from_several_processes_are_not_lost(self):
+        stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=1)
+        holders = list(Portfolio.objects.order_by('pk')[:3])
+        Asset.objects.bulk_create([
+            Asset(portfolio=portfolio, stock=stock, quantity=100 * (index + 1), average_buy_price=Decimal('100.00'))
+            for index, portfolio in enumerate(holders)
+        ])
+        ValuationService.reconcile(fix=True)
+        RankSnapshot.rebuild()
+
+        # У каждого "процесса" своя копия снимка (как у воркеров Celery prefork)
+        processes = {'a': dict(RankSnapshot._local), 'b': {'version': None, 'seq': None, 'snapshot': None}}
+
+        def tick(process, price, compact=False):
+            RankSnapshot._local = processes[process]
+            if compact:
+                cache.delete(COMPACT_LOCK_KEY)
+            with self.captureOnCommitCallbacks(execute=True):
+                MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': price, 'lotsize': 1}])
+            processes[process] = RankSnapshot._local
+
+        tick('a', '120.00')
+        # Второй тик применяет другой процесс и публикует новую версию: правка первого в ней есть
+        tick('b', '90.00', compact=True)
+        RankSnapshot._local = processes['a']
+        snapshot = RankSnapshot.get_snapshot()
+        self.assertEqual(snapshot['version'], RankSnapshot.version())
+        tick('a', '130.00')
+        RankSnapshot._local = processes['b']
+        self._assertSnapshotMatchesDatabase(RankSnapshot.get_snapshot())
+
+    def test_trades_fills_and_registration_update_snapshot(self):
+        engine.reset()
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=1)
+        PriceCache.publish()
+        Portfolio.objects.filter(pk=self.portfolio.pk).update(balance=Decimal('100000.00'))
+        RankSnapshot.rebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(PortfolioService.buy_stock(self.user, 'SBER', 100)['success'])
+            self.assertTrue(PortfolioService.sell_stock(self.user, 'SBER', 30)['success'])
+            result = PortfolioService.execute_batch(self.user, [{'action': 'BUY', 'ticker': 'SBER', 'quantity': 10}])
+            self.assertTrue(result['success'], result)
+            self.assertTrue(OrderService.place_order(self.user, 'BUY', Order.TYPE_LIMIT, 'SBER', 50, Decimal('95.00'))['success'])
+        with self.captureOnCommitCallbacks(execute=True):
+            MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': '93.17', 'lotsize': 1}])
+        self.assertEqual(Order.objects.get().status, Order.STATUS_FILLED)
+        with self.captureOnCommitCallbacks(execute=True):
+            newcomer = User.objects.create_user(username='newcomer')
+
+        snapshot = RankSnapshot.get_snapshot()
+        self.assertEqual(len(snapshot['ids']), self.PLAYERS + 1)
+        self.assertEqual(LeaderboardService.get_leaderboard(self.portfolio)['total'], self.PLAYERS + 1)
+        newcomer_portfolio = Portfolio.objects.get(user=newcomer)
+        self.assertEqual(
+            LeaderboardService.get_leaderboard(newcomer_portfolio)['me']['rank'],
+            self._expected_rank(newcomer_portfolio.net_worth),
+        )
+        self._assertSnapshotMatchesDatabase(snapshot)
+
+    def test_lost_log_entry_forces_rebuild(self):
+        RankSnapshot.rebuild()
+        RankSnapshot.apply_deltas({self.portfolio.pk: Decimal('10.00')})
+        cache.delete(f"{DELTA_KEY_PREFIX}{cache.get(DELTA_SEQ_KEY)}")
+        with mock.patch.object(RankSnapshot, 'rebuild', wraps=RankSnapshot.rebuild) as rebuild:
+            RankSnapshot.compact()
+        rebuild.assert_called_once()
+
+    def test_rank_ignores_own_stale_entry(self):
+        RankSnapshot.rebuild()
+        # Игрок потерял деньги после пересборки: его старая запись в снимке выше него
+        Portfolio.objects.filter(pk=self.portfolio.pk).update(balance=Decimal('0.00'))
+        result = LeaderboardService.get_leaderboard(self.portfolio)
+        self.assertEqual(result['me']['rank'], self.PLAYERS)
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/api/portfolio/leaderboard/', {'limit': 5})
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual(len(body['top']), 5)
+        self.assertEqual(body['top'][0]['rank'], 1)
+
+        response = client.get('/api/portfolio/leaderboard/', {'limit': 5, 'cursor': body['next_cursor']})
+        self.assertEqual(response.json()['top'][0]['rank'], self._expected_rank(Decimal(response.json()['top'][0]['net_worth'])))
+        self.assertEqual(client.get('/api/portfolio/leaderboard/', {'cursor': 'bad'}).status_code, 400)
+
+    def test_page_query_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Планы сверяются с форматом EXPLAIN QUERY PLAN SQLite')
+        queryset = Portfolio.objects.order_by('-net_worth', 'id').values_list('id', 'user__username', 'net_worth')[:20]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = ' | '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('portfolio_net_worth_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TransactionHistoryTests(TestCase):
+    """История транзакций: страницы по курсору, фильтры и потоковая выгрузка."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user)
+        sber = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'))
+        gazp = Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.00'))
+        Transaction.objects.bulk_create([
+            Transaction(
+                portfolio=self.portfolio,
+                stock=sber if i % 3 else gazp,
+                action='BUY' if i % 2 else 'SELL',
+                quantity=i + 1,
+                price=Decimal('100.00'),
+                commission=Decimal('0.10'),
+            )
+            for i in range(45)
+        ])
+        # Часть сделок в один и тот же момент: порядок внутри него задаёт id
+        base = timezone.now()
+        for transaction_id in Transaction.objects.values_list('id', flat=True):
+            Transaction.objects.filter(pk=transaction_id).update(timestamp=base - timedelta(days=transaction_id // 4))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _expected(self, **filters):
+        return list(Transaction.objects.filter(**filters).order_by('-timestamp', '-id').values_list('id', flat=True))
+
+    def test_cursor_pages_cover_history_without_gaps(self):
+        seen, cursor = [], None
+        while True:
+            page = PortfolioService.get_transaction_history(self.user, limit=10, cursor=cursor)
+            seen.extend(row['id'] for row in page['results'])
+            if page['next_cursor'] is None:
+                break
+            cursor = PortfolioService.decode_history_cursor(page['next_cursor'])
+        self.assertEqual(seen, self._expected())
+
+    def test_filters(self):
+        today = timezone.localdate()
+        response = self.client.get('/api/portfolio/history/', {
+            'ticker': 'sber', 'action': 'buy', 'date_from': today - timedelta(days=5), 'date_to': today, 'limit': 200,
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        expected = self._expected(
+            stock__ticker='SBER', action='BUY',
+            timestamp__gte=timezone.make_aware(datetime.combine(today - timedelta(days=5), datetime.min.time())),
+        )
+        self.assertTrue(expected)
+        self.assertEqual([row['id'] for row in response.json()['results']], expected)
+        self.assertIsNone(response.json()['next_cursor'])
+        self.assertEqual(self.client.get('/api/portfolio/history/', {'cursor': 'x'}).status_code, 400)
+
+    def test_page_query_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Планы сверяются с форматом EXPLAIN QUERY PLAN SQLite')
+        last = Transaction.objects.order_by('-timestamp', '-id')[10]
+        queryset = PortfolioService.history_queryset(self.portfolio, cursor=(last.timestamp, last.id))[:10]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = ' | '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('portfolio_tx_history_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_export_streams_in_chunks(self):
+        with mock.patch('apps.portfolio.services.HISTORY_EXPORT_CHUNK_SIZE', 20):
+            chunks = list(PortfolioService.export_transaction_history(self.portfolio, file_format='ndjson'))
+        self.assertEqual(len(chunks), 3)
+        rows = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+        self.assertEqual([row['id'] for row in rows], self._expected())
+
+        response = self.client.get('/api/portfolio/history/export/', {'type': 'csv', 'ticker': 'GAZP'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,timestamp,action,ticker,quantity,price,total,commission')
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], self._expected(stock__ticker='GAZP'))
+
+
+class EquitySnapshotTests(TestCase):
+    """Ежедневные снимки капитала: расчёт в NumPy совпадает с расчётом в Python, прогон продолжается после сбоя."""
+
+    def setUp(self):
+        rng = random.Random(11)
+        stocks = Stock.objects.bulk_create([
+            Stock(ticker=f"E{i:02d}", name=f"Stock {i}", current_price=Decimal(rng.randint(1, 500_000)) / 100)
+            for i in range(20)
+        ])
+        users = User.objects.bulk_create([User(username=f"investor{i:02d}") for i in range(30)])
+        portfolios = Portfolio.objects.bulk_create([
+            Portfolio(user=user, balance=Decimal(rng.randint(0, 10_000_000)) / 100) for user in users
+        ])
+        Asset.objects.bulk_create([
+            Asset(portfolio=portfolio, stock=stock, quantity=rng.randint(1, 500), average_buy_price=Decimal('1.00'))
+            for portfolio in portfolios[1:]  # Первый портфель — без позиций
+            for stock in rng.sample(stocks, rng.randint(1, 8))
+        ])
+        self.portfolios = portfolios
+
+    def _expected(self, portfolio):
+        assets = portfolio.assets.select_related('stock')
+        market_value = sum((asset.quantity * asset.stock.current_price for asset in assets), Decimal('0.00'))
+        positions = {asset.stock.ticker: asset.quantity for asset in assets}
+        return portfolio.balance, market_value, portfolio.balance + market_value, positions
+
+    def test_matches_python_valuation(self):
+        report = EquitySnapshotService.snapshot_all(chunk_size=7)
+        self.assertEqual(report['created'], 30)
+        for portfolio in self.portfolios:
+            snapshot = EquitySnapshot.objects.get(portfolio=portfolio)
+            self.assertEqual(
+                (snapshot.balance, snapshot.market_value, snapshot.net_worth, snapshot.positions),
+                self._expected(portfolio),
+            )
+
+    def test_resumes_after_interruption(self):
+        with mock.patch.object(EquitySnapshot.objects, 'bulk_create', side_effect=[mock.DEFAULT, RuntimeError('killed')],
+                               wraps=EquitySnapshot.objects.bulk_create):
+            with self.assertRaises(RuntimeError):
+                EquitySnapshotService.snapshot_all(chunk_size=10)
+        self.assertEqual(EquitySnapshot.objects.count(), 10)
+
+        report = EquitySnapshotService.snapshot_all(chunk_size=10)
+        self.assertEqual(report['resumed_after'], self.portfolios[9].pk)
+        self.assertEqual(report['created'], 20)
+        self.assertEqual(EquitySnapshot.objects.count(), 30)
+        # Повторный прогон за тот же день ничего не дописывает
+        self.assertEqual(EquitySnapshotService.snapshot_all()['created'], 0)
+
+    def test_endpoint(self):
+        portfolio = self.portfolios[1]
+        today = timezone.localdate()
+        for days_ago in (2, 1):
+            EquitySnapshotService.snapshot_all(date=today - timedelta(days=days_ago))
+        client = APIClient()
+        client.force_authenticate(portfolio.user)
+        response = client.get('/api/portfolio/equity/', {'days': 30})
+        self.assertEqual(response.status_code, 200, response.content)
+        points = response.json()['points']
+        self.assertEqual([point['date'] for point in points], [str(today - timedelta(days=2)), str(today - timedelta(days=1))])
+        self.assertEqual(Decimal(str(points[0]['net_worth'])), self._expected(portfolio)[2])
+
+
+class AnalyticsTests(TestCase):
+    """Риск и доходность: метрики на известных рядах, выравнивание цен, кэш по версии данных."""
+
+    def setUp(self):
+        cache.clear()
+        PortfolioAnalytics._cached.cache_clear()
+        PortfolioAnalytics._settled_history.cache_clear()
+        self.index = Stock.objects.create(ticker='IDX', name='Index', current_price=Decimal('110.00'), is_blue_chip=True)
+        self.stock = Stock.objects.create(ticker='LEV', name='Leveraged', current_price=Decimal('120.00'), sector='FINS')
+        self.portfolio = funded_portfolio(User.objects.create(username='analyst'), Decimal('0.00'))
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=10, average_buy_price=Decimal('100.00'))
+
+        # Индекс: 100, 105, 95, 110 (сегодня); бумага портфеля ходит вдвое сильнее рынка
+        today = timezone.localdate()
+        midnight = lambda days_ago: timezone.make_aware(datetime.combine(today - timedelta(days=days_ago), datetime.min.time()))
+        candles = []
+        for days_ago, index_close, stock_close in ((3, 100, 100), (2, 105, 110), (1, 95, None)):
+            for stock, close in ((self.index, index_close), (self.stock, stock_close)):
+                if close is not None:  # Пропуск — у бумаги не было торгов
+                    candles.append(Candle(stock=stock, interval=Candle.INTERVAL_1D, bucket_start=midnight(days_ago),
+                                          open=close, high=close, low=close, close=close))
+        Candle.objects.bulk_create(candles)
+
+    def test_metrics_on_known_series(self):
+        market = np.array([0.01, -0.02, 0.03, 0.005])
+        values = np.cumprod(np.r_[100.0, 1 + 2 * market])
+        metrics = compute_metrics(values, market)
+        self.assertEqual(metrics['beta'], 2.0)
+        self.assertEqual(metrics['max_drawdown_percent'], -4.0)
+        self.assertEqual(compute_metrics([100, 101])['volatility_percent'], None)
+
+    def test_forward_fill(self):
+        prices = np.array([[np.nan, 1.0], [2.0, np.nan], [np.nan, 3.0]])
+        np.testing.assert_array_equal(_forward_fill(prices), [[2.0, 1.0], [2.0, 1.0], [2.0, 3.0]])
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.portfolio.user)
+        response = client.get('/api/portfolio/analytics/', {'days': 30})
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+
+        # Стоимость портфеля: 1000, 1100, 1100 (пропуск), 1200
+        self.assertEqual(data['period']['points'], 4)
+        self.assertEqual(data['total_return_percent'], 20.0)
+        self.assertEqual(data['max_drawdown_percent'], 0.0)
+        self.assertIsNotNone(data['beta'])
+        self.assertEqual(data['sector_exposure'], [
+            {'sector': 'FINS', 'name': 'Финансовый сектор', 'market_value': 1200.0, 'weight_percent': 100.0}
+        ])
+        self.assertEqual(client.get('/api/portfolio/analytics/', {'days': 1}).status_code, 400)
+
+    def test_cached_per_data_version(self):
+        first = PortfolioAnalytics.get_analytics(self.portfolio, 30)
+        # Повтор при той же версии цен — только чтение позиций, без свечей
+        with self.assertNumQueries(1):
+            self.assertEqual(PortfolioAnalytics.get_analytics(self.portfolio, 30), first)
+
+        Stock.objects.filter(pk=self.stock.pk).update(current_price=Decimal('60.00'))
+        PriceCache.publish()
+        self.assertEqual(PortfolioAnalytics.get_analytics(self.portfolio, 30)['total_return_percent'], -40.0)
+
+
+class LedgerReplayTests(TestCase):
+    """Сверка с журналом: сделки всех видов сходятся, ручные правки находятся и исправляются."""
+
+    def setUp(self):
+        self.sber = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        self.gazp = Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.55'))
+        self.users = [User.objects.create(username=f"trader{i}") for i in range(5)]
+        PriceCache.publish()
+
+        for user in self.users:
+            PortfolioService.buy_stock(user, 'SBER', 30)
+            PortfolioService.buy_stock(user, 'GAZP', 7)
+        self._set_price(self.sber, '103.37')
+        PortfolioService.buy_stock(self.users[0], 'SBER', 20)
+        PortfolioService.sell_stock(self.users[1], 'SBER', 30)
+        PortfolioService.execute_batch(self.users[2], [
+            {'action': 'SELL', 'ticker': 'GAZP', 'quantity': 3}, {'action': 'BUY', 'ticker': 'SBER', 'quantity': 10},
+        ])
+        OrderService.place_order(self.users[3], 'BUY', Order.TYPE_LIMIT, 'GAZP', 5, Decimal('140.00'))
+        OrderService.place_order(self.users[3], 'SELL', Order.TYPE_LIMIT, 'SBER', 10, Decimal('120.00'))
+        order = OrderService.place_order(self.users[4], 'BUY', Order.TYPE_STOP, 'SBER', 10, Decimal('105.00'))
+        OrderService.execute_orders([order['order_id']], {self.sber.pk: Decimal('105.10')})
+        self.portfolios = [user.portfolio for user in self.users]
+
+    def _set_price(self, stock, price):
+        Stock.objects.filter(pk=stock.pk).update(current_price=Decimal(price))
+        PriceCache.publish()
+
+    def test_trades_match_ledger(self):
+        report = LedgerService.replay_all(workers=1, range_size=2)
+        self.assertEqual(report['ranges'], 3)
+        self.assertEqual((report['portfolios'], report['transactions']), (5, 15))
+        self.assertEqual(report['drifted'], 0, report['drifts'])
+
+    def test_finds_and_repairs_drift(self):
+        first, second, third = self.portfolios[:3]
+        Portfolio.objects.filter(pk=first.pk).update(balance=F('balance') + 1)
+        Asset.objects.filter(portfolio=second, stock=self.gazp).update(quantity=1, average_buy_price=Decimal('1.00'))
+        Asset.objects.filter(portfolio=third, stock=self.sber).delete()
+        Asset.objects.filter(portfolio=self.portfolios[3], stock=self.sber).update(reserved_quantity=0)
+
+        report = LedgerService.replay_all(workers=1)
+        self.assertEqual(report['drifted'], 4)
+        self.assertEqual(
+            {(drift['portfolio_id'], drift['stock_id'], drift['field']) for drift in report['drifts']},
+            {
+                (first.pk, None, 'balance'),
+                (second.pk, self.gazp.pk, 'quantity'), (second.pk, self.gazp.pk, 'average_buy_price'),
+                (third.pk, self.sber.pk, 'quantity'), (third.pk, self.sber.pk, 'average_buy_price'),
+                (self.portfolios[3].pk, self.sber.pk, 'reserved_quantity'),
+            },
+        )
+        self.assertEqual(report['repaired'], 0)
+
+        self.assertEqual(LedgerService.replay_all(fix=True, workers=1)['repaired'], 4)
+        self.assertEqual(LedgerService.replay_all(workers=1)['drifted'], 0)
+        # Оценка исправленных портфелей пересчитана вместе с позициями
+        # (у последнего — заявка исполнена по цене выше текущей, его оценку правит reconcile)
+        mismatched = {portfolio_id for portfolio_id, *_ in ValuationService.reconcile()['mismatches']}
+        self.assertFalse(mismatched & {portfolio.pk for portfolio in self.portfolios[:4]})
+
+    def test_command(self):
+        Portfolio.objects.filter(pk=self.portfolios[0].pk).update(reserved_balance=Decimal('5.00'))
+        out, err = io.StringIO(), io.StringIO()
+        call_command('replayledger', '--workers', '1', stdout=out, stderr=err)
+        self.assertIn('reserved_balance', out.getvalue())
+        self.assertIn('1 drifted', err.getvalue())
+
+
+class TransactionArchiveTests(TestCase):
+    """Архив транзакций: история и сверка с журналом видят перенесённые строки, прогон продолжается."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='archivist')
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'))
+        Stock.objects.create(ticker='GAZP', name='Газпром', current_price=Decimal('150.55'))
+        PriceCache.publish()
+        for i in range(12):
+            PortfolioService.buy_stock(self.user, 'SBER' if i % 3 else 'GAZP', i + 1)
+            if i % 4 == 3:
+                PortfolioService.sell_stock(self.user, 'SBER', 2)
+        self.portfolio = self.user.portfolio
+        # Первые 12 транзакций — по одной в месяц два-три года назад, остальные свежие
+        now = timezone.now()
+        for index, transaction_id in enumerate(Transaction.objects.order_by('id').values_list('id', flat=True)[:12]):
+            Transaction.objects.filter(pk=transaction_id).update(timestamp=now - timedelta(days=900 - 30 * index))
+        self.total = Transaction.objects.count()
+        self.history = self._history()
+        self.months = {
+            timezone.localtime(moment).date().replace(day=1)
+            for moment in Transaction.objects.order_by('id').values_list('timestamp', flat=True)[:12]
+        }
+
+    def _history(self, **filters):
+        seen, cursor = [], None
+        while True:
+            page = PortfolioService.get_transaction_history(self.user, limit=4, cursor=cursor, filters=filters)
+            seen.extend(row['id'] for row in page['results'])
+            if page['next_cursor'] is None:
+                return seen
+            cursor = PortfolioService.decode_history_cursor(page['next_cursor'])
+
+    def test_history_and_export_read_archive(self):
+        sber_history = self._history(ticker='SBER')
+        report = TransactionArchiveService.archive(batch_size=5, pause=0)
+        self.assertTrue(report['done'])
+        self.assertEqual(report['archived'], 12)
+        self.assertEqual(Transaction.objects.count(), self.total - 12)
+        self.assertEqual(set(TransactionArchive.objects.filter(portfolio=self.portfolio).values_list('month', flat=True)), self.months)
+
+        self.assertEqual(self._history(), self.history)
+        self.assertEqual(self._history(ticker='SBER'), sber_history)
+        lines = ''.join(PortfolioService.export_transaction_history(self.portfolio, file_format='ndjson')).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.history)
+
+    def test_resumes_and_keeps_ledger(self):
+        self.assertEqual(TransactionArchiveService.archive(batch_size=5, max_batches=1, pause=0)['archived'], 5)
+        self.assertEqual(TransactionArchiveService.archive(batch_size=5, pause=0)['archived'], 7)
+        self.assertEqual(TransactionArchiveService.archive(pause=0)['archived'], 0)
+
+        report = LedgerService.replay_all(workers=1)
+        self.assertEqual(report['transactions'], self.total)
+        self.assertEqual(report['drifted'], 0, report['drifts'])
+        self.assertEqual(
+            sum(ArchivedPosition.objects.filter(portfolio=self.portfolio).values_list('transactions', flat=True)), 12
+        )
+
+
+class TriggerBookTests(TestCase):
+
+    def test_pop_touches_only_triggered(self):
+        book = TriggerBook()
+        for order_id in range(20000):
+            book.add(Decimal(order_id % 1000) / 10, order_id)
+
+        triggered = book.pop_triggered(Decimal('99.0'))
+        # Ключи 99.0..99.9 — по 20 заявок на ключ
+        self.assertEqual(len(triggered), 200)
+        self.assertTrue(all(order_id % 1000 >= 990 for order_id in triggered))
+        self.assertEqual(len(book), 19800)
+        self.assertEqual(book.pop_triggered(Decimal('99.0')), [])
+
+    def test_extend_matches_single_adds(self):
+        entries = [(Decimal(order_id % 97), order_id) for order_id in range(5000)]
+        single, bulk = TriggerBook(), TriggerBook()
+        for key, order_id in entries:
+            single.add(key, order_id)
+        bulk.extend(entries[:3000])
+        bulk.extend(entries[3000:])
+        self.assertEqual((bulk.keys, bulk.ids), (single.keys, single.ids))
+
+
+class PendingOrderTests(TestCase):
+    """Лимитные и стоп-заявки: резерв, срабатывание по цене, отмена."""
+
+    def setUp(self):
+        engine.reset()
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('10000.00'))
+        self.stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        PriceCache.publish()
+
+    def _set_price(self, price):
+        return MoexDataService.apply_market_data([{'ticker': 'SBER', 'last': price, 'lotsize': 10}])
+
+    def test_buy_limit_reserves_and_fills_below_limit(self):
+        result = OrderService.place_order(self.user, 'BUY', Order.TYPE_LIMIT, 'SBER', 50, Decimal('90.00'))
+        self.assertTrue(result['success'], result)
+        self.portfolio.refresh_from_db()
+        # 90 * 50 + комиссия 4.50
+        self.assertEqual(self.portfolio.reserved_balance, Decimal('4504.50'))
+
+        # Зарезервированные деньги нельзя потратить рыночной покупкой
+        self.assertFalse(PortfolioService.buy_stock(self.user, 'SBER', 60)['success'])
+
+        self._set_price('95.00')
+        self.assertEqual(Order.objects.get().status, Order.STATUS_OPEN)
+
+        self._set_price('85.00')
+        order = Order.objects.get()
+        self.assertEqual(order.status, Order.STATUS_FILLED)
+        self.assertEqual(order.fill_price, Decimal('85.00'))
+
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.reserved_balance, Decimal('0.00'))
+        # Списано по цене исполнения: 85 * 50 + 4.25
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') - Decimal('4254.25'))
+        asset = Asset.objects.get(portfolio=self.portfolio)
+        self.assertEqual((asset.quantity, asset.average_buy_price), (50, Decimal('85.00')))
+
+    def test_stop_loss_sells_reserved_shares(self):
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=30, average_buy_price=Decimal('100.00'))
+        self.assertTrue(OrderService.place_order(self.user, 'SELL', Order.TYPE_STOP, 'SBER', 20, Decimal('95.00'))['success'])
+        # Свободно только 10 акций: 20 не продать, а все свободные 10 — можно
+        self.assertFalse(PortfolioService.sell_stock(self.user, 'SBER', 20)['success'])
+        self.assertTrue(PortfolioService.sell_stock(self.user, 'SBER', 10)['success'])
+        asset = Asset.objects.get(portfolio=self.portfolio)
+        self.assertEqual((asset.quantity, asset.reserved_quantity), (20, 20))
+
+        self._set_price('94.00')
+        self.assertEqual(Order.objects.get().status, Order.STATUS_FILLED)
+        # Заявка продала всю позицию — она закрыта
+        self.assertFalse(Asset.objects.filter(portfolio=self.portfolio).exists())
+        self.portfolio.refresh_from_db()
+        # 100 * 10 - 1.00 и 94 * 20 - 1.88
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') + Decimal('999.00') + Decimal('1878.12'))
+
+    def test_marketable_order_fills_on_next_run(self):
+        # Лимит выше текущей цены исполним сразу: сработает на ближайшем прогоне,
+        # даже если цена этой акции не изменилась
+        OrderService.place_order(self.user, 'BUY', Order.TYPE_LIMIT, 'SBER', 10, Decimal('110.00'))
+        report = self._set_price('100.00')
+        self.assertEqual(report['changed'], 0)
+        self.assertEqual(Order.objects.get().status, Order.STATUS_FILLED)
+
+    def test_cancel_releases_reservation(self):
+        order_id = OrderService.place_order(self.user, 'BUY', Order.TYPE_LIMIT, 'SBER', 10, Decimal('90.00'))['order_id']
+        self.assertTrue(OrderService.cancel_order(self.user, order_id)['success'])
+        self.assertFalse(OrderService.cancel_order(self.user, order_id)['success'])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.reserved_balance, Decimal('0.00'))
+
+        # Отменённая заявка в книге не исполняется
+        self._set_price('80.00')
+        self.assertEqual(Order.objects.get().status, Order.STATUS_CANCELLED)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_endpoints(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/portfolio/orders/', {
+            'action': 'buy', 'order_type': 'limit', 'ticker': 'sber', 'quantity': 10, 'trigger_price': '90.00',
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        order_id = response.json()['order_id']
+
+        response = client.get('/api/portfolio/orders/?status=open')
+        self.assertEqual([order['id'] for order in response.json()], [order_id])
+
+        response = client.post(f'/api/portfolio/orders/{order_id}/cancel/')
+        self.assertEqual(response.status_code, 200)
+
+        response = client.post('/api/portfolio/orders/abc/cancel/')
+        self.assertEqual(response.status_code, 404)
+
+
+class IdempotencyKeyTests(TestCase):
+    """Повтор POST сделки с тем же Idempotency-Key не повторяет сделку."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='trader', password='pass')
+        funded_portfolio(self.user, Decimal('10000.00'))
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        PriceCache.publish()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _buy(self, key, quantity=10):
+        return self.client.post('/api/portfolio/trade/buy/', {'ticker': 'SBER', 'quantity': quantity}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay_returns_stored_response_without_queries(self):
+        # Ответ попадает в кэш после коммита транзакции сделки
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self._buy('click-1')
+        self.assertEqual(first.status_code, 200)
+
+        with self.assertNumQueries(0):
+            replay = self._buy('click-1')
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_replay_from_database_after_cache_loss(self):
+        self._buy('click-1')
+        cache.clear()
+        PriceCache.publish()
+        self.assertEqual(self._buy('click-1')['Idempotent-Replayed'], 'true')
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_key_reuse_with_other_request_is_rejected(self):
+        self._buy('click-1')
+        self.assertEqual(self._buy('click-1', quantity=20).status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_without_key_every_request_executes(self):
+        self.client.post('/api/portfolio/trade/buy/', {'ticker': 'SBER', 'quantity': 10}, format='json')
+        self.client.post('/api/portfolio/trade/buy/', {'ticker': 'SBER', 'quantity': 10}, format='json')
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class PortfolioResolutionTests(TestCase):
+    """Портфель создаётся при регистрации; эндпоинты не ищут его по пользователю на каждом запросе."""
+
+    # Запросов на вызов при тёплом кэше токенов и цен (без SAVEPOINT)
+    ENDPOINT_QUERIES = [
+        ('post', '/api/portfolio/trade/buy/', {'ticker': 'SBER', 'quantity': 10}, 3),
+        ('post', '/api/portfolio/trade/sell/', {'ticker': 'SBER', 'quantity': 5}, 3),
+        ('post', '/api/portfolio/trade/batch/', {'mode': 'best_effort', 'legs': [{'action': 'BUY', 'ticker': 'SBER', 'quantity': 1}]}, 5),
+        ('post', '/api/portfolio/orders/', {'action': 'BUY', 'order_type': 'LIMIT', 'ticker': 'SBER', 'quantity': 1, 'trigger_price': '90.00'}, 2),
+        ('get', '/api/portfolio/orders/', None, 1),
+        ('get', '/api/portfolio/summary/', None, 1),
+        ('get', '/api/portfolio/summary/?assets=false', None, 1),
+        ('get', '/api/portfolio/equity/', None, 1),
+        ('get', '/api/portfolio/analytics/', None, 3),
+        ('get', '/api/portfolio/leaderboard/', None, 4),
+        ('get', '/api/portfolio/history/', None, 2),
+        ('get', '/api/portfolio/history/export/?type=csv', None, 2),
+    ]
+
+    def setUp(self):
+        cache.clear()
+        CachedTokenAuthentication.local.clear()
+        PortfolioAnalytics._cached.cache_clear()
+        PortfolioAnalytics._settled_history.cache_clear()
+        self.user = User.objects.create(username='resolver')
+        funded_portfolio(self.user)
+        Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=1, is_blue_chip=True)
+        PriceCache.publish()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+
+    def _call(self, method, url, data):
+        with CaptureQueriesContext(connection) as ctx:
+            if data is None:
+                response = getattr(self.client, method)(url)
+            else:
+                response = getattr(self.client, method)(url, data, format='json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 300, url)
+        return [query['sql'] for query in ctx.captured_queries if 'SAVEPOINT' not in query['sql']]
+
+    def test_registration_creates_portfolio(self):
+        response = APIClient().post('/auth/users/', {'username': 'newcomer', 'password': 'Sup3r-secret-pass'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        portfolio = Portfolio.objects.get(user_id=response.json()['id'])
+        self.assertEqual(portfolio.balance, Decimal('100000.00'))
+
+    def test_backfill_creates_missing_portfolios(self):
+        # Пользователи, созданные в обход post_save (как до создания портфеля при регистрации)
+        User.objects.bulk_create([User(username=f"legacy{i}") for i in range(5)])
+        out = io.StringIO()
+        call_command('backfillportfolios', '--batch-size', '2', stdout=out)
+        self.assertIn('5 portfolios created', out.getvalue())
+        self.assertFalse(User.objects.filter(portfolio__isnull=True).exists())
+        call_command('backfillportfolios', stdout=out)
+        self.assertIn('0 portfolios created', out.getvalue())
+
+    def test_resolved_portfolio_reads_fresh_balance(self):
+        self.user.portfolio_id = Portfolio.objects.get(user=self.user).pk
+        with self.assertNumQueries(0):
+            portfolio = PortfolioService.resolve_portfolio(self.user)
+        Portfolio.objects.filter(pk=portfolio.pk).update(balance=Decimal('42.00'))
+        self.assertEqual(portfolio.balance, Decimal('42.00'))
+
+    def test_endpoints_do_not_look_up_portfolio(self):
+        # Первый проход прогревает кэши токена, снимка рейтинга и истории цен
+        for method, url, data, _ in self.ENDPOINT_QUERIES:
+            self._call(method, url, data)
+        for method, url, data, expected in self.ENDPOINT_QUERIES:
+            queries = self._call(method, url, data)
+            self.assertEqual(len(queries), expected, f"{url}: " + '\n'.join(queries))
+            lookups = [sql for sql in queries if 'authtoken_token' in sql or (
+                sql.startswith('SELECT') and 'FROM "portfolio_portfolio" WHERE "portfolio_portfolio"."user_id"' in sql
+                and 'LIMIT 21' in sql
+            )]
+            self.assertEqual(lookups, [], url)
+
+        for order_id in Order.objects.filter(status=Order.STATUS_OPEN).values_list('pk', flat=True):
+            self.assertEqual(len(self._call('post', f'/api/portfolio/orders/{order_id}/cancel/', None)), 4)
+
+
+class ConcurrentTradeTests(TransactionTestCase):
+    """Параллельные покупки в один портфель не уводят баланс в минус."""
+
+    BUYERS = 16
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='trader', password='pass')
+        self.portfolio = funded_portfolio(self.user, Decimal('10000.00'))
+        self.stock = Stock.objects.create(ticker='SBER', name='Сбербанк', current_price=Decimal('100.00'), lot_size=10)
+        Asset.objects.create(portfolio=self.portfolio, stock=self.stock, quantity=10, average_buy_price=Decimal('50.00'))
+        PriceCache.publish()
+
+    def test_parallel_buys(self):
+        barrier = threading.Barrier(self.BUYERS)
+
+        def buy():
+            try:
+                barrier.wait()
+                return PortfolioService.buy_stock(self.user, 'SBER', 10)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.BUYERS) as pool:
+            results = list(pool.map(lambda _: buy(), range(self.BUYERS)))
+
+        # Каждая покупка стоит 1000 + 1 комиссии: из 10000 проходят ровно 9
+        succeeded = sum(result['success'] for result in results)
+        self.assertEqual(succeeded, 9)
+
+        self.portfolio.refresh_from_db()
+        self.assertGreaterEqual(self.portfolio.balance, Decimal('0'))
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') - 9 * Decimal('1001.00'))
+
+        asset = Asset.objects.get(portfolio=self.portfolio, stock=self.stock)
+        self.assertEqual(asset.quantity, 100)
+        # (50 * 10 + 100 * 90) / 100
+        self.assertEqual(asset.average_buy_price, Decimal('95.00'))
+        self.assertEqual(Transaction.objects.filter(portfolio=self.portfolio, action='BUY').count(), 9)
+
+    def test_parallel_batches(self):
+        # Пакет сначала читает портфель и позиции, потом пишет: без BEGIN IMMEDIATE
+        # встречные пакеты падали бы с "database is locked", не дожидаясь timeout
+        barrier = threading.Barrier(self.BUYERS)
+
+        def batch():
+            try:
+                barrier.wait()
+                return PortfolioService.execute_batch(self.user, [{'action': 'BUY', 'ticker': 'SBER', 'quantity': 10}])
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.BUYERS) as pool:
+            results = list(pool.map(lambda _: batch(), range(self.BUYERS)))
+
+        self.assertEqual(sum(result['success'] for result in results), 9)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') - 9 * Decimal('1001.00'))
+
+    def test_only_write_paths_take_the_write_lock_at_begin(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('BEGIN IMMEDIATE — особенность SQLite')
+        with CaptureQueriesContext(connection) as ctx:
+            with transaction.atomic():
+                Portfolio.objects.count()
+            with write_transaction():
+                Portfolio.objects.count()
+                # Вложенный блок — точка сохранения в той же транзакции
+                with write_transaction():
+                    Portfolio.objects.count()
+        begins = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('BEGIN')]
+        self.assertEqual(begins, ['BEGIN', 'BEGIN IMMEDIATE'])
+        self.assertIsNone(connection.transaction_mode)
+
+    def test_parallel_duplicates_execute_once(self):
+        barrier = threading.Barrier(self.BUYERS)
+
+        def buy():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                return client.post(
+                    '/api/portfolio/trade/buy/', {'ticker': 'SBER', 'quantity': 10},
+                    format='json', HTTP_IDEMPOTENCY_KEY='retry-storm',
+                )
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.BUYERS) as pool:
+            responses = list(pool.map(lambda _: buy(), range(self.BUYERS)))
+
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(len({response.content for response in responses}), 1)
+        self.assertEqual(Transaction.objects.filter(portfolio=self.portfolio).count(), 1)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.balance, Decimal('10000.00') - Decimal('1001.00'))
@@ -1,10 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import TradingViewSet, PortfolioViewSet
+from .views import TradingViewSet, OrderViewSet, PortfolioViewSet
 
 router = DefaultRouter()
 # /api/portfolio/trade/buy/ и /api/portfolio/trade/sell/
 router.register(r'trade', TradingViewSet, basename='trade')
+# /api/portfolio/orders/ и /api/portfolio/orders/{id}/cancel/
+router.register(r'orders', OrderViewSet, basename='order')
 # 💡 /api/portfolio/summary/ (благодаря @action(detail=False, methods=['get']) на PortfolioViewSet)
 router.register(r'', PortfolioViewSet, basename='portfolio')
 
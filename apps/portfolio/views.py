@@ -1,22 +1,52 @@
 import logging
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from .serializers import TradeSerializer
-from .services import PortfolioService
+from .analytics import PortfolioAnalytics
+from .equity import EquitySnapshotService
+from .idempotency import idempotent
+from .models import Order
+from .leaderboard import LeaderboardService
+from .serializers import (
+    TradeSerializer, BatchTradeSerializer, OrderCreateSerializer, OrderSerializer, LeaderboardQuerySerializer,
+    TransactionHistoryQuerySerializer, EquityCurveQuerySerializer, AnalyticsQuerySerializer,
+)
+from .services import PortfolioService, OrderService
 
 logger = logging.getLogger(__name__)
 
+# Тип содержимого и расширение файла выгрузки истории
+HISTORY_EXPORT_CONTENT_TYPES = {
+    TransactionHistoryQuerySerializer.EXPORT_CSV: 'text/csv; charset=utf-8',
+    TransactionHistoryQuerySerializer.EXPORT_NDJSON: 'application/x-ndjson; charset=utf-8',
+}
+
+
+async def _iterate_in_thread(iterator):
+    """
+    Синхронный генератор для асинхронного потока ответа. Под ASGI StreamingHttpResponse
+    собрал бы синхронный итератор в список целиком — здесь каждый шаг (с запросами ORM)
+    выполняется в потоке sync_to_async, и в памяти только текущая часть.
+    """
+    step = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await step(iterator, None)) is not None:
+        yield chunk
+
 class TradingViewSet(viewsets.GenericViewSet):
     """
     ViewSet для обработки запросов на покупку/продажу акций.
     Доступен только для аутентифицированных пользователей.
+    С заголовком Idempotency-Key повтор запроса возвращает первый ответ, не повторяя сделку.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = TradeSerializer
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def buy(self, request):
         """Обрабатывает запрос на покупку акций."""
         serializer = self.get_serializer(data=request.data)
@@ -41,6 +71,7 @@ class TradingViewSet(viewsets.GenericViewSet):
             return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def sell(self, request):
         """Обрабатывает запрос на продажу акций."""
         serializer = self.get_serializer(data=request.data)
@@ -64,22 +95,166 @@ class TradingViewSet(viewsets.GenericViewSet):
             logger.warning(f"Ошибка продажи для пользователя {user.username}: {result['error']}")
             return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], serializer_class=BatchTradeSerializer)
+    @idempotent
+    def batch(self, request):
+        """
+        Пакет заявок одной транзакцией: /api/portfolio/trade/batch/
+        {"mode": "all_or_nothing" | "best_effort",
+         "legs": [{"action": "SELL", "ticker": "GAZP", "quantity": 10}, ...]}
+        Ответ содержит результат по каждой заявке в порядке запроса.
+        """
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        all_or_nothing = serializer.validated_data['mode'] == BatchTradeSerializer.MODE_ALL_OR_NOTHING
+        result = PortfolioService.execute_batch(request.user, serializer.validated_data['legs'], all_or_nothing)
+
+        # Пакет, в котором ничего не исполнено, — ошибка; частичное исполнение — 200 с деталями
+        if result['executed'] == 0:
+            logger.warning(f"Пакет заявок пользователя {request.user.username} отклонён: {result['failed']} ошибок.")
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
+
+class OrderViewSet(viewsets.GenericViewSet):
+    """
+    Отложенные заявки (лимитные и стоп).
+    GET /api/portfolio/orders/ — заявки пользователя (?status=OPEN — только активные),
+    POST /api/portfolio/orders/ — новая заявка,
+    POST /api/portfolio/orders/{id}/cancel/ — отмена с возвратом резерва.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = OrderSerializer
+    # id заявки — только цифры: иначе маршрут не совпадёт и вернётся 404, а не 500 из базы
+    lookup_value_regex = r'\d+'
+
+    def get_queryset(self):
+        queryset = Order.objects.filter(portfolio__user=self.request.user).select_related('stock').order_by('-id')
+        order_status = self.request.query_params.get('status')
+        if order_status:
+            queryset = queryset.filter(status=order_status.upper())
+        return queryset
+
+    def list(self, request):
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @idempotent
+    def create(self, request):
+        serializer = OrderCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        result = OrderService.place_order(
+            request.user, data['action'], data['order_type'], data['ticker'], data['quantity'], data['trigger_price']
+        )
+        if result['success']:
+            return Response(result, status=status.HTTP_201_CREATED)
+        logger.warning(f"Ошибка размещения заявки для пользователя {request.user.username}: {result['error']}")
+        return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        result = OrderService.cancel_order(request.user, pk)
+        if result['success']:
+            return Response({'message': result['message']}, status=status.HTTP_200_OK)
+        return Response({'error': result['error']}, status=status.HTTP_404_NOT_FOUND)
+
 class PortfolioViewSet(viewsets.GenericViewSet):
     """ViewSet для отображения сводки по портфелю."""
     permission_classes = [IsAuthenticated] # 🛡️ Защищаем точку токеном
 
     @action(detail=False, methods=['get'])
     def summary(self, request):
-        """Возвращает полную сводку по портфелю, включая P&L."""
+        """
+        Возвращает полную сводку по портфелю, включая P&L.
+        ?assets=false — только итоги, без списка позиций (чтение одной строки портфеля).
+        """
+        include_assets = request.query_params.get('assets', 'true').lower() not in ('false', '0')
 
         # 1. Вызов сервиса для сбора и расчета данных
-        summary_data = PortfolioService.get_portfolio_summary(request.user)
+        summary_data = PortfolioService.get_portfolio_summary(request.user, include_assets=include_assets)
 
         # 2. Ответ клиенту
         return Response(summary_data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['get'])
+    def equity(self, request):
+        """
+        Кривая капитала по ежедневным снимкам: /api/portfolio/equity/?days=365
+        Точки от старых к новым: дата, баланс, стоимость акций, чистая стоимость.
+        """
+        serializer = EquityCurveQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        portfolio = PortfolioService.resolve_portfolio(request.user)
+        points = EquitySnapshotService.get_equity_curve(portfolio, serializer.validated_data['days'])
+        return Response({'points': points}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def analytics(self, request):
+        """
+        Риск и доходность текущих позиций по дневной истории цен: /api/portfolio/analytics/?days=365
+        Доходность, волатильность, максимальная просадка, Шарп, бета к голубым фишкам и доли секторов.
+        """
+        serializer = AnalyticsQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        portfolio = PortfolioService.resolve_portfolio(request.user)
+        result = PortfolioAnalytics.get_analytics(portfolio, serializer.validated_data['days'])
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def leaderboard(self, request):
+        """
+        Рейтинг игроков по чистой стоимости: /api/portfolio/leaderboard/?limit=20&around=5
+        Следующая страница — ?cursor=<next_cursor из ответа>. В ответе также место
+        пользователя (me) и его соседи сверху (above) и снизу (below).
+        """
+        serializer = LeaderboardQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        portfolio = PortfolioService.resolve_portfolio(request.user)
+        data = serializer.validated_data
+        result = LeaderboardService.get_leaderboard(portfolio, data['limit'], data.get('cursor'), data['around'])
+        return Response(result, status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'])
     def history(self, request):
-        """Возвращает историю транзакций пользователя."""
-        history_data = PortfolioService.get_transaction_history(request.user)
-        return Response(history_data, status=status.HTTP_200_OK)
\ No newline at end of file
+        """
+        Возвращает историю транзакций пользователя, сначала самые новые:
+        /api/portfolio/history/?ticker=SBER&action=BUY&date_from=2024-01-01&date_to=2024-12-31&limit=50
+        Следующая страница — ?cursor=<next_cursor из ответа> с теми же фильтрами.
+        """
+        serializer = TransactionHistoryQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        history_data = PortfolioService.get_transaction_history(request.user, data['limit'], data.get('cursor'), serializer.filters)
+        return Response(history_data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='history/export')
+    def history_export(self, request):
+        """
+        Выгрузка всей истории файлом: /api/portfolio/history/export/?type=csv|ndjson
+        с теми же фильтрами, что и history. Отдаётся потоком, частями по мере чтения из базы.
+        """
+        serializer = TransactionHistoryQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        file_format = serializer.validated_data['type']
+        portfolio = PortfolioService.resolve_portfolio(request.user)
+        content = PortfolioService.export_transaction_history(portfolio, serializer.filters, file_format)
+        if isinstance(request._request, ASGIRequest):
+            content = _iterate_in_thread(content)
+
+        response = StreamingHttpResponse(content, content_type=HISTORY_EXPORT_CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = f'attachment; filename="transactions.{file_format}"'
+        return response
\ No newline at end of file
@@ -6,3 +6,14 @@ class UsersConfig(AppConfig):
     name = 'apps.users'
     label = 'users'
     verbose_name = 'пользователи'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_delete, post_save
+        from rest_framework.authtoken.models import Token
+        from .authentication import invalidate_token, invalidate_user
+        # Кэш аутентификации по токену сбрасывается при выходе (удаление токена)
+        # и при изменении пользователя (деактивация)
+        post_delete.connect(invalidate_token, sender=Token, dispatch_uid='users.token_deleted')
+        post_save.connect(invalidate_token, sender=Token, dispatch_uid='users.token_saved')
+        post_save.connect(invalidate_user, sender=get_user_model(), dispatch_uid='users.user_saved')
@@ -0,0 +1,150 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# Общий кэш (Redis): токен -> пользователь, и сколько держать неверный токен
+TOKEN_CACHE_PREFIX = 'auth:token:'
+TOKEN_CACHE_TTL = 300
+TOKEN_NEGATIVE_TTL = 30
+# Кэш процесса поверх общего: размер и срок. Удаление токена в другом процессе
+# становится видно здесь не позже чем через TOKEN_LOCAL_TTL секунд
+TOKEN_LOCAL_SIZE = 10_000
+TOKEN_LOCAL_TTL = 10
+
+# Поля пользователя, которые кладутся в общий кэш: только нужное аутентификации и правам.
+# Пароль, email и прочие данные профиля в кэш не попадают
+TOKEN_CACHED_USER_FIELDS = ('id', 'username', 'is_active', 'is_staff')
+
+# Метка неверного токена в обоих уровнях кэша
+INVALID = 'invalid'
+
+
+def _cache_key(key: str) -> str:
+    # Сам токен в ключ кэша не попадает
+    return TOKEN_CACHE_PREFIX + hashlib.sha256(key.encode()).hexdigest()
+
+
+class LocalTokenCache:
+    """LRU процесса с ограничением по времени: cache_key -> (срок, пользователь или INVALID)."""
+
+    def __init__(self, maxsize: int = TOKEN_LOCAL_SIZE, ttl: float = TOKEN_LOCAL_TTL):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry[1]
+
+    def set(self, cache_key, value, ttl=None):
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + min(ttl or self.ttl, self.ttl), value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, cache_key):
+        with self._lock:
+            self._entries.pop(cache_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication с кэшем "токен -> пользователь" в два уровня: LRU процесса
+    и общий кэш (Redis) с TTL. Неверные токены тоже кэшируются, на TOKEN_NEGATIVE_TTL.
+    На тёплом кэше аутентификация не делает ни одного запроса к базе.
+
+    Запись сбрасывается при удалении токена (logout djoser, админка) и при любом
+    сохранении пользователя (деактивация, смена данных, вход) — см. invalidate_token /
+    invalidate_user, подключены в UsersConfig.ready.
+    """
+
+    local = LocalTokenCache()
+
+    def authenticate_credentials(self, key):
+        cache_key = _cache_key(key)
+        user = self.local.get(cache_key)
+        if user is None:
+            fields = cache.get(cache_key)
+            if fields is None:
+                fields = self._load(key, cache_key)
+            user = fields if fields == INVALID else self._build_user(fields)
+            self.local.set(cache_key, user, TOKEN_NEGATIVE_TTL if user == INVALID else None)
+
+        if user == INVALID:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        # Своя копия на запрос: общий объект из кэша процесса не меняется между запросами
+        return copy.copy(user), key
+
+    def _load(self, key, cache_key):
+        """
+        Поля пользователя и id его портфеля из базы (один запрос) в общий кэш;
+        INVALID, если токена нет.
+        """
+        # id портфеля (он не меняется) едет вместе с пользователем: сервисы портфеля
+        # получают его без запроса, см. PortfolioService.resolve_portfolio
+        fields = (
+            self.get_model().objects.filter(key=key)
+            .values(*(f'user__{name}' for name in TOKEN_CACHED_USER_FIELDS), portfolio_id=F('user__portfolio'))
+            .first()
+        )
+        if fields is None:
+            cache.set(cache_key, INVALID, timeout=TOKEN_NEGATIVE_TTL)
+            return INVALID
+        fields = {name.removeprefix('user__'): value for name, value in fields.items()}
+        cache.set(cache_key, fields, timeout=TOKEN_CACHE_TTL)
+        return fields
+
+    @staticmethod
+    def _build_user(fields: dict):
+        """
+        Пользователь из полей кэша. Собран как загруженный из базы с отложенными
+        остальными полями: обращение к ним читает их из базы, а save() обновляет только
+        загруженные поля и не затирает пароль и профиль пустыми значениями.
+        """
+        User = get_user_model()
+        # from_db ждёт значения в порядке полей модели
+        names = [field.attname for field in User._meta.concrete_fields if field.attname in TOKEN_CACHED_USER_FIELDS]
+        user = User.from_db(User.objects.db, names, [fields[name] for name in names])
+        user.portfolio_id = fields['portfolio_id']
+        return user
+
+
+def invalidate_key(key: str):
+    cache_key = _cache_key(key)
+    cache.delete(cache_key)
+    CachedTokenAuthentication.local.delete(cache_key)
+
+
+def invalidate_token(sender, instance, **kwargs):
+    """Подписчик post_delete / post_save Token: токен удалён или заменён."""
+    invalidate_key(instance.key)
+
+
+def invalidate_user(sender, instance, **kwargs):
+    """Подписчик post_save пользователя (деактивация, смена данных): сбрасывает кэш его токена."""
+    for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        invalidate_key(key)
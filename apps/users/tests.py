@@ -1,3 +1,93 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from .authentication import TOKEN_CACHED_USER_FIELDS, CachedTokenAuthentication, _cache_key
+
+User = get_user_model()
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    """Аутентификация по токену: кэш, отрицательный кэш и сброс при выходе/деактивации."""
+
+    def setUp(self):
+        cache.clear()
+        CachedTokenAuthentication.local.clear()
+        self.user = User.objects.create(username='auth_user')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def me(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/auth/users/me/')
+        return response, [q['sql'] for q in ctx.captured_queries if 'authtoken_token' in q['sql']]
+
+    def test_warm_cache_makes_no_token_queries(self):
+        response, queries = self.me()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.me()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['username'], 'auth_user')
+        self.assertEqual(queries, [])
+
+        # Только общий кэш (другой процесс): тоже без базы
+        CachedTokenAuthentication.local.clear()
+        response, queries = self.me()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_invalid_token_is_cached(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + 'x' * 40)
+        response, queries = self.me()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.me()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(queries, [])
+
+    def test_logout_invalidates_token(self):
+        self.assertEqual(self.me()[0].status_code, 200)
+        self.assertEqual(self.client.post('/auth/token/logout/').status_code, 204)
+        self.assertEqual(self.me()[0].status_code, 401)
+
+    def test_deactivation_invalidates_token(self):
+        self.assertEqual(self.me()[0].status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.me()[0].status_code, 401)
+
+    def test_cached_user_is_not_shared_between_requests(self):
+        auth = CachedTokenAuthentication()
+        first, _ = auth.authenticate_credentials(self.token.key)
+        first.first_name = 'changed'
+        second, _ = auth.authenticate_credentials(self.token.key)
+        self.assertEqual(second.first_name, '')
+        self.assertIsNot(first._state, second._state)
+
+    def test_shared_cache_holds_no_secrets(self):
+        self.user.set_password('Sup3r-secret-pass')
+        self.user.email = 'auth@example.com'
+        self.user.first_name = 'Auth'
+        self.user.save()
+        response, _ = self.me()
+        self.assertEqual(response.data['first_name'], 'Auth')
+
+        cached = cache.get(_cache_key(self.token.key))
+        self.assertEqual(set(cached), {*TOKEN_CACHED_USER_FIELDS, 'portfolio_id'})
+        self.assertNotIn('password', cached)
+        self.assertNotIn('email', cached)
+
+        # Профиль, сохранённый через пользователя из кэша, не затирает пароль и email
+        response = self.client.patch('/auth/users/me/', {'last_name': 'User'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name, self.user.email), ('Auth', 'User', 'auth@example.com'))
+        self.assertTrue(self.user.check_password('Sup3r-secret-pass'))
@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Поток цен /api/market/stream/ (Server-Sent Events) работает только под ASGI:
+uvicorn config.asgi:application --workers 4
+Каждый воркер держит один PriceBroadcaster (apps.market.streaming) на все свои соединения.
 """
 
 import os
@@ -90,10 +90,51 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Параллельные писатели (веб, бот, Celery) ждут блокировку записи до timeout
+            # секунд вместо мгновенного "database is locked". Транзакции остаются DEFERRED:
+            # сделки и заявки берут блокировку сразу через apps.portfolio.locking.write_transaction,
+            # а только читающие atomic() друг друга не ждут.
+            'timeout': 20,
+        },
+        # Тестовая база — файл (в .gitignore): у общей in-memory базы SQLite нет ожидания
+        # блокировок, а тесты параллельных сделок ходят в неё из нескольких потоков
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Кэш цен (apps.market.cache.PriceCache) должен быть общим для веб-процессов и Celery,
+# поэтому в проде — Redis (REDIS_CACHE_URL=redis://127.0.0.1:6379/1).
+# Без переменной окружения (разработка, тесты) — локальная память процесса.
+
+REDIS_CACHE_URL = os.environ.get('REDIS_CACHE_URL')
+
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
+# Telegram-бот (manage.py runbot)
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+# Адрес Bot API; в тестах — локальный сервер-заглушка
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -165,18 +206,88 @@ CELERY_BEAT_SCHEDULE = {
     're-initialize-stocks-weekly': {
         'task': 'apps.market.tasks.initialize_all_stocks_task',
         'schedule': crontab(hour=4, minute=30, day_of_week=6), # 💡 Расписание: каждую субботу (day_of_week=6) в 04:30
-    }
+    },
+    # История цен: свёртка тиков в свечи 1m -> 1h -> 1d
+    'rollup-price-history-1m': {
+        'task': 'apps.market.tasks.rollup_price_history_task',
+        'schedule': timedelta(minutes=5),
+        'args': ('1m',),
+    },
+    'rollup-price-history-1h': {
+        'task': 'apps.market.tasks.rollup_price_history_task',
+        'schedule': timedelta(minutes=30),
+        'args': ('1h',),
+    },
+    'rollup-price-history-1d': {
+        'task': 'apps.market.tasks.rollup_price_history_task',
+        'schedule': timedelta(hours=6),
+        'args': ('1d',),
+    },
+    # Удаление тиков и свечей старше срока хранения
+    'prune-price-history-daily': {
+        'task': 'apps.market.tasks.prune_price_history_task',
+        'schedule': crontab(hour=3, minute=15),
+    },
+    # Удаление просроченных ключей Idempotency-Key
+    'prune-idempotency-keys-hourly': {
+        'task': 'apps.portfolio.tasks.prune_idempotency_keys_task',
+        'schedule': timedelta(hours=1),
+    },
+    # Рейтинг игроков: пересборка снимка мест из базы
+    'rebuild-leaderboard': {
+        'task': 'apps.portfolio.tasks.rebuild_leaderboard_task',
+        'schedule': timedelta(minutes=15),
+    },
+    # Сверка материализованной оценки портфелей с полным пересчётом (исправление пачками)
+    'reconcile-valuations-nightly': {
+        'task': 'apps.portfolio.tasks.reconcile_valuations_task',
+        'schedule': crontab(hour=1, minute=30),
+    },
+    # Кривая капитала: снимок всех портфелей после вечерней сессии MOEX
+    'snapshot-equity-nightly': {
+        'task': 'apps.portfolio.tasks.snapshot_equity_task',
+        'schedule': crontab(hour=23, minute=55),
+    },
+    # Сверка балансов и позиций с журналом сделок (только отчёт, исправление — replayledger --fix)
+    'replay-ledger-nightly': {
+        'task': 'apps.portfolio.tasks.replay_ledger_task',
+        'schedule': crontab(hour=2, minute=30),
+    },
+    # Перенос транзакций старше года в архив небольшими пачками
+    'archive-transactions-nightly': {
+        'task': 'apps.portfolio.tasks.archive_transactions_task',
+        'schedule': crontab(hour=3, minute=45),
+    },
 }
 # Для автоматического обновления цен запускаем следующие процессы:
 # Запуск  Redis: docker run -d -p 6379:6379 --name investor-redis redis
 # Запуск Celery worker: celery -A config worker -l info
 # Запуск планировщика Celery: celery -A config beat -l info
 
+# Источник рыночных данных для обновления цен
+# =========================================================
+# По умолчанию — живой MOEX ISS через moexalgo. Для нагрузочных прогонов без сети
+# можно проигрывать запись, сделанную командой recordmarket:
+# MARKET_DATA_SOURCE = {
+#     'BACKEND': 'apps.market.sources.ReplaySource',
+#     'OPTIONS': {'path': 'market.jsonl.gz', 'speed': 100, 'loop': True},
+# }
+# Вне торговых часов — синтетические цены (геометрическое броуновское движение):
+# MARKET_DATA_SOURCE = {
+#     'BACKEND': 'apps.market.simulator.SimulatedSource',
+#     'OPTIONS': {'seed': 42, 'time_scale': 60},
+# }
+MARKET_DATA_SOURCE = {
+    'BACKEND': 'apps.market.sources.MoexAlgoSource',
+    'OPTIONS': {'engine': 'shares', 'board': 'tqbr'},
+}
+
 # Django Rest Framework Settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        # 💡 Аутентификация по токену (полученный токен передаем в Headers)
-        'rest_framework.authentication.TokenAuthentication',
+        # 💡 Аутентификация по токену (полученный токен передаем в Headers);
+        # пара "токен -> пользователь" кэшируется, см. apps/users/authentication.py
+        'apps.users.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
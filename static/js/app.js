@@ -6,6 +6,8 @@ const TRADE_BUY_URL = API_ROOT + 'trade/buy/';
 const TRADE_SELL_URL = API_ROOT + 'trade/sell/';
 const STOCK_SEARCH_URL = '/api/market/search/';
 const MARKET_LIST_URL = '/api/market/list/';
+const PRICE_STREAM_URL = '/api/market/stream/';
+const PRICE_STREAM_TICKET_URL = '/api/market/stream/ticket/';
 const LOGIN_URL = '/auth/token/login/';
 const REGISTER_URL = '/auth/users/';
 const USER_ME_URL = '/auth/users/me/';
@@ -41,6 +43,85 @@ function displayMessage(message, isError = false) {
     }
 }
 
+// --- ПОТОК ЦЕН (Server-Sent Events) ---
+
+// Без потока (сервер запущен не через ASGI, браузер без EventSource) страница
+// перечитывает данные с этим интервалом; ответы списка ревалидируются по ETag
+const PRICE_POLL_INTERVAL_MS = 60000;
+// Пауза перед новой подпиской, если поток закрылся (разрыв, истёкший билет)
+const PRICE_STREAM_RESUBSCRIBE_MS = 5000;
+
+let priceStream = null;
+let pricePollTimer = null;
+// Сервер ответил 501 — до перезагрузки страницы поток больше не запрашиваем
+let priceStreamUnavailable = false;
+
+function closePriceUpdates() {
+    if (priceStream) priceStream.close();
+    priceStream = null;
+    clearInterval(pricePollTimer);
+    pricePollTimer = null;
+}
+
+/**
+ * Подписывается на изменения цен вместо периодического перезапроса списков.
+ * Сервер присылает только тикеры, цена которых изменилась в очередном обновлении.
+ * Постоянный токен в адрес потока не попадает: сначала берётся одноразовый билет
+ * (POST с заголовком Authorization), и уже он передаётся в ?ticket=.
+ * Если поток недоступен, страница раз в PRICE_POLL_INTERVAL_MS вызывает refetch.
+ * @param {string[]|null} tickers Тикеры для подписки (null — все акции)
+ * @param {function(Object, number)} onPrices Колбэк: {TICKER: {price, lot_size}}, число пропущенных событий
+ * @param {function()} refetch Обычная загрузка данных страницы — запасной путь без потока
+ */
+async function subscribePrices(tickers, onPrices, refetch) {
+    const token = getAuthToken();
+    if (!token) return;
+
+    closePriceUpdates();
+
+    if (window.EventSource && !priceStreamUnavailable) {
+        try {
+            const response = await fetch(PRICE_STREAM_TICKET_URL, {
+                method: 'POST',
+                headers: { 'Authorization': `Token ${token}` }
+            });
+            if (response.ok) {
+                const { ticket } = await response.json();
+                openPriceStream(ticket, tickers, onPrices, refetch);
+                return;
+            }
+            if (response.status === 501) priceStreamUnavailable = true;
+        } catch (error) {
+            console.error('Не удалось подписаться на поток цен:', error);
+        }
+    }
+
+    pricePollTimer = setInterval(refetch, PRICE_POLL_INTERVAL_MS);
+}
+
+function openPriceStream(ticket, tickers, onPrices, refetch) {
+    const params = new URLSearchParams({ ticket });
+    if (tickers && tickers.length) params.append('tickers', tickers.join(','));
+
+    const stream = new EventSource(`${PRICE_STREAM_URL}?${params.toString()}`);
+    priceStream = stream;
+    stream.addEventListener('prices', (e) => {
+        const event = JSON.parse(e.data);
+        onPrices(event.prices, event.dropped);
+    });
+    stream.addEventListener('error', () => {
+        // Билет одноразовый: автоматическое переподключение EventSource получает 401
+        // и закрывает поток — подписываемся заново с новым билетом
+        if (stream.readyState !== EventSource.CLOSED || priceStream !== stream) return;
+        priceStream = null;
+        setTimeout(() => {
+            if (priceStream === null && pricePollTimer === null) {
+                subscribePrices(tickers, onPrices, refetch);
+            }
+        }, PRICE_STREAM_RESUBSCRIBE_MS);
+    });
+}
+
 // --- ЛОГИКА ИМЕНИ ПОЛЬЗОВАТЕЛЯ (Placeholder) ---
 
 /**
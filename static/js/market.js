@@ -62,9 +62,11 @@ async function fetchPortfolioSummary() {
         // 2. Отображение активов
         const tbody = document.getElementById('assets-table').querySelector('tbody');
         tbody.innerHTML = '';
+        portfolioSummary = summary;
 
         summary.assets.forEach(asset => {
             const row = tbody.insertRow();
+            row.dataset.ticker = asset.ticker;
 
             const assetPnl = parseFloat(asset.profit_loss);
             const assetPnlPercent = parseFloat(asset.profit_loss_percent);
@@ -82,6 +84,11 @@ async function fetchPortfolioSummary() {
             row.insertCell().textContent = asset.lot_size;
         });
 
+        // 3. Дальше цены позиций обновляются из потока цен (без потока — периодическим перезапросом)
+        if (summary.assets.length) {
+            subscribePrices(summary.assets.map(asset => asset.ticker), applyPortfolioPrices, fetchPortfolioSummary);
+        }
+
     } catch (error) {
         displayMessage('Не удалось загрузить данные портфеля.', true);
         console.error(error);
@@ -89,6 +96,52 @@ async function fetchPortfolioSummary() {
     await fetchTransactionHistory();
 }
 
+// Последняя загруженная сводка: по ней пересчитываются стоимость и P&L при новых ценах
+let portfolioSummary = null;
+
+/**
+ * Пересчитывает строки активов и итоги портфеля по событию из потока цен.
+ */
+function applyPortfolioPrices(prices, dropped) {
+    if (!portfolioSummary) return;
+    // Часть событий потеряна (медленное соединение) — перечитываем сводку целиком
+    if (dropped) {
+        fetchPortfolioSummary();
+        return;
+    }
+    const tbody = document.getElementById('assets-table').querySelector('tbody');
+
+    let totalMarketValue = 0;
+    let totalCostBasis = 0;
+
+    portfolioSummary.assets.forEach(asset => {
+        if (prices[asset.ticker]) {
+            asset.current_price = prices[asset.ticker].price;
+        }
+        const marketValue = asset.quantity * parseFloat(asset.current_price);
+        const costBasis = asset.quantity * parseFloat(asset.average_buy_price);
+        const assetPnl = marketValue - costBasis;
+        const assetPnlPercent = costBasis > 0 ? assetPnl / costBasis * 100 : 0;
+        totalMarketValue += marketValue;
+        totalCostBasis += costBasis;
+
+        const row = tbody.querySelector(`tr[data-ticker="${asset.ticker}"]`);
+        if (!row) return;
+        const pnlClass = assetPnl >= 0 ? 'profit' : 'loss';
+        row.cells[3].textContent = parseFloat(asset.current_price).toFixed(2);
+        row.cells[4].textContent = marketValue.toFixed(2);
+        row.cells[5].innerHTML = `<span class="${pnlClass}">${assetPnl.toFixed(2)}</span>`;
+        row.cells[6].innerHTML = `<span class="${pnlClass}">${assetPnlPercent.toFixed(2)}%</span>`;
+    });
+
+    const totalPnl = totalMarketValue - totalCostBasis;
+    const totalPnlPercent = totalCostBasis > 0 ? totalPnl / totalCostBasis * 100 : 0;
+    document.getElementById('market-value-display').textContent = totalMarketValue.toLocaleString('ru-RU', { style: 'currency', currency: 'RUB' });
+    const pnlElement = document.getElementById('pnl-display');
+    pnlElement.textContent = `${totalPnl.toLocaleString('ru-RU', { style: 'currency', currency: 'RUB' })} (${totalPnlPercent.toFixed(2)}%)`;
+    pnlElement.className = totalPnl >= 0 ? 'profit' : 'loss';
+}
+
 // --- 4. ЛОГИКА СДЕЛОК ---
 async function handleTrade(actionType) {
     const token = getAuthToken();
@@ -114,15 +167,26 @@ async function handleTrade(actionType) {
         return;
     }
 
+    // Один ключ на нажатие: повтор после сетевой ошибки вернёт результат первой попытки,
+    // а не совершит сделку второй раз
+    const idempotencyKey = crypto.randomUUID();
+    const request = () => fetch(tradeUrl, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Token ${token}`,
+            'Idempotency-Key': idempotencyKey,
+        },
+        body: JSON.stringify({ ticker, quantity })
+    });
+
     try {
-        const response = await fetch(tradeUrl, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Token ${token}`,
-            },
-            body: JSON.stringify({ ticker, quantity })
-        });
+        let response;
+        try {
+            response = await request();
+        } catch (networkError) {
+            response = await request();
+        }
 
         const data = await response.json();
 
@@ -158,7 +222,8 @@ async function fetchTransactionHistory() {
             return;
         }
 
-        const history = await response.json();
+        // Первая страница истории: { results: [...], next_cursor }
+        const history = (await response.json()).results;
 
         const tbody = document.getElementById('history-table').querySelector('tbody');
         tbody.innerHTML = ''; // Очистка старых данных
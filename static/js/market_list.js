@@ -1,3 +1,7 @@
+// Последний ответ списка: при повторном запросе с теми же параметрами отправляем
+// If-None-Match и при 304 Not Modified ничего не перерисовываем
+let marketListCache = { url: null, etag: null };
+
 /**
  * Загружает полный список акций с ценами и рендерит его в таблице.
  */
@@ -9,7 +13,6 @@ async function fetchAndRenderMarketList() {
         return;
     }
     const tableBody = document.querySelector('#market-stocks-table tbody');
-    tableBody.innerHTML = '<tr><td colspan="4">Загрузка...</td></tr>';
 
     // 1. Сбор значений фильтров и поискового запроса
     const searchInput = document.getElementById('market-search-input');
@@ -43,10 +46,22 @@ async function fetchAndRenderMarketList() {
     // 2. Формируем конечный URL с параметрами
     const url = `${MARKET_LIST_URL}?${params.toString()}`;
 
+    const headers = { 'Authorization': `Token ${token}` };
+    const sameRequest = marketListCache.url === url && marketListCache.etag;
+    if (sameRequest) {
+        headers['If-None-Match'] = marketListCache.etag;
+    } else {
+        tableBody.innerHTML = '<tr><td colspan="4">Загрузка...</td></tr>';
+    }
+
     try {
-        const response = await fetch(url, {
-            headers: { 'Authorization': `Token ${token}` }
-        });
+        // no-store: ревалидацией управляем сами, без HTTP-кэша браузера
+        const response = await fetch(url, { headers, cache: 'no-store' });
+
+        // Данные не менялись с прошлой загрузки — таблица уже актуальна
+        if (response.status === 304) {
+            return;
+        }
 
         if (!response.ok) {
             tableBody.innerHTML = '<tr><td colspan="4">Ошибка загрузки данных рынка.</td></tr>';
@@ -54,6 +69,7 @@ async function fetchAndRenderMarketList() {
         }
 
         const stocks = await response.json();
+        marketListCache = { url, etag: response.headers.get('ETag') };
 
         // 3. Очищаем и рендерим данные
         tableBody.innerHTML = '';
@@ -64,9 +80,12 @@ async function fetchAndRenderMarketList() {
 
         stocks.forEach(stock => {
             const row = tableBody.insertRow();
+            row.dataset.ticker = stock.ticker;
             row.insertCell().textContent = stock.ticker;
             row.insertCell().textContent = stock.name;
-            row.insertCell().textContent = parseFloat(stock.current_price).toFixed(2);
+            const priceCell = row.insertCell();
+            priceCell.classList.add('price-cell');
+            priceCell.textContent = parseFloat(stock.current_price).toFixed(2);
 
             // Кнопка для быстрого перехода к покупке
             const actionCell = row.insertCell();
@@ -76,12 +95,34 @@ async function fetchAndRenderMarketList() {
         // 4. Добавляем обработчики для кнопок "Купить"
         attachBuyButtonListeners();
 
+        // 5. Дальше цены обновляются из потока, без повторной загрузки списка
+        //    (без потока — периодический перезапрос с If-None-Match)
+        subscribePrices(stocks.map(stock => stock.ticker), applyPriceUpdates, fetchAndRenderMarketList);
+
     } catch (error) {
         console.error('Сетевая ошибка при загрузке рынка:', error);
         tableBody.innerHTML = '<tr><td colspan="4">Ошибка соединения.</td></tr>';
     }
 }
 
+/**
+ * Обновляет цены в уже отрисованной таблице по событию из потока цен.
+ */
+function applyPriceUpdates(prices, dropped) {
+    // Часть событий потеряна (медленное соединение) — перечитываем список целиком
+    if (dropped) {
+        fetchAndRenderMarketList();
+        return;
+    }
+    const tableBody = document.querySelector('#market-stocks-table tbody');
+    Object.entries(prices).forEach(([ticker, quote]) => {
+        const row = tableBody.querySelector(`tr[data-ticker="${ticker}"]`);
+        if (row) {
+            row.querySelector('.price-cell').textContent = parseFloat(quote.price).toFixed(2);
+        }
+    });
+}
+
 /**
  * Привязывает обработчик к кнопкам "Купить", которые могут быть добавлены динамически.
  * В MVP мы просто перенаправляем пользователя на страницу портфеля с предзаполненным тикером.